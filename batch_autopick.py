@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+## 2026-10-19: Wrote script
+
+"""
+    Headless version of the em_dataset_curator.py autopicker: run the same template matching used by the
+    'Autopick' panel over every image in a directory, writing a '_CURATED.star' file per image with the
+    match scores as _rlnAutopickFigureOfMerit, e.g.:
+        $ batch_autopick.py  template.png  --threshold 0.3  --diameter 150  --angpix 1.1  --mrc_dimensions 4096 4096
+        $ batch_autopick.py  --gaussian_disk 120  --threshold 0.3  --jobs 8  --resume
+        $ batch_autopick.py  side_view.png  top_view.png  --rotations 36  --threshold 0.4
+
+    With more than one template, or with --rotations, each image is matched against the whole template bank
+    (see: image_handler.template_bank_match) and the angle of the best matching rotation is written as the
+    _rlnAnglePsi of each pick.
+
+    With --candidates, every pick down to a lower floor score is also kept (with its score) in a dataset-wide
+    candidate store in the output directory (see: candidate_store.py), from which the '_CURATED.star' files can be
+    written again at any other threshold above the floor without matching the images again.
+
+    With --mrc, the full-resolution .MRC micrographs are matched instead of the display images, in overlapping
+    tiles of the memory-mapped file (see: image_handler.tiled_template_match). Images are then processed one at a
+    time with their tiles spread over --jobs threads, and memory use is capped by --memory. Template images
+    are expected at the pixel size of the .MRC files.
+
+    Images are prepared as they are for display in em_dataset_curator.py (scaled, grayscale, sigma contrast),
+    so a threshold tuned in the GUI gives the same picks here. Defaults for the pixel size, .MRC dimensions,
+    diameter, scale, sigma & threshold are read from the '.em_dataset_curator.config' file in the input
+    directory (if present), and can be overridden on the commandline.
+"""
+
+## imports are made at module level (rather than in the run block) so they are available to the worker processes
+import os
+import sys
+import time
+import multiprocessing
+
+## Get the execution path of this script so we can find local modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+try:
+    import image_handler
+    import star_handler
+    import candidate_store
+except :
+    print(" ERROR :: Check if image_handler.py, star_handler.py & candidate_store.py scripts are in same folder as this script and run without error (i.e. can be compiled)!")
+    sys.exit()
+
+#############################
+###     DEFINITIONS
+#############################
+
+## display processing of each worker process, its work buffers are reused for every image of the same size (see: prepare_image)
+DISPLAY_PIPELINE = image_handler.Pipeline()
+
+def usage():
+    print("=================================================================================================================")
+    print(" Autopick every image in a directory by template matching (as the em_dataset_curator.py 'Autopick' panel), and")
+    print(" write the picks into a '_CURATED.star' file per image.")
+    print("=================================================================================================================")
+    print(" USAGE:")
+    print("    $ batch_autopick.py  template.png  --threshold 0.3")
+    print("    $ batch_autopick.py  --gaussian_disk 120  --threshold 0.3")
+    print("    $ batch_autopick.py  template_1.png  template_2.png  --rotations 36  --threshold 0.4")
+    print(" Options (default in brackets, settings file values are used if present): ")
+    print("               --i  (.)  :: directory of images (.jpg, .jpeg, .gif)")
+    print("               --o  (--i)  :: directory to write the '_CURATED.star' files")
+    print("   --gaussian_disk  ( )  :: use a generated gaussian disk template of this diameter (Ang) instead of a template image")
+    print("       --rotations  (1)  :: number of in-plane rotations of each template (i.e. 36 = every 10 deg), fills _rlnAnglePsi")
+    print("       --threshold  (0.3)  :: minimum template matching score (0 - 1)")
+    print("          --levels  (1)  :: search coarse-to-fine over this many pyramid levels (single template, no rotations)")
+    print("          --margin  (2 x binning)  :: (with --levels) search radius in px around each coarse candidate")
+    print("      --candidates  ( )  :: also keep all picks down to this floor score in '%s' in the output directory," % candidate_store.DEFAULT_CANDIDATE_DIR)
+    print("                            to re-threshold the dataset later with candidate_store.py (e.g. 0.1)")
+    print("         --exclude  ( )  :: skip carbon/ice/gold regions that differ from the bulk of the image by this many robust")
+    print("                            standard deviations in local mean or variance (e.g. 3)")
+    print("        --diameter  (150)  :: particle diameter (Ang), used to scale the gaussian disk template")
+    print("          --angpix  (1.0)  :: pixel size of the .MRC micrographs (Ang/px)")
+    print("  --mrc_dimensions  (4096 4096)  :: size (x, y) of the .MRC micrographs (px)")
+    print("           --scale  (0.67)  :: scaling factor applied to the images before matching (as the display scale in the GUI)")
+    print("           --sigma  (3)  :: sigma contrast applied to the images before matching")
+    print("            --jobs  (all cores)  :: number of images to process in parallel")
+    print("          --resume  :: skip images that already have a '_CURATED.star' file in the output directory")
+    print("             --mrc  :: match the full-resolution .MRC files in tiles (single template, no rotations)")
+    print("          --memory  (1024)  :: (with --mrc) approximate memory cap in MB for the tiles being matched")
+    print("=================================================================================================================")
+    sys.exit()
+
+def read_settings_file(settings_file):
+    """ Read the subset of em_dataset_curator.py settings used for picking
+        RETURNS
+            settings = dict(); { 'angpix' : float(), 'mrc_dimensions' : (int(), int()), ... }
+    """
+    settings = dict()
+    if not os.path.exists(settings_file):
+        return settings
+    with open(settings_file, 'r') as f :
+        for line in f :
+            line2list = line.split()
+            if len(line2list) < 2 or '#' in line2list[0]:
+                continue
+            if line2list[0] == 'mrc_dimensions':
+                settings['mrc_dimensions'] = (int(line2list[1]), int(line2list[2]))
+            elif line2list[0] in ['angpix', 'scale_factor', 'sigma_contrast', 'picks_threshold']:
+                settings[line2list[0]] = float(line2list[1])
+            elif line2list[0] == 'picks_diameter':
+                settings['picks_diameter'] = int(line2list[1])
+    print(" Loaded default settings from: %s" % settings_file)
+    return settings
+
+def parse_cmdline(cmdline):
+    """ Read the commandline into a dictionary of parameters, printing usage if anything is wrong
+    """
+    PARAMS = {
+        'template_files' : [],
+        'input_dir' : '.',
+        'output_dir' : None,
+        'gaussian_disk' : None,
+        'threshold' : None,
+        'diameter' : None,
+        'angpix' : None,
+        'mrc_dimensions' : None,
+        'scale' : None,
+        'sigma' : None,
+        'rotations' : 1,
+        'levels' : 1,
+        'margin' : None,
+        'exclude' : None,
+        'candidates' : None,
+        'jobs' : os.cpu_count(),
+        'resume' : False,
+        'mrc' : False,
+        'memory' : 1024
+    }
+
+    if len(cmdline) < 2:
+        usage()
+
+    ## expected type of the value(s) for each flag
+    flags = {
+        '--i' : ('input_dir', str),
+        '--o' : ('output_dir', str),
+        '--gaussian_disk' : ('gaussian_disk', float),
+        '--threshold' : ('threshold', float),
+        '--diameter' : ('diameter', float),
+        '--angpix' : ('angpix', float),
+        '--scale' : ('scale', float),
+        '--sigma' : ('sigma', float),
+        '--rotations' : ('rotations', int),
+        '--levels' : ('levels', int),
+        '--margin' : ('margin', int),
+        '--exclude' : ('exclude', float),
+        '--candidates' : ('candidates', float),
+        '--jobs' : ('jobs', int),
+        '--memory' : ('memory', float)
+    }
+
+    i = 1
+    while i < len(cmdline):
+        arg = cmdline[i]
+        if arg in ['-h', '--h', '--help']:
+            usage()
+        elif arg == '--resume':
+            PARAMS['resume'] = True
+        elif arg == '--mrc':
+            PARAMS['mrc'] = True
+        elif arg == '--mrc_dimensions':
+            try:
+                PARAMS['mrc_dimensions'] = (int(cmdline[i + 1]), int(cmdline[i + 2]))
+            except:
+                print(" ERROR :: --mrc_dimensions requires two integer values (x, y)")
+                usage()
+            i += 3
+            continue
+        elif arg in flags:
+            key, value_type = flags[arg]
+            try:
+                PARAMS[key] = value_type(cmdline[i + 1])
+            except:
+                print(" ERROR :: Flag %s requires a value of type %s" % (arg, value_type.__name__))
+                usage()
+            i += 2
+            continue
+        elif os.path.splitext(arg)[1].lower() in ['.png', '.jpg', '.jpeg', '.gif', '.tif', '.tiff']:
+            PARAMS['template_files'].append(arg)
+        else:
+            print(" ERROR :: Unrecognized input: %s" % arg)
+            usage()
+        i += 1
+
+    if len(PARAMS['template_files']) == 0 and PARAMS['gaussian_disk'] is None:
+        print(" ERROR :: No template image or --gaussian_disk diameter given")
+        usage()
+
+    if PARAMS['mrc'] and (len(PARAMS['template_files']) > 1 or PARAMS['rotations'] > 1):
+        print(" ERROR :: --mrc matching supports a single template without rotations")
+        usage()
+    if PARAMS['mrc']:
+        try:
+            import mrcfile
+        except ImportError:
+            print(" ERROR :: --mrc requires mrcfile, try:")
+            print("     pip install mrcfile")
+            sys.exit()
+
+    ## fill any parameters not given on the commandline from the settings file, then the GUI defaults
+    settings = read_settings_file(os.path.join(PARAMS['input_dir'], '.em_dataset_curator.config'))
+    defaults = {
+        'threshold' : settings.get('picks_threshold', 0.3),
+        'diameter' : settings.get('picks_diameter', 150),
+        'angpix' : settings.get('angpix', 1.0),
+        'mrc_dimensions' : settings.get('mrc_dimensions', (4096, 4096)),
+        'scale' : settings.get('scale_factor', 0.67),
+        'sigma' : settings.get('sigma_contrast', 3)
+    }
+    for key in defaults:
+        if PARAMS[key] is None:
+            PARAMS[key] = defaults[key]
+    if PARAMS['output_dir'] is None:
+        PARAMS['output_dir'] = PARAMS['input_dir']
+    PARAMS['jobs'] = max(1, PARAMS['jobs'])
+    PARAMS['rotations'] = max(1, PARAMS['rotations'])
+    PARAMS['levels'] = max(1, PARAMS['levels'])
+    if PARAMS['levels'] > 1 and (len(PARAMS['template_files']) > 1 or PARAMS['rotations'] > 1 or PARAMS['mrc']):
+        print(" ERROR :: --levels supports a single template without rotations (and without --mrc)")
+        usage()
+
+    return PARAMS
+
+def images_in_dir(path, USE_MRC = False):
+    """ Image files in the directory, matching those listed by em_dataset_curator.py
+    """
+    if USE_MRC:
+        image_formats = [".mrc"]
+    else:
+        image_formats = [".gif", ".jpg", ".jpeg"]
+    return [ file for file in sorted(os.listdir(path)) if os.path.splitext(file)[1].lower() in image_formats ]
+
+def curated_star_name(image_name, output_dir):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(image_name))[0] + '_CURATED.star')
+
+def prepare_image(fname, scale_factor, sigma):
+    """ Load an image as it is displayed in em_dataset_curator.py (see: MainUI.load_img)
+        RETURNS
+            im_array = np array (uint8) of the scaled, contrasted grayscale image
+            jpg_dimensions = tuple(x, y); size of the image on disk
+    """
+    import numpy as np
+    from PIL import Image as PIL_Image
+
+    with PIL_Image.open(fname) as im:
+        jpg_dimensions = im.size
+        im = im.resize((int(im.size[0] * scale_factor), int(im.size[1] * scale_factor)))
+        im_array = np.asarray(im.convert('L'))
+
+    ## sigma contrast, clipped to the grayscale range (as em_dataset_curator.py)
+    im_array = DISPLAY_PIPELINE.reset().sigma_contrast(sigma, clamp = True).run(im_array)
+    return im_array, jpg_dimensions
+
+def load_template(template_file):
+    import numpy as np
+    import cv2
+    template = cv2.imread(template_file, cv2.IMREAD_GRAYSCALE)
+    if template is None:
+        print(" ERROR :: Could not read template image: %s" % template_file)
+        sys.exit()
+    return np.array(template).astype(np.uint8)
+
+def picking_floor(PARAMS):
+    """ Lowest score to pick down to: the threshold, or the candidate floor if candidates are kept
+    """
+    if PARAMS['candidates'] is None:
+        return PARAMS['threshold']
+    return min(PARAMS['threshold'], PARAMS['candidates'])
+
+def split_candidates(star_coordinates, PARAMS):
+    """ Split picks in .MRC pixels into the rows of the '_CURATED.star' file (above the threshold) and the candidates to
+        store, as np array [ [x, y, score, psi], ... ] (None if candidates are not kept)
+    """
+    import numpy as np
+    candidates = None
+    if PARAMS['candidates'] is not None:
+        candidates = np.array([ (x, y, score, psi) for x, y, selection_type, psi, score in star_coordinates ], dtype = np.float32).reshape(-1, 4)
+    star_coordinates = [ row for row in star_coordinates if row[4] > PARAMS['threshold'] ]
+    return star_coordinates, candidates
+
+def autopick_image(task):
+    """ Worker function: pick one image and write its '_CURATED.star' file
+        PARAMETERS
+            task = tuple( 'path/to/image.jpg', dict(PARAMS), list( np.array(template), ... ) or None )
+        RETURNS
+            tuple( 'image.jpg', int(number of picks), float(seconds), np array of candidates or None (see: split_candidates) )
+    """
+    import numpy as np
+    fname, PARAMS, templates = task
+    start_time = time.time()
+
+    im_array, jpg_dimensions = prepare_image(fname, PARAMS['scale'], PARAMS['sigma'])
+    ## size of the .MRC relative to the image on disk, and the pixel size of the image used for matching
+    mrc_x, mrc_y = PARAMS['mrc_dimensions']
+    jpg2mrc_scale = (mrc_x / jpg_dimensions[0] + mrc_y / jpg_dimensions[1]) / 2
+    display_angpix = jpg2mrc_scale * PARAMS['angpix'] / PARAMS['scale']
+
+    if templates is None:
+        ## generate the disk against the background grayscale of this image (as AutopickPanel.create_gaussian_disk)
+        background_grayscale = np.percentile(im_array, 75)
+        templates = [ image_handler.gaussian_disk(int(PARAMS['gaussian_disk'] / display_angpix), int(PARAMS['diameter'] / display_angpix), background_color = background_grayscale) ]
+
+    exclude = None
+    if PARAMS['exclude'] is not None:
+        exclude = image_handler.exclusion_mask(im_array, PARAMS['diameter'] / display_angpix, sigma = PARAMS['exclude'])
+
+    if len(templates) == 1 and PARAMS['rotations'] == 1:
+        res, loc = image_handler.template_match(im_array, templates[0], picking_floor(PARAMS), DEBUG = False, levels = PARAMS['levels'], margin = PARAMS['margin'], exclude = exclude)
+        loc = [ (x, y, score, -999.0) for x, y, score in loc ]
+    else:
+        angles = [ i * 360 / PARAMS['rotations'] for i in range(PARAMS['rotations']) ]
+        res, loc = image_handler.template_bank_picks(im_array, templates, angles, picking_floor(PARAMS), exclude = exclude)
+        loc = [ (x, y, score, angle) for x, y, score, template_index, angle in loc ]
+
+    ## picks are in display pixels: map to the image on disk (as MainUI.add_coordinate) then to the .MRC (as jpg2star)
+    star_coordinates = []
+    for x, y, score, psi in loc:
+        jpg_x, jpg_y = int(x / PARAMS['scale']), int(y / PARAMS['scale'])
+        star_coordinates.append((int(jpg_x * jpg2mrc_scale), int(jpg_y * jpg2mrc_scale), 2, psi, score))
+    star_coordinates, candidates = split_candidates(star_coordinates, PARAMS)
+
+    write_curated_star(curated_star_name(fname, PARAMS['output_dir']), star_coordinates)
+
+    return os.path.basename(fname), len(star_coordinates), time.time() - start_time, candidates
+
+def autopick_mrc(fname, PARAMS, templates):
+    """ Pick one full-resolution .MRC file in tiles (tiles are matched on PARAMS['jobs'] threads) and write its '_CURATED.star' file
+        RETURNS
+            tuple( 'image.mrc', int(number of picks), float(seconds), np array of candidates or None (see: split_candidates) )
+    """
+    start_time = time.time()
+    if templates is None:
+        templates = [ image_handler.gaussian_disk(int(PARAMS['gaussian_disk'] / PARAMS['angpix']), int(PARAMS['diameter'] / PARAMS['angpix'])) ]
+
+    exclude = None
+    if PARAMS['exclude'] is not None:
+        exclude = mrc_exclusion_mask(fname, PARAMS['diameter'] / PARAMS['angpix'], PARAMS['exclude'])
+
+    loc = image_handler.tiled_template_match(fname, templates[0], picking_floor(PARAMS), memory_limit = PARAMS['memory'], jobs = PARAMS['jobs'], exclude = exclude, DEBUG = False)
+    ## picks are already in .MRC pixels
+    star_coordinates = [ (x, y, 2, -999.0, score) for x, y, score in loc ]
+    star_coordinates, candidates = split_candidates(star_coordinates, PARAMS)
+    write_curated_star(curated_star_name(fname, PARAMS['output_dir']), star_coordinates)
+
+    return os.path.basename(fname), len(star_coordinates), time.time() - start_time, candidates
+
+def mrc_exclusion_mask(fname, diameter_pixels, sigma):
+    """ Exclusion mask (see: image_handler.exclusion_mask) of a full-resolution .MRC, from every n-th pixel of the memory-mapped
+        file so only a small fraction of it is read
+    """
+    import numpy as np
+    import mrcfile
+    ## sample ~8 pixels across each particle
+    step = max(1, int(diameter_pixels / 8))
+    with mrcfile.mmap(fname, mode = 'r', permissive = True) as mrc:
+        mrc_data = mrc.data
+        if mrc_data.ndim == 3:
+            mrc_data = mrc_data[0]
+        sampled = np.array(mrc_data[::step, ::step], dtype = np.float32)
+    return image_handler.exclusion_mask(sampled, diameter_pixels / step, sigma = sigma)
+
+def write_curated_star(save_fname, star_coordinates):
+    with open(save_fname + '.tmp', 'w') as f :
+        f.write(star_handler.format_coordinates_star(star_coordinates))
+    ## only complete files get the final name, so an interrupted run can be resumed
+    os.replace(save_fname + '.tmp', save_fname)
+    return
+
+#############################
+###     RUN BLOCK
+#############################
+
+if __name__ == "__main__":
+    PARAMS = parse_cmdline(sys.argv)
+
+    print("... Running job")
+    print("========================")
+    for key in ['template_files', 'rotations', 'levels', 'margin', 'exclude', 'candidates', 'gaussian_disk', 'threshold', 'diameter', 'angpix', 'mrc_dimensions', 'scale', 'sigma', 'jobs', 'resume', 'mrc', 'memory']:
+        print("  %s = %s" % (key, PARAMS[key]))
+    print("========================")
+    start_time = time.time()
+
+    templates = None
+    if len(PARAMS['template_files']) > 0:
+        templates = []
+        for template_file in PARAMS['template_files']:
+            templates.append(load_template(template_file))
+            print(" Template loaded: %s %s" % (template_file, templates[-1].shape))
+
+    os.makedirs(PARAMS['output_dir'], exist_ok = True)
+    images = images_in_dir(PARAMS['input_dir'], PARAMS['mrc'])
+    tasks = []
+    skipped = 0
+    for image in images:
+        if PARAMS['resume'] and os.path.exists(curated_star_name(image, PARAMS['output_dir'])):
+            skipped += 1
+            continue
+        tasks.append((os.path.join(PARAMS['input_dir'], image), PARAMS, templates))
+    print(" %s images found, %s to pick (%s skipped with existing '_CURATED.star' files)" % (len(images), len(tasks), skipped))
+
+    ## candidates are only ever appended from this process, as they come back from the workers
+    store = None
+    if PARAMS['candidates'] is not None:
+        store = candidate_store.CandidateStore(os.path.join(PARAMS['output_dir'], candidate_store.DEFAULT_CANDIDATE_DIR))
+
+    total_picks = 0
+    if PARAMS['mrc']:
+        ## one micrograph at a time, each spread over the cores by tile
+        results = (autopick_mrc(*task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(min(PARAMS['jobs'], max(1, len(tasks))))
+        results = pool.imap_unordered(autopick_image, tasks)
+    for i, (image, n, seconds, candidates) in enumerate(results, 1):
+        total_picks += n
+        if store is not None:
+            store.add_micrograph(image, candidates, picking_floor(PARAMS))
+        print("  [%s/%s] %s :: %s picks (%.2f s)" % (i, len(tasks), image, n, seconds))
+    if not PARAMS['mrc']:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start_time
+    print("========================")
+    print(" Picked %s particles from %s images in %.1f s (%.2f s/image)" % (total_picks, len(tasks), elapsed, elapsed / max(1, len(tasks))))
+    if store is not None:
+        print(" Candidates down to %s kept in: %s" % (picking_floor(PARAMS), store.store_dir))
+    print("... job completed.")
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+## 2026-10-19: Wrote module
+
+"""
+    A dataset-wide store of autopick candidates, so the picking threshold can be changed after picking without
+    matching any image again. Every candidate found above a low floor score is kept, in .MRC pixels:
+        x.f32, y.f32, score.f32, psi.f32  :: one raw float32 column file each, appended to & read memory-mapped
+        index.tsv                          :: one line per run of candidates: micrograph name, row offset, count & floor score
+    The candidates of each micrograph are a contiguous run of rows sorted by decreasing score, so the picks above
+    any threshold are a leading slice of the run. Picking a micrograph again appends a new run and a new index line,
+    which overrides the earlier one (the old run is dropped when the store is compacted). Compacting writes a new generation
+    of column files (e.g. x.1.f32) and then swaps in an index that points at them, so the index always matches its columns.
+    Coordinate files for a new threshold are written by streaming through the columns, e.g.:
+        $ candidate_store.py  .autopick_candidates  --threshold 0.4  --o curated/
+    Import this module directly via:
+        from candidate_store import CandidateStore
+"""
+
+import os
+import sys
+import numpy as np
+
+DEFAULT_CANDIDATE_DIR = '.autopick_candidates'
+## the store is only compacted automatically once it has at least this many rows (and most are of replaced runs)
+COMPACT_MIN_ROWS = 1000000
+
+class CandidateStore:
+    """
+    Append-only columnar store of autopick candidates (x, y, score, psi in .MRC pixels) for every micrograph of a dataset.
+    The store directory is created if it does not exist.
+    ### USAGE:
+    ```
+        store = CandidateStore('.autopick_candidates')
+        store.add_micrograph('mic_0001.jpg', [ (x, y, score, psi), ... ], floor = 0.0)
+        x, y, score, psi = store.candidates('mic_0001.jpg', threshold = 0.4)
+        store.export_star('curated/', threshold = 0.4)
+    ```
+    """
+    COLUMNS = ['x', 'y', 'score', 'psi']
+
+    def __init__(self, store_dir = DEFAULT_CANDIDATE_DIR, DEBUG = False):
+        self.store_dir = store_dir
+        self.DEBUG = DEBUG
+        os.makedirs(store_dir, exist_ok = True)
+        self.index_file = os.path.join(store_dir, 'index.tsv')
+        self.rows = 0
+        self.index_size = 0 ## bytes of complete lines in the index file
+        self.generation = 0 ## the column files the index points at, counted up each time the store is compacted
+        ## { micrograph name : dict(offset, count, floor) }
+        self.micrographs = dict()
+        if os.path.exists(self.index_file):
+            self.load_index()
+        self._columns = None
+        return
+
+    def load_index(self):
+        """ Read the index, where a later line for a micrograph replaces an earlier one. An incomplete last line, and any
+            rows past the end of the last complete line, belong to an append that did not finish and are overwritten by the next one.
+        """
+        with open(self.index_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                if line.startswith(b'#generation'):
+                    self.generation = int(line.decode().rstrip('\n').split('\t')[1])
+                    self.index_size += len(line)
+                    continue
+                name, offset, count, floor = line.decode().rstrip('\n').split('\t')
+                self.micrographs[name] = dict(offset = int(offset), count = int(count), floor = float(floor))
+                self.rows = max(self.rows, int(offset) + int(count))
+                self.index_size += len(line)
+        return
+
+    def column_file(self, column, generation = None):
+        if generation is None:
+            generation = self.generation
+        if generation == 0:
+            return os.path.join(self.store_dir, column + '.f32')
+        return os.path.join(self.store_dir, "%s.%s.f32" % (column, generation))
+
+    def columns(self):
+        """ RETURNS
+                columns = dict( column name : np.memmap (float32) of all rows ); opened once and reused until the next append
+        """
+        if self._columns is None:
+            if self.rows == 0:
+                self._columns = { column : np.zeros(0, dtype = '<f4') for column in self.COLUMNS }
+            else:
+                self._columns = { column : np.memmap(self.column_file(column), dtype = '<f4', mode = 'r', shape = (self.rows,)) for column in self.COLUMNS }
+        return self._columns
+
+    def live_rows(self):
+        return sum(entry['count'] for entry in self.micrographs.values())
+
+    def add_micrograph(self, name, candidates, floor):
+        """ Store all candidates of a micrograph, replacing any stored before
+            PARAMETERS
+                name = str(); micrograph name (e.g. 'mic_0001.jpg')
+                candidates = list( (x, y, score, psi), ... ) or np array (n, 4); in .MRC pixels (psi = -999.0 if unknown)
+                floor = float(); the lowest score the picker kept, i.e. thresholds below it give no more picks
+        """
+        candidates = np.asarray(candidates, dtype = np.float32).reshape(-1, 4)
+        candidates = candidates[np.argsort(-candidates[:, 2], kind = 'stable')]
+
+        ## drop the memory maps before the files grow, and cut off any rows of an append that did not finish
+        self._columns = None
+        for i, column in enumerate(self.COLUMNS):
+            file = self.column_file(column)
+            with open(file, 'r+b' if os.path.exists(file) else 'wb') as f:
+                f.truncate(self.rows * 4)
+                f.seek(self.rows * 4)
+                f.write(np.ascontiguousarray(candidates[:, i], dtype = '<f4').tobytes())
+        ## rows only count once the index line that points at them is written
+        line = ("%s\t%s\t%s\t%s\n" % (name, self.rows, len(candidates), float(floor))).encode()
+        with open(self.index_file, 'r+b' if os.path.exists(self.index_file) else 'wb') as f:
+            f.truncate(self.index_size)
+            f.seek(self.index_size)
+            f.write(line)
+        self.index_size += len(line)
+        self.micrographs[name] = dict(offset = self.rows, count = len(candidates), floor = float(floor))
+        self.rows += len(candidates)
+
+        if self.rows > 2 * self.live_rows() and self.rows > COMPACT_MIN_ROWS:
+            self.compact()
+
+        if self.DEBUG:
+            print(" Candidate store :: %s candidates for %s (floor = %s), %s micrographs" % (len(candidates), name, floor, len(self.micrographs)))
+        return
+
+    def save_index(self):
+        """ Rewrite the index with one line per micrograph (via a temporary file, replaced in one step)
+        """
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write("#generation\t%s\n" % self.generation)
+            for name, entry in self.micrographs.items():
+                f.write("%s\t%s\t%s\t%s\n" % (name, entry['offset'], entry['count'], entry['floor']))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.index_file)
+        self.index_size = os.path.getsize(self.index_file)
+        return
+
+    def candidates(self, name, threshold = None):
+        """ RETURNS
+                x, y, score, psi = np arrays (memory-mapped) of the candidates of a micrograph with a score above the threshold,
+                                   in order of decreasing score (all candidates if threshold is None)
+        """
+        entry = self.micrographs[name]
+        columns = self.columns()
+        start, end = entry['offset'], entry['offset'] + entry['count']
+        if threshold is not None:
+            ## scores are in decreasing order within the run
+            end = start + int(np.searchsorted(-columns['score'][start:end], -threshold, side = 'left'))
+        return tuple(columns[column][start:end] for column in self.COLUMNS)
+
+    def count_above(self, thresholds):
+        """ Number of candidates in the whole dataset above each of a list of thresholds
+        """
+        counts = np.zeros(len(thresholds), dtype = np.int64)
+        scores = self.columns()['score']
+        negative_thresholds = -np.asarray(thresholds, dtype = np.float64)
+        for entry in self.micrographs.values():
+            counts += np.searchsorted(-scores[entry['offset'] : entry['offset'] + entry['count']], negative_thresholds, side = 'left')
+        return counts
+
+    def export_star(self, output_dir, threshold, micrographs = None):
+        """ Write a '_CURATED.star' file of the candidates above a threshold for every (or the given) micrograph(s)
+            RETURNS
+                n_files, n_particles = int(), int()
+        """
+        import star_handler
+
+        os.makedirs(output_dir, exist_ok = True)
+        if micrographs is None:
+            micrographs = sorted(self.micrographs)
+        n_particles = 0
+        below_floor = 0
+        for name in micrographs:
+            if threshold < self.micrographs[name]['floor']:
+                below_floor += 1
+            x, y, score, psi = self.candidates(name, threshold)
+            ## selection type 2 as written by batch_autopick.py
+            rows = zip(x.tolist(), y.tolist(), [ 2 ] * len(x), psi.tolist(), score.tolist())
+            save_fname = os.path.join(output_dir, os.path.splitext(name)[0] + '_CURATED.star')
+            with open(save_fname + '.tmp', 'w') as f:
+                f.write(star_handler.format_coordinates_star(rows))
+            os.replace(save_fname + '.tmp', save_fname)
+            n_particles += len(x)
+        if below_floor > 0:
+            print(" WARNING :: threshold (%s) is below the floor score candidates were kept down to for %s micrographs, re-pick them for all picks above it" % (threshold, below_floor))
+        if self.DEBUG:
+            print(" Written %s particles above %s into %s '_CURATED.star' files in: %s" % (n_particles, threshold, len(micrographs), output_dir))
+        return len(micrographs), n_particles
+
+    def compact(self):
+        """ Rewrite the column files with only the current run of each micrograph. The new columns are written as the next
+            generation of files next to the current ones, and only become the store once the index that points at them has
+            replaced the old index. If this is interrupted, the old index & columns are left as they were.
+        """
+        columns = self.columns()
+        names = sorted(self.micrographs)
+        old_generation = self.generation
+        new_generation = old_generation + 1
+        for column in self.COLUMNS:
+            with open(self.column_file(column, new_generation), 'wb') as f:
+                for name in names:
+                    entry = self.micrographs[name]
+                    f.write(np.ascontiguousarray(columns[column][entry['offset'] : entry['offset'] + entry['count']]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        ## close the memory maps before the old files are removed
+        del columns
+        self._columns = None
+        offset = 0
+        for name in names:
+            self.micrographs[name]['offset'] = offset
+            offset += self.micrographs[name]['count']
+        dropped = self.rows - offset
+        self.rows = offset
+        self.generation = new_generation
+        self.save_index()
+        for column in self.COLUMNS:
+            if os.path.exists(self.column_file(column, old_generation)):
+                os.remove(self.column_file(column, old_generation))
+        if self.DEBUG:
+            print(" Compacted candidate store: %s rows dropped, %s rows kept" % (dropped, self.rows))
+        return
+
+def usage():
+    print("===================================================================================================")
+    print(" Re-threshold the autopick candidates of a whole dataset and write new '_CURATED.star' files:")
+    print("    $ candidate_store.py  %s  --threshold 0.4  --o curated/" % DEFAULT_CANDIDATE_DIR)
+    print(" Without --threshold, a summary of the store is printed. Options: ")
+    print("   --threshold  <n>    :: minimum score of the picks to write")
+    print("           --o  <dir>  :: output directory for the '_CURATED.star' files (required with --threshold)")
+    print("     --compact         :: drop the candidates of micrographs that have since been picked again")
+    print("===================================================================================================")
+    sys.exit()
+
+#############################################
+##  RUN BLOCK
+#############################################
+if __name__ == "__main__":
+    import time
+
+    ## Get the execution path of this script so we can find local modules
+    sys.path.append(os.path.dirname(os.path.abspath(sys.argv[0])))
+
+    if len(sys.argv) < 2 or '--help' in sys.argv or '-h' in sys.argv:
+        usage()
+
+    store_dir = sys.argv[1]
+    args = [ arg for arg in sys.argv[2:] if arg != '--compact' ]
+    options = {}
+    for i in range(0, len(args) - 1, 2):
+        options[args[i]] = args[i + 1]
+    for option in options:
+        if option not in ['--threshold', '--o']:
+            print(" ERROR :: Unrecognized option: %s" % option)
+            usage()
+    if not os.path.exists(os.path.join(store_dir, 'index.tsv')):
+        print(" ERROR :: Could not find a candidate store in: %s" % store_dir)
+        usage()
+
+    store = CandidateStore(store_dir, DEBUG = True)
+    if '--compact' in sys.argv:
+        store.compact()
+
+    if '--threshold' in options:
+        if '--o' not in options:
+            print(" ERROR :: Give an output directory for the '_CURATED.star' files with --o")
+            usage()
+        start_time = time.time()
+        n_files, n_particles = store.export_star(options['--o'], float(options['--threshold']))
+        print(" Written %s particles into %s files in %.2f s" % (n_particles, n_files, time.time() - start_time))
+    else:
+        thresholds = np.round(np.arange(0.1, 1.0, 0.1), 1)
+        floors = [ entry['floor'] for entry in store.micrographs.values() ]
+        print(" %s micrographs, %s candidates (floor score %s - %s)" % (len(store.micrographs), store.live_rows(), min(floors, default = '--'), max(floors, default = '--')))
+        for threshold, count in zip(thresholds, store.count_above(thresholds)):
+            print("   above %.1f :: %s picks%s" % (threshold, count, "  (incomplete, below the floor of some micrographs)" if threshold < max(floors, default = 0) else ""))
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+## 2026-10-19: Wrote script
+
+"""
+    After curating a dataset with em_dataset_curator.py each micrograph has its own '_CURATED.star' file
+    holding its particle coordinates. RELION expects a single particles .STAR file (v3.1+) with an optics
+    table and a particles table, where each particle carries its _rlnMicrographName & _rlnOpticsGroup.
+
+    This script joins all '_CURATED.star' files in a directory against the micrographs table of a
+    'micrographs_ctf.star' file (parsed once and held in a hash table keyed on micrograph basename), and
+    streams the result into a single particles .STAR file:
+        $ curated_to_particles_star.py  /path/to/micrographs_ctf.star  --i /path/to/curated/  --marked marked_imgs.txt
+
+    Each micrograph's coordinate file is read in parallel and written out as soon as it is parsed (in
+    micrograph order), so memory use is bounded by the number of files in flight rather than the number
+    of particles in the dataset.
+"""
+
+## imports are made at module level (rather than in the run block) so they are available to the worker processes
+import os
+import sys
+import time
+import multiprocessing
+
+## Get the execution path of this script so we can find local modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+try:
+    import star_handler
+except :
+    print(" ERROR :: Check if star_handler.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
+    sys.exit()
+
+#############################
+###     DEFINITIONS
+#############################
+
+## columns of the particles table taken from the coordinate files, ahead of the micrographs table columns
+PARTICLE_COLUMNS = ['_rlnCoordinateX', '_rlnCoordinateY', '_rlnAnglePsi', '_rlnAutopickFigureOfMerit']
+
+def usage():
+    print("=================================================================================================================")
+    print(" Combine all '_CURATED.star' coordinate files from em_dataset_curator.py into a single RELION (v3.1+) particles")
+    print(" .STAR file, taking micrograph names, optics groups & CTF values from a CtfFind 'micrographs_ctf.star' file.")
+    print(" Micrographs listed in a marked images file are skipped.")
+    print("=================================================================================================================")
+    print(" USAGE:")
+    print("    $ curated_to_particles_star.py  /path/to/micrographs_ctf.star")
+    print(" Options (default in brackets): ")
+    print("       --i  (.)  :: directory with the '_CURATED.star' files")
+    print("  --marked  ( )  :: marked images file(s) to skip (e.g. marked_imgs.txt), can be given more than once")
+    print("       --o  (particles.star)  :: output file name")
+    print("       --j  (all cores)  :: number of processes used to read coordinate files")
+    print("=================================================================================================================")
+    sys.exit()
+
+def parse_cmdline(cmdline):
+    """ Read the commandline into a dictionary of parameters, printing usage if anything is wrong
+    """
+    PARAMS = {
+        'ctf_star' : None,
+        'input_dir' : '.',
+        'marked_files' : [],
+        'output_file' : 'particles.star',
+        'jobs' : os.cpu_count()
+    }
+
+    if len(cmdline) < 2:
+        usage()
+
+    i = 1
+    while i < len(cmdline):
+        arg = cmdline[i]
+        if arg in ['-h', '--h', '--help']:
+            usage()
+        elif arg in ['--i', '--marked', '--o', '--j']:
+            if i + 1 >= len(cmdline):
+                print(" ERROR :: No value given for flag: %s" % arg)
+                usage()
+            value = cmdline[i + 1]
+            if arg == '--i':
+                PARAMS['input_dir'] = value
+            elif arg == '--marked':
+                PARAMS['marked_files'].append(value)
+            elif arg == '--o':
+                PARAMS['output_file'] = value
+            elif arg == '--j':
+                try:
+                    PARAMS['jobs'] = max(1, int(value))
+                except:
+                    print(" ERROR :: --j requires an integer value (given: %s)" % value)
+                    usage()
+            i += 2
+            continue
+        elif os.path.splitext(arg)[1] == '.star':
+            PARAMS['ctf_star'] = arg
+        else:
+            print(" ERROR :: Unrecognized input: %s" % arg)
+            usage()
+        i += 1
+
+    if PARAMS['ctf_star'] is None:
+        print(" ERROR :: No micrographs_ctf.star file given")
+        usage()
+
+    return PARAMS
+
+def micrograph_key(mic_name):
+    """ Micrographs are matched on their basename without extension, e.g.:
+            MotionCorr/job002/Movies/mic_0001.mrc -> mic_0001
+            mic_0001.jpg -> mic_0001
+    """
+    return os.path.splitext(os.path.basename(mic_name))[0]
+
+def parse_marked_files(files):
+    """ Load one or more marked images files (one name per line, '#' for comments) into a set of micrograph keys
+    """
+    marked = set()
+    for file in files:
+        with open(file, 'r') as f :
+            for line in f :
+                line_to_list = line.split()
+                if len(line_to_list) == 0 or line_to_list[0][0] == '#':
+                    continue
+                marked.add(micrograph_key(line_to_list[0]))
+        print(" %s marked micrographs loaded from %s" % (len(marked), file))
+    return marked
+
+def parse_ctf_star(file):
+    """ Read the optics and micrographs tables of a RELION v3.1+ micrographs_ctf.star file in a single streaming pass over each.
+        RETURNS
+            optics_columns = list( '_rlnColumnName', ... ) in column order
+            optics_rows = list( list( str(), ... ), ... )
+            mic_columns = list( '_rlnColumnName', ... ) in column order, without any of the PARTICLE_COLUMNS
+            mic_rows = { 'mic_key' : str('tab-joined micrograph table entries'), ... } of the mic_columns
+    """
+    print(" >>> PARSING %s" % file)
+
+    optics_columns, optics_data_start = star_handler.get_star_columns(file, 'data_optics')
+    if len(optics_columns) == 0:
+        print(" ERROR :: No 'data_optics' table found in %s, a RELION v3.1+ file is required" % file)
+        sys.exit()
+    optics_rows = list(star_handler.iter_star_rows(file, optics_data_start))
+
+    mic_columns, mic_data_start = star_handler.get_star_columns(file, 'data_micrographs')
+    if '_rlnMicrographName' not in mic_columns:
+        print(" ERROR :: No _rlnMicrographName column found in the 'data_micrographs' table of %s" % file)
+        sys.exit()
+    mic_name_index = mic_columns['_rlnMicrographName'] - 1
+
+    ## a column can only appear once in the particles table, so the coordinate file values replace any in the micrographs table
+    kept_columns = []
+    for column in sorted(mic_columns, key = mic_columns.get):
+        if column in PARTICLE_COLUMNS:
+            print(" WARNING :: Column %s present in both the micrographs table and coordinate files, using the coordinate file values" % column)
+        else:
+            kept_columns.append(column)
+    kept_indices = [ mic_columns[column] - 1 for column in kept_columns ]
+
+    mic_rows = dict()
+    for row in star_handler.iter_star_rows(file, mic_data_start):
+        mic_rows[micrograph_key(row[mic_name_index])] = "\t".join([ row[i] for i in kept_indices ])
+
+    print("   >> %s optics groups, %s micrographs" % (len(optics_rows), len(mic_rows)))
+
+    return sorted(optics_columns, key = optics_columns.get), optics_rows, kept_columns, mic_rows
+
+def find_curated_files(input_dir):
+    """ RETURNS
+            curated_files = { 'mic_key' : 'path/to/mic_key_CURATED.star', ... }
+    """
+    curated_files = dict()
+    suffix = '_CURATED.star'
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(suffix) and entry.is_file():
+                curated_files[entry.name[:-len(suffix)]] = entry.path
+    print(" %s '%s' files found in %s" % (len(curated_files), suffix, input_dir))
+    return curated_files
+
+def read_curated_particles(task):
+    """ Worker function: read one '_CURATED.star' file and format its particles as lines of the output particles table.
+        Values are copied as text to avoid any loss from float conversion.
+        PARAMETERS
+            task = tuple( 'path/to/file_CURATED.star', str('tab-joined micrograph table entries') )
+        RETURNS
+            tuple( str(lines of the particle table), int(number of particles) )
+    """
+    curated_file, mic_row = task
+    columns, data_start = star_handler.get_star_columns(curated_file, 'data_')
+    try:
+        x_index = columns['_rlnCoordinateX'] - 1
+        y_index = columns['_rlnCoordinateY'] - 1
+    except KeyError:
+        print(" WARNING :: %s has no coordinate columns, skipping" % curated_file)
+        return "", 0
+    psi_index = columns.get('_rlnAnglePsi', 0) - 1
+    fom_index = columns.get('_rlnAutopickFigureOfMerit', 0) - 1
+
+    lines = []
+    for row in star_handler.iter_star_rows(curated_file, data_start):
+        psi = row[psi_index] if psi_index >= 0 else '-999.0'
+        fom = row[fom_index] if fom_index >= 0 else '-999.0'
+        lines.append("%s\t%s\t%s\t%s\t%s\n" % (row[x_index], row[y_index], psi, fom, mic_row))
+    return "".join(lines), len(lines)
+
+def write_table_header(f, table_title, columns):
+    f.write("\n")
+    f.write("# version 30001\n")
+    f.write("\n")
+    f.write("%s\n" % table_title)
+    f.write("\n")
+    f.write("loop_\n")
+    for i in range(len(columns)):
+        f.write("%s #%s\n" % (columns[i], i + 1))
+
+def write_particles_star(output_file, optics_columns, optics_rows, mic_columns, tasks, jobs, batch_size = 256):
+    """ Stream the optics table and all particles into the output file. Tasks are handed to the process pool in
+        fixed-size batches so that at most one batch of parsed coordinate files is held in memory at a time.
+    """
+    print(" >>> WRITING %s" % output_file)
+
+    total_particles = 0
+    total_micrographs = 0
+    with open(output_file, 'w') as f :
+        write_table_header(f, 'data_optics', optics_columns)
+        for row in optics_rows:
+            f.write("%s\n" % "\t".join(row))
+        f.write("\n")
+
+        write_table_header(f, 'data_particles', PARTICLE_COLUMNS + mic_columns)
+
+        with multiprocessing.Pool(jobs) as pool:
+            for batch_start in range(0, len(tasks), batch_size * jobs):
+                batch = tasks[batch_start : batch_start + batch_size * jobs]
+                for lines, n in pool.imap(read_curated_particles, batch, chunksize = batch_size):
+                    f.write(lines)
+                    total_particles += n
+                    total_micrographs += 1
+                print("   ... %s / %s micrographs, %s particles" % (total_micrographs, len(tasks), total_particles), end = '\r')
+        f.write("\n")
+
+    print()
+    return total_micrographs, total_particles
+
+#############################
+###     RUN BLOCK
+#############################
+
+if __name__ == "__main__":
+    PARAMS = parse_cmdline(sys.argv)
+
+    print("... Running job")
+    print("========================")
+    start_time = time.time()
+
+    optics_columns, optics_rows, mic_columns, mic_rows = parse_ctf_star(PARAMS['ctf_star'])
+    marked = parse_marked_files(PARAMS['marked_files'])
+    curated_files = find_curated_files(PARAMS['input_dir'])
+
+    ## hash-join the coordinate files against the micrographs table
+    tasks = []
+    skipped_marked = 0
+    missing_ctf = 0
+    for mic_key in sorted(curated_files):
+        if mic_key in marked:
+            skipped_marked += 1
+            continue
+        if mic_key not in mic_rows:
+            missing_ctf += 1
+            continue
+        tasks.append((curated_files[mic_key], mic_rows[mic_key]))
+
+    print(" %s micrographs to export (%s marked & skipped, %s not found in %s)" % (len(tasks), skipped_marked, missing_ctf, PARAMS['ctf_star']))
+
+    total_micrographs, total_particles = write_particles_star(PARAMS['output_file'], optics_columns, optics_rows, mic_columns, tasks, PARAMS['jobs'])
+
+    print("========================")
+    print(" Wrote %s particles from %s micrographs into: %s (%.1f s)" % (total_particles, total_micrographs, PARAMS['output_file'], time.time() - start_time))
+    print("... job completed.")
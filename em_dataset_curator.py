@@ -13,7 +13,6 @@ To Do:
     - Add contrast from picks
     - Add the ability to hold Ctrl + arrow keys to shift the jpg coordinates by a few pixels in the corresponding direction?
     - For autopicking, add a way to generate a not-too-soft gaussian disk
-    - For templat picking add a min and max average range of signal expected? ie how to avoid picking on ice/carbon?
     - Add a toggle to use the threshold slider
     - Add a button to drop points below threshold (not displayed) ... might make obsolete the autopicker? 
     - Let the user define the display to show squares or circles and the stroke?
@@ -21,6 +20,12 @@ To Do:
 """ 
 
 DEBUG = True
+## autopick peaks are found (and cached) down to this score, so a higher picking threshold only needs to re-filter them
+AUTOPICK_CACHE_THRESHOLD = 0.0
+## number of autopick results (correlation map & peaks) kept in memory, see: MainUI.template_picker
+AUTOPICK_CACHE_SIZE = 4
+## number of carbon/ice exclusion masks kept in memory (small, so images visited again reuse them), see: MainUI.get_exclusion_mask
+EXCLUSION_MASK_CACHE_SIZE = 32
 
 #region :: Utilities 
 
@@ -36,10 +41,10 @@ def read_coords_from_star(starfile, scale_factor):
     ```
     ### RETURNS:
     ```
-        image_coordinates = {   (jpg_x1, jpg_y1, score1)  : (star_x1, star_y1, score1),
-                                (jpg_x2, jpg_y2, score2)  : (star_x2, star_y2, score2),
+        image_coordinates = {   (jpg_x1, jpg_y1, score1)  : (star_x1, star_y1, score1, psi1),
+                                (jpg_x2, jpg_y2, score2)  : (star_x2, star_y2, score2, psi2),
                                 ...,
-                                (jpg_xn, jpg_yn, score_n) : (star_xn, star_yn, score_n) }
+                                (jpg_xn, jpg_yn, score_n) : (star_xn, star_yn, score_n, psi_n) }
     ```
     ### EXAMPLES:
     ```
@@ -52,6 +57,7 @@ def read_coords_from_star(starfile, scale_factor):
     star_X_coord_column = star_handler.find_star_column(starfile, "_rlnCoordinateX", HEADER_START, DATA_START - 1)
     star_Y_coord_column = star_handler.find_star_column(starfile, "_rlnCoordinateY", HEADER_START, DATA_START - 1)
     star_score_column = star_handler.find_star_column(starfile, "_rlnAutopickFigureOfMerit", HEADER_START, DATA_START - 1)
+    star_psi_column = star_handler.find_star_column(starfile, "_rlnAnglePsi", HEADER_START, DATA_START - 1)
 
     with open(starfile, 'r') as f:
         counter = 0
@@ -74,7 +80,11 @@ def read_coords_from_star(starfile, scale_factor):
                 continue
 
             counter += 1
-            star_coord = (int(float(star_X_coord)), int(float(star_Y_coord)), float(star_score))
+            ## keep the psi angle (e.g. from template bank autopicking) so it is written back out on saving
+            star_psi = star_handler.get_star_data(line, star_psi_column) if star_psi_column is not None else False
+            star_psi = float(star_psi) if star_psi else -999.0
+
+            star_coord = (int(float(star_X_coord)), int(float(star_Y_coord)), float(star_score), star_psi)
             img_coord = star2jpg(star_coord, scale_factor)
 
             image_coordinates[ img_coord ] = star_coord # data are linked in this way to avoid transformation data loss
@@ -83,6 +93,27 @@ def read_coords_from_star(starfile, scale_factor):
     
     return image_coordinates
 
+def read_coords_from_rows(star_coordinates, scale_factor):
+    """ 
+    Remap coordinates in .STAR space (e.g. as stored in a session database) onto the display image, in the same
+    way as read_coords_from_star.
+    ### PARAMETERS:
+    ```
+        star_coordinates = list( tuple(x, y, selection_type, psi, score), ... )
+        scale_factor = float() # the scale factor to apply between the .jpg and raw .mrc file 
+    ```
+    ### RETURNS:
+    ```
+        image_coordinates = { (jpg_x1, jpg_y1, score1) : (star_x1, star_y1, score1, psi1), ... }
+    ```
+    """
+    image_coordinates = dict()
+    for x, y, selection_type, psi, score in star_coordinates:
+        star_coord = (int(x), int(y), max(float(score), 0), float(psi))
+        image_coordinates[ star2jpg(star_coord, scale_factor) ] = star_coord
+    print(">> %s particles read from session" % len(image_coordinates))
+    return image_coordinates
+
 def get_scale_factor(mrc_dimensions, img_dimensions):
     """ 
     For a given set of image & mrc dimensions, determine the scaling factor between them, (i.e. how
@@ -179,39 +210,73 @@ def suggest_target_angpix(particle_diameter, CNN_architecture = 'resnet8'):
     
     return target_angpix
 
-def load_topaz_csv(fname, DEBUG = True):
+def load_topaz_csv(fname, chunksize = None, DEBUG = True):
     """
         Parse a csv particles file into a fixed data structure:
             {
-                'img_name' : [ (x, y, score), (x2, y2, score), ... ]
+                'img_name' : np.array([ [x, y, score], [x2, y2, score], ... ]),
             }
+        Each entry is a view into a single (n, 3) float32 array sorted by image, so rows iterate as (x, y, score).
+        For very large files, set chunksize (# of lines) to parse the file in pieces; only the compact numeric
+        columns are kept between chunks, so the full table is never held in memory as a DataFrame.
     """
+    columns = ['image_name', 'x_coord', 'y_coord', 'score']
+    dtypes = {'image_name' : str, 'x_coord' : np.float32, 'y_coord' : np.float32, 'score' : np.float32}
 
-    ## initialize an empty dictionary 
-    particle_data = {}
     ## extract file information from selection
     file_path = str(fname)
 
-    ## load particle data as a pandas DataFrame object for easy manipulation
-    csv_data = pd.read_csv(file_path, sep="\t", header=0)
-
-    ## reorganize the DataFrame by the image name
-    csv_data = csv_data.groupby('image_name')
+    ## load only the needed columns, either in one go or chunk by chunk
+    if chunksize is None:
+        chunks = [ pd.read_csv(file_path, sep="\t", header=0, usecols=columns, dtype=dtypes) ]
+    else:
+        chunks = pd.read_csv(file_path, sep="\t", header=0, usecols=columns, dtype=dtypes, chunksize=chunksize)
+
+    ## map image names onto integer codes that are consistent across chunks
+    image_names = []
+    image_codes = {}
+    code_arrays = []
+    value_arrays = []
+    for chunk in chunks:
+        chunk_codes, chunk_names = pd.factorize(chunk['image_name'], sort = False)
+        remap = np.empty(len(chunk_names), dtype = np.int64)
+        for i, img in enumerate(chunk_names):
+            if img not in image_codes:
+                image_codes[img] = len(image_names)
+                image_names.append(img)
+            remap[i] = image_codes[img]
+        ## rows without an image name are given code -1 by factorize, drop them
+        has_name = chunk_codes >= 0
+        code_arrays.append(remap[chunk_codes[has_name]])
+        value_arrays.append(chunk[['x_coord', 'y_coord', 'score']].to_numpy(dtype = np.float32)[has_name])
+
+    if len(code_arrays) > 0:
+        codes = np.concatenate(code_arrays)
+        values = np.concatenate(value_arrays)
+    else:
+        codes = np.empty(0, dtype = np.int64)
+        values = np.empty((0, 3), dtype = np.float32)
+
+    ## renumber the codes so they follow the alphabetical order of the image names
+    name_order = np.argsort(np.array(image_names, dtype = object)).astype(np.int64)
+    name_rank = np.empty(len(image_names), dtype = np.int64)
+    name_rank[name_order] = np.arange(len(image_names))
+    codes = name_rank[codes]
+    image_names = [image_names[i] for i in name_order]
+
+    ## sort once by image (stable, so particles keep their order in the file) and split into per-image views
+    order = np.argsort(codes, kind = 'stable')
+    codes = codes[order]
+    values = values[order]
+    unique_codes, start_indices = np.unique(codes, return_index = True)
+    end_indices = np.append(start_indices[1:], len(codes))
 
-    total_micrographs = 0
-    total_particles = 0
-    for img, particles in csv_data:
-        total_micrographs += 1
-        ## add a new entry to the dictionary 
-        particle_data[img] = []
+    particle_data = {}
+    for code, i0, i1 in zip(unique_codes, start_indices, end_indices):
+        particle_data[image_names[code]] = values[i0:i1]
 
-        ## add particles to the new entry list 
-        for row_index, row in particles.iterrows():
-            total_particles += 1
-            x = row['x_coord']
-            y = row['y_coord']
-            s = row['score']
-            particle_data[img].append((x, y, s))
+    total_micrographs = len(particle_data)
+    total_particles = len(values)
 
     if DEBUG:
         print("=======================================")
@@ -317,7 +382,7 @@ def resize_image(img_nparray, scaling_factor):
 def get_PhotoImage_obj(img_nparray):
     """ Convert an input numpy array grayscale image and return an ImageTk.PhotoImage object
     """
-    PIL_img = PIL_Image.fromarray(img_nparray.astype(np.uint8))  #.convert('L')
+    PIL_img = PIL_Image.fromarray(img_nparray.astype(np.uint8, copy = False))  #.convert('L')
 
     img_obj = ImageTk.PhotoImage(PIL_img)
     return img_obj
@@ -359,37 +424,214 @@ def mrc2grayscale(mrc_raw_data, pixel_size):
 
     return remapped
 
-def sigma_contrast(im_array, sigma):
-    """ Rescale the image intensity levels to a range defined by a sigma value (the # of
-        standard deviations to keep). Can perform better than auto_contrast when there is
-        a lot of dark pixels throwing off the level balancing.
+class BackgroundWriter:
+    """ 
+    A single background thread that writes text files (.STAR files, marked lists, settings) off the Tk main thread.
+    Files are written in the order they were submitted; if a file is submitted again while still waiting to be 
+    written, only its latest content is kept (in its original place in the queue). Each file is written to a 
+    temporary file first and then moved into place, so a file is never left half-written.
+    ### USAGE:
+    ```
+        writer = BackgroundWriter()
+        writer.submit('marked_imgs.txt', "img1.jpg\nimg2.jpg\n")
+        writer.flush() # block until all submitted files are on disk
+        writer.close()
+    ```
+    Errors are collected on the `errors` queue as tuples of (path, exception) for the GUI to report.
     """
-    import numpy as np
-    stdev = np.std(im_array)
-    mean = np.mean(im_array)
-    minval = mean - (stdev * sigma)
-    maxval = mean + (stdev * sigma)
+    def __init__(self):
+        self.pending = OrderedDict() # { path : content }
+        self.active_path = None # path currently being written by the thread
+        self.errors = queue.Queue()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target = self._run, name = 'BackgroundWriter', daemon = True)
+        self.thread.start()
+        return
 
-    if minval < 0: 
-        minval = 0
-    if maxval > 255:
-        maxval = 255
+    def submit(self, path, content):
+        with self.condition:
+            self.pending[path] = content
+            self.condition.notify_all()
+        return
 
-    if DEBUG:
-        print(" sigma_contrast (s = %s)" % sigma)
+    def flush(self, path = None, timeout = None):
+        """ Block until the given path (or all paths, if None) has been written. Returns False on a timeout.
+        """
+        with self.condition:
+            if path is None:
+                is_waiting = lambda: len(self.pending) > 0 or self.active_path is not None
+            else:
+                is_waiting = lambda: path in self.pending or self.active_path == path
+            return self.condition.wait_for(lambda: not is_waiting(), timeout = timeout)
 
-    ## remove pixels above/below the defined limits
-    im_array = np.clip(im_array, minval, maxval)
-    ## rescale the image into the range 0 - 255
-    im_array = ((im_array - minval) / (maxval - minval)) * 255
+    def close(self):
+        """ Write out anything still pending and stop the thread
+        """
+        self.flush()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        return
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pending) > 0 or not self.running)
+                if len(self.pending) == 0:
+                    return
+                path, content = self.pending.popitem(last = False)
+                self.active_path = path
+            temp_path = path + '.tmp'
+            try:
+                with open(temp_path, 'w') as f :
+                    f.write(content)
+                os.replace(temp_path, path)
+            except Exception as e:
+                ## do not leave a partly written file behind
+                try:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                except OSError:
+                    pass
+                self.errors.put((path, e))
+            with self.condition:
+                self.active_path = None
+                self.condition.notify_all()
+
+
+class JobCancelled(Exception):
+    """ Raised inside a BackgroundJob target when its cancel event has been set
+    """
+    pass
+
+class BackgroundJob:
+    """ Run a long calculation (e.g. template matching) on a worker thread so the GUI stays responsive.
+        The target is called as target(*args, cancel = threading.Event(), progress = function(str)), and should
+        check the cancel event between steps (raising JobCancelled). Messages are collected from the main thread
+        by polling (i.e. via tk.after()), as tkinter widgets must not be touched from other threads:
+            ('progress', str), ('done', result), ('cancelled', None), ('error', str)
+    """
+    def __init__(self, name, target, args = (), image_name = None):
+        self.name = name
+        self.image_name = image_name
+        self.start_time = time.time()
+        self.cancel_event = threading.Event()
+        self.messages = queue.Queue()
+        self.thread = threading.Thread(target = self._run, args = (target, args), daemon = True)
+        self.thread.start()
+        return
+
+    def progress(self, text):
+        self.messages.put(('progress', text))
+        return
+
+    def cancel(self):
+        self.cancel_event.set()
+        return
+
+    def poll(self):
+        """ RETURNS all messages received since the last call
+        """
+        messages = []
+        while not self.messages.empty():
+            messages.append(self.messages.get())
+        return messages
 
-    return im_array.astype('uint8')
+    def _run(self, target, args):
+        try:
+            result = target(*args, cancel = self.cancel_event, progress = self.progress)
+            if self.cancel_event.is_set():
+                raise JobCancelled()
+            self.messages.put(('done', result))
+        except JobCancelled:
+            self.messages.put(('cancelled', None))
+        except Exception as error:
+            self.messages.put(('error', "%s: %s" % (type(error).__name__, error)))
+        return
+
+def array_digest(im_array):
+    """ Short hash of the contents, shape & type of an array (e.g. to tell if the displayed image or template has changed)
+    """
+    import hashlib
+    im_array = np.ascontiguousarray(im_array)
+    digest = hashlib.blake2b(im_array.tobytes(), digest_size = 16)
+    digest.update(("%s %s" % (im_array.shape, im_array.dtype)).encode())
+    return digest.hexdigest()
+
+def autopick_worker(im_array, template, picking_threshold, rotations, exclude, cancel, progress):
+    """ BackgroundJob target for template picking on a display image
+        PARAMETERS
+            exclude = np array of bool or None; low resolution mask of regions not to pick in (see: image_handler.exclusion_mask)
+        RETURNS
+            res = np array; the correlation map (best score over all rotations)
+            loc = list( (x, y, score), ... ); picks in display pixels, in order of decreasing score
+            psi = list( float(), ... ); in-plane angle of the best matching rotation of each pick (-999.0 if not rotated)
+    """
+    if rotations > 1:
+        angles = [ i * 360 / rotations for i in range(rotations) ]
+        res, bank_loc = image_handler.template_bank_picks(im_array, [ template ], angles, picking_threshold, exclude = exclude, cancel = cancel, progress = progress, DEBUG = DEBUG)
+        if cancel.is_set():
+            raise JobCancelled()
+        loc = [ (x, y, score) for x, y, score, template_index, angle in bank_loc ]
+        psi = [ angle for x, y, score, template_index, angle in bank_loc ]
+    else:
+        progress("matching template")
+        res, loc = image_handler.template_match(im_array, template, picking_threshold, exclude = exclude)
+        psi = [ -999.0 ] * len(loc)
+    progress("%s picks found" % len(loc))
+    return res, loc, psi
+
+def average_picks_template(im_array, box_size, coordinates, cancel, progress):
+    """ BackgroundJob target to average the boxes around picked coordinates into a template (0 - 255)
+    """
+    ## sum the boxes in chunks rather than stacking them, so any number of picks can be averaged
+    merged, n_boxes = image_handler.sum_boxes(im_array, box_size, coordinates, DEBUG = DEBUG)
+    if cancel.is_set():
+        raise JobCancelled()
+    if n_boxes == 0:
+        raise ValueError("no picks are far enough from the image edge to extract a box")
+
+    # Normalised [0,255] as integer: don't forget the parenthesis before astype(int)
+    normalized_template = (255*(merged - np.min(merged))/np.ptp(merged)).astype(int)
+    return normalized_template
+
+def score_histogram_worker(working_dir, image_names, stamps, cancel, progress):
+    """ BackgroundJob target to read the pick scores of every image whose coordinate .STAR file changed since it was added
+        to the dataset score histogram. The .STAR file of an image is found as in MainUI.load_img ('_CURATED.star' first).
+        PARAMETERS
+            stamps = dict(); { image name : modification time of the .STAR file its scores were read from }
+        RETURNS
+            updates = dict(); { image name : tuple(stamp, np array of scores) } for images to (re-)add to the histogram
+            no_source = list( str(), ... ); images without a .STAR file
+    """
+    star_files = set(fname for fname in os.listdir(working_dir) if fname.endswith('.star'))
+    updates = dict()
+    no_source = []
+    for i, image_name in enumerate(image_names):
+        if cancel.is_set():
+            raise JobCancelled()
+        if i % 100 == 0:
+            progress("reading scores (%s / %s images)" % (i, len(image_names)))
+        img_basename = os.path.splitext(image_name)[0]
+        for suffix in ['_CURATED.star', '.star', '_manualpick.star']:
+            if img_basename + suffix in star_files:
+                star_file = os.path.join(working_dir, img_basename + suffix)
+                break
+        else:
+            no_source.append(image_name)
+            continue
+        stamp = os.path.getmtime(star_file)
+        if stamps.get(image_name) != stamp:
+            updates[image_name] = (stamp, score_histogram.read_star_scores(star_file))
+    return updates, no_source
 
 #endregion 
 
 #region :: GUIs
 class MainUI:
-    def __init__(self, instance, start_index, particle_data = dict()):
+    def __init__(self, instance, start_index, particle_data = dict(), session = None):
         self.instance = instance
         instance.title("Tk-based EM image curator")
         # instance.geometry("520x500")
@@ -408,13 +650,17 @@ class MainUI:
         self.image_name = str()
         self.scale_factor = 0.67 ## scaling factor for displayed image
         self.sigma_contrast = 3
+        self.local_contrast_method = 'downsample' ## 'rank' (exact, slow), 'downsample' or 'clahe', see: image_handler.local_contrast
+        self.display_pipeline = image_handler.Pipeline(DEBUG = DEBUG) ## processing of the displayed image, reuses its work buffers for every image of the same size
         self.SHOW_PICKS = tk.BooleanVar(instance, True)
         self.picks_diameter = 150 ## Angstroms, `picks' are clicked particles by the user
         self.picks_color = 'red'
         self.picks_threshold = 0
         self.threshold_min = -1
         self.threshold_max = 1
+        self.threshold_mode = tk.StringVar(instance, 'image') ## threshold slider spans the scores of the displayed 'image', or of the dataset by 'score' or 'percentile'
         self.coordinates = particle_data # dict() ## list of picked points
+        self.picks_psi = dict() ## { (jpg_x, jpg_y, score) : psi } for autopicked 'new_point' coordinates with a known in-plane angle
         self.marked_imgs = []
         self.index = start_index ## 0 ## index of the list of known mrc files int he directory to view
         self.working_dir = "."
@@ -423,6 +669,35 @@ class MainUI:
         self.particles_file_save_name = 'particles.txt'
         self.IS_FILAMENTS = tk.BooleanVar(instance, False)
         self.FLIPY = tk.BooleanVar(instance, False)
+        self.USE_EXCLUSION_MASK = tk.BooleanVar(instance, False) # option to keep autopicking out of carbon/ice regions, see: get_exclusion_mask
+        self.exclusion_sigma = image_handler.EXCLUSION_SIGMA
+        self.exclusion_mask_cache = OrderedDict() ## { (image_name, source image digest, particle px, sigma) : np array of bool }
+        self.display_im_source = None ## the display image as loaded, before any processing (local contrast, blur, ...)
+        self.writer = BackgroundWriter() ## writes star files, marked lists & settings off the main thread
+        self.saved_marked_imgs = None ## marked images as last written to file, used to report changes on saving
+        self.session = session ## optional session_store.SessionStore, replaces per-image .STAR files, marked_imgs.txt & settings file
+        self.autopick_job = None ## BackgroundJob running template matching for the current image, see: start_autopick_job
+        self.autopick_job_callback = None
+        self.autopick_cache = OrderedDict() ## { (image_name, image digest, template digest, rotations, mask digest) : dict(res, loc, psi, floor) }, see: template_picker
+        self.autopick_active_key = None ## cache key of the autopick result currently shown on the image, re-filtered by the Autopick panel slider
+        self.autopick_keys = set() ## coordinates added from the active autopick result
+        self.autopick_rejected = set() ## coordinates of the active autopick result erased by the user, never re-added on re-filtering
+        self.candidate_store = None ## all autopick candidates of the dataset down to their floor score, opened on the first autopick (see: store_autopick_candidates)
+        ## scores of the picks of every image in the dataset, for the dataset-wide threshold slider modes (see: start_score_histogram_scan)
+        self.dataset_particle_data = particle_data ## picks from a topaz particles file, { img_name : np array [ [x, y, score], ... ] }
+        if session is not None:
+            ## rebuilt from the session database on every launch
+            self.score_histogram = score_histogram.ScoreHistogram(None, DEBUG = False)
+        else:
+            self.score_histogram = score_histogram.ScoreHistogram(os.path.join(self.working_dir, score_histogram.DEFAULT_HISTOGRAM_FILE), DEBUG = False)
+        self.score_histogram_job = None
+        self.score_histogram_saved = set() ## images saved while a score histogram scan is running, whose scores the scan must not overwrite
+        ## optional dataset-level template, updated with the picks of every saved image once started (see: make_dataset_template)
+        self.template_accumulator = None
+        self.template_accumulator_cache = None ## (key, (image array, pixel size)) of the image last boxed out from for the dataset template
+        accumulator_file = os.path.join(self.working_dir, template_accumulator.DEFAULT_ACCUMULATOR_FILE)
+        if os.path.exists(accumulator_file):
+            self.template_accumulator = template_accumulator.TemplateAccumulator(accumulator_file, DEBUG = DEBUG)
 
         #endregion
 
@@ -508,12 +783,18 @@ class MainUI:
 
         self.threshold_LABEL = tk.Label(instance, font=("Helvetica", right_side_panel_fontsize), text="Threshold: %s" % self.picks_threshold)
         self.threshold_SLIDER = tk.Scale(instance, font=("Helvetica", right_side_panel_fontsize), from_=0, to=100, resolution=0.1, showvalue =0, tickinterval=0, orient=tk.HORIZONTAL, sliderlength = 20, length = 105, width = 10, command=self.on_slider_change)
+        self.threshold_mode_MENU = tk.OptionMenu(instance, self.threshold_mode, 'image', 'score', 'percentile', command=self.on_threshold_mode_change)
+        self.threshold_mode_MENU.config(font=("Helvetica", right_side_panel_fontsize))
         self.threshold_LABEL.grid(row = 20, column = 1, sticky = (tk.S)) #, tk.CENTER))
+        self.threshold_mode_MENU.grid(row = 20, column = 2, sticky = (tk.S, tk.W))
         self.threshold_SLIDER.grid(row = 21, column = 1,  columnspan = 2) #, sticky = (tk.N, tk.E))
 
         self.apply_threshold_BUTTON = tk.Button(instance, text="Apply", font = ('Helvetica', '8'), command = lambda: self.apply_threshold(), width=7)
         self.apply_threshold_BUTTON.grid(row = 22, column = 1, columnspan = 2)
 
+        self.threshold_retained_LABEL = tk.Label(instance, font=("Helvetica", right_side_panel_fontsize), text="Dataset: --")
+        self.threshold_retained_LABEL.grid(row = 23, column = 1, columnspan = 2, sticky = (tk.N))
+
         #endregion 
 
         #endregion
@@ -530,6 +811,9 @@ class MainUI:
         ## LOAD AN INITIAL MRC FILE
         self.next_img('none')
 
+        ## bring the dataset score histogram up to date with the coordinate files in the background
+        self.start_score_histogram_scan()
+
         ## SET THE SIZE OF THE PROGRAM WINDOW BASED ON THE SIZE OF THE DATA FRAME AND THE SCREEN RESOLUTION
         self.resize_program_to_fit_screen_or_data()
 
@@ -598,9 +882,22 @@ class MainUI:
         #endregion
         ####################################
 
+        ## periodically check if the background writer reported any problems
+        self.check_writer_errors()
+
         self.usage()
         return
 
+    def check_writer_errors(self):
+        """ Poll the background writer for failed writes and report them to the user
+        """
+        while not self.writer.errors.empty():
+            path, error = self.writer.errors.get()
+            print(" !! ERROR :: Could not write file '%s': %s" % (path, error))
+            showerror("Write error", "Failed to write file\n'%s'\n\n%s" % (path, error))
+        self.instance.after(500, self.check_writer_errors)
+        return
+
     def apply_threshold(self):
         print("Drop points below threshold: ")
 
@@ -631,6 +928,10 @@ class MainUI:
             else:
                 ## reset the list for the particle data under this image name
                 self.coordinates = dict() 
+                self.picks_psi = dict()
+                ## cleared autopicks are gone for good, rather than erased picks to be kept out of a re-filter
+                self.autopick_active_key = None
+                self.autopick_keys = set()
                 self.draw_image_coordinates()
    
         return 
@@ -642,16 +943,17 @@ class MainUI:
             return
         elif panelType == "AutopickPanel":
             if self.autopickPanel_instance is None:
-                self.autopickPanel = AutopickPanel(self)
+                self.autopickPanel_instance = AutopickPanel(self)
             else:
                 print(" AutopickPanel is already open: ", self.autopickPanel_instance)
         else:
             return
         return
 
-    def make_template_from_picks(self):
+    def make_template_from_picks(self, on_done):
         """
-            Experimental function to see if I can generate a crude template to help speed up manual picking 
+            Experimental function to see if I can generate a crude template to help speed up manual picking.
+            The boxes are averaged on a worker thread, on_done(template) is called on the main thread when finished
         """
         ## get all the picks so far and add them together before re-normalizing
         current_display_img = self.display_im_arrays[0]
@@ -667,88 +969,255 @@ class MainUI:
         rescaled_coordinates = []
         for Xcoord, Ycoord, score in self.coordinates:
             rescaled_coordinates.append((int(Xcoord * self.scale_factor), int(Ycoord * self.scale_factor)))
-        particle_imgs = image_handler.extract_boxes(current_display_img, rescaled_box_size, rescaled_coordinates, DEBUG = DEBUG)
-
-        # print(" input to np sum == ", particle_imgs)
-        # merged = np.sum(particle_imgs)
-        merged = np.sum(np.stack(particle_imgs), axis =0)
-
-        # Normalised [0,255] as integer: don't forget the parenthesis before astype(int)
-        normalized_template = (255*(merged - np.min(merged))/np.ptp(merged)).astype(int)
-        # import matplotlib.pyplot as plt
-        # plt.figure()
-        # plt.imshow(normalized_template, cmap='gray', vmin=0, vmax=255) 
-        # plt.show()
-        # print(" norm_template shape = ", normalized_template.shape)  
-        return normalized_template
+
+        self.start_autopick_job("Template from %s picks" % len(rescaled_coordinates), average_picks_template, (current_display_img, rescaled_box_size, rescaled_coordinates), on_done)
+        return
     
-    def template_picker(self, template, picking_threshold = 0.3):
+    def make_dataset_template(self):
+        """
+            Start (or bring up to date) the dataset-level template with the picks on the current image. Once started, the picks of
+            every image are added as it is saved, so the template improves as curation proceeds (and is kept on disk between sessions).
+            RETURNS the template at the pixel size of the displayed image, or None if no boxes have been accumulated
+        """
+        display_angpix = get_scale_factor(self.mrc_dimensions, self.jpg_dimensions) * self.pixel_size / self.scale_factor
+        if self.template_accumulator is None:
+            ## the box size & pixel size are fixed from here on, so boxes from all images can be added together
+            rescaled_box_size = int(self.picks_diameter * 1.4  / display_angpix) # add some padding around the particle
+            accumulator_file = os.path.join(self.working_dir, template_accumulator.DEFAULT_ACCUMULATOR_FILE)
+            self.template_accumulator = template_accumulator.TemplateAccumulator(accumulator_file, rescaled_box_size, display_angpix, DEBUG = DEBUG)
+        self.update_template_accumulator()
+        self.set_autopick_status("Dataset template: %s boxes from %s images" % (self.template_accumulator.n, len(self.template_accumulator.contributions)))
+        return self.template_accumulator.template(display_angpix)
+
+    def update_template_accumulator(self):
+        """ Bring the dataset template up to date with the picks on the current image (if a dataset template is in use)
         """
-            Use an input template to pick on the displayed image 
+        if self.template_accumulator is None or len(self.display_im_arrays) == 0 or not isinstance(self.display_im_arrays[0], np.ndarray):
+            return
+        source_array, source_angpix = self.template_accumulator_source()
+        ## picks are tracked in .jpg pixels, which do not change with the display scale
+        jpg_coordinates = [ (Xcoord, Ycoord) for Xcoord, Ycoord, score in self.coordinates ]
+        n_added, n_removed = self.template_accumulator.update_micrograph(self.image_name, source_array, source_angpix, jpg_coordinates)
+        if n_added > 0 or n_removed > 0:
+            self.template_accumulator.save()
+        return
+
+    def template_accumulator_source(self):
+        """ The image the dataset template boxes out picks from: the current image file as it is on disk (in grayscale, and flipped
+            as it is displayed), at the pixel size of the .jpg coordinates. Deleted picks are subtracted again by boxing them out of
+            this image, so it must not change with the display scale or any processing of the displayed image (blur, contrast, ...).
+            RETURNS
+                source_array = 2d np array, source_angpix = float(); the image & its pixel size (Ang/px)
+        """
+        key = (self.image_name, self.USE_MRC.get(), self.FLIPY.get(), self.mrc_dimensions, self.jpg_dimensions, self.pixel_size)
+        if self.template_accumulator_cache is not None and self.template_accumulator_cache[0] == key:
+            return self.template_accumulator_cache[1]
+
+        fname = os.path.join(self.working_dir, self.image_name)
+        if self.USE_MRC.get():
+            ## .mrc coordinates are in pixels of the .mrc file
+            source_array, source_angpix = get_mrc_raw_data(fname)
+        else:
+            with PIL_Image.open(fname) as im:
+                im = im.convert('L')
+                if self.FLIPY.get() == True:
+                    im = im.transpose(PIL_Image.FLIP_TOP_BOTTOM)
+                source_array = np.asarray(im)
+            source_angpix = get_scale_factor(self.mrc_dimensions, self.jpg_dimensions) * self.pixel_size
+        self.template_accumulator_cache = (key, (source_array, source_angpix))
+        return source_array, source_angpix
+
+    def template_picker(self, template, picking_threshold = 0.3, rotations = 1):
+        """
+            Use an input template to pick on the displayed image. Matching runs on a worker thread so the
+            window stays responsive. The correlation map & all peaks down to AUTOPICK_CACHE_THRESHOLD are cached per
+            (image, template, rotations), so picking again on the same image & template only re-filters the cached peaks.
             PARAMETERS
                 template = np.array (uint8, 0 - 255)
+                rotations = int(); number of in-plane rotations of the template to match, the best angle is kept as the psi of each pick
         """
-        
-        ## get all the picks so far and add them together before re-normalizing
-        current_display_img = self.display_im_arrays[0]
+        exclude = self.get_exclusion_mask() if self.USE_EXCLUSION_MASK.get() else None
+        ## the digest of the displayed image also covers any display processing (contrast, blur, scale)
+        key = (self.image_name, array_digest(self.display_im_arrays[0]), array_digest(template), rotations, None if exclude is None else array_digest(exclude))
+        if key in self.autopick_cache and self.autopick_cache[key]['floor'] <= picking_threshold:
+            self.autopick_cache.move_to_end(key)
+            print(" Autopick :: using cached peaks for %s" % self.image_name)
+            self.apply_autopick_threshold(key, picking_threshold)
+            return
 
-        res, loc = image_handler.template_match(current_display_img, template, picking_threshold) 
-        print(" residual img dimensions :: (x, y) color_range [a, b] -> (%s, %s)  [%s, %s]" % (res.shape[0], res.shape[1], np.min(res), np.max(res)))
+        floor = min(picking_threshold, AUTOPICK_CACHE_THRESHOLD)
+        ## take a copy of the displayed image, as the buffer is replaced if the image is reprocessed while the job runs
+        current_display_img = np.array(self.display_im_arrays[0], copy = True)
+        self.start_autopick_job("Autopick", autopick_worker, (current_display_img, template, floor, rotations, exclude), lambda result: self.cache_autopick_result(key, floor, result, picking_threshold))
+        return
 
-        # fig,ax=plt.subplots()
-        # im=ax.imshow(current_display_img, aspect='equal',interpolation=None)
-        # for pt in loc:
-        #     ax.add_patch(plt.Circle([pt[0],pt[1]], radius=0.5, edgecolor='r',lw=3, fill=False))
-        # cbar=plt.colorbar(im)
-        # plt.show()
+    def cache_autopick_result(self, key, floor, result, picking_threshold):
+        """ Store a finished autopick job in the cache (dropping the least recently used entry if full), then show its picks
+        """
+        res, loc, psi = result
+        self.autopick_cache[key] = dict(res = res, loc = loc, psi = psi, floor = floor)
+        self.autopick_cache.move_to_end(key)
+        while len(self.autopick_cache) > AUTOPICK_CACHE_SIZE:
+            self.autopick_cache.popitem(last = False)
+        try:
+            self.store_autopick_candidates(loc, psi, floor)
+        except Exception as e:
+            print(" WARNING :: could not store autopick candidates (%s)" % e)
+        self.apply_autopick_threshold(key, picking_threshold)
+        return
 
+    def store_autopick_candidates(self, loc, psi, floor):
+        """ Keep every autopick peak of the current image (down to the floor score) in the dataset candidate store, in .MRC
+            pixels, so the whole dataset can be re-thresholded later without picking again (see: candidate_store.py)
+        """
+        if self.candidate_store is None:
+            self.candidate_store = candidate_store.CandidateStore(os.path.join(self.working_dir, candidate_store.DEFAULT_CANDIDATE_DIR), DEBUG = DEBUG)
+        mrc_scale = get_scale_factor(self.mrc_dimensions, self.jpg_dimensions)
+        candidates = []
+        for (x, y, score), angle in zip(loc, psi):
+            ## display px -> .jpg px (as add_coordinate) -> .MRC px (as jpg2star)
+            mrc_x, mrc_y, score = jpg2star((int(x / self.scale_factor), int(y / self.scale_factor), score), mrc_scale)
+            candidates.append((mrc_x, mrc_y, score, angle))
+        self.candidate_store.add_micrograph(self.image_name, candidates, floor)
+        return
 
-        # ## add the picks to the current coordinate list, avoiding any that are clashing with current picks 
-        # for Xcoord, Ycoord, score in loc:
-        #     if self.is_clashing((Xcoord, Ycoord), REMOVE = False): 
-        #         pass
-        #     else:
-        #         self.add_coordinate(Xcoord, Ycoord, score)
-        
-        ## For performance probably want to run the check with fewer calculations per cycle, so pre-calculate the halfbox size, then for each point run a range intersection check for X, if it passes then Y, then if it does not intersect with both add the coordinate a a separate list we later call to add points (to avoid growth of the search set during loop, input coordinates are expected NOT to intersect!)
+    def apply_autopick_threshold(self, key, picking_threshold):
+        """ Show the cached picks of an autopick result above a threshold. If the result is the one already shown, its
+            previous picks are replaced (picks erased by the user stay erased); picks of any other result are kept as they are.
+        """
+        if key[0] != self.image_name or key not in self.autopick_cache:
+            return
+        cached = self.autopick_cache[key]
+
+        if key == self.autopick_active_key:
+            for coordinate in self.autopick_keys:
+                if coordinate in self.coordinates:
+                    del self.coordinates[coordinate]
+                    self.picks_psi.pop(coordinate, None)
+                else:
+                    self.autopick_rejected.add(coordinate)
+        else:
+            self.autopick_rejected = set()
+        self.autopick_active_key = key
+
+        ## peaks are sorted by decreasing score, so those above the threshold are a leading slice
+        n_above = 0
+        while n_above < len(cached['loc']) and cached['loc'][n_above][2] > picking_threshold:
+            n_above += 1
+        loc, psi = [], []
+        for p in range(n_above):
+            x, y, score = cached['loc'][p]
+            if (int(x / self.scale_factor), int(y / self.scale_factor), score) not in self.autopick_rejected:
+                loc.append(cached['loc'][p])
+                psi.append(cached['psi'][p])
+        self.autopick_keys = set(self.merge_template_picks((loc, psi)))
+        return
+
+    def refilter_autopick(self, picking_threshold):
+        """ Re-filter the picks of the autopick result shown on the current image at a new threshold (without recalculating)
+        """
+        if self.autopick_active_key is None:
+            return
+        self.apply_autopick_threshold(self.autopick_active_key, picking_threshold)
+        return
+
+    def merge_template_picks(self, result):
+        """ Add the picks from a finished autopick job to the coordinates of the current image, skipping any that clash with existing picks
+            PARAMETERS
+                result = tuple( list( (x, y, score), ... ), list( psi, ... ) ); picks in display pixels
+            RETURNS
+                added = list( (jpg_x, jpg_y, score), ... ); keys of the coordinates added
+        """
+        loc, psi = result
+        if len(loc) == 0:
+            print(" No picks found above threshold")
+            self.draw_image_coordinates()
+            return []
+
+        ## Picks clash with an existing coordinate if their particle boxes overlap, i.e. within a box width of each other along both axes
         display_angpix = get_scale_factor(self.mrc_dimensions, self.jpg_dimensions) * self.pixel_size / self.scale_factor
-        # display_angpix = self.pixel_size / self.scale_factor
         particle_width = self.picks_diameter / display_angpix
         particle_halfwidth = int(particle_width / 2)
-        picks_to_keep = []
-        for i in range(len(loc)):
-            ADD_POINT = True
-            x, y, score = loc[i]
-
-
-            if not len(self.coordinates) == 0:                
-                for px, py, pscore in self.coordinates:
-                    ## coordinates need to be rescaled to the viewing image scale 
-                    rescaled_x = int(px * self.scale_factor)
-                    rescaled_y = int(py * self.scale_factor)
-
-                    ## run the fast intersection algorithm for X, then Y
-                    if check_if_two_ranges_intersect(x - particle_halfwidth, x + particle_halfwidth, rescaled_x - particle_halfwidth, rescaled_x + particle_halfwidth):
-                        if check_if_two_ranges_intersect(y - particle_halfwidth, y + particle_halfwidth, rescaled_y - particle_halfwidth, rescaled_y + particle_halfwidth):
-                            ## if we pass both checks, we have a clash situation - abandon adding this point to the final roster without further checks 
-                            ADD_POINT = False
-            ## use the flag to decide whether we add the point 
-            if ADD_POINT:
-                picks_to_keep.append(i)
+        picks_to_keep = range(len(loc))
+        if not len(self.coordinates) == 0:
+            ## coordinates need to be rescaled to the viewing image scale 
+            rescaled = [ (int(px * self.scale_factor), int(py * self.scale_factor)) for px, py, pscore in self.coordinates ]
+            tree = cKDTree(rescaled)
+            clashes = tree.query_ball_point([ (x, y) for x, y, score in loc ], r = 2 * particle_halfwidth, p = np.inf)
+            picks_to_keep = [ i for i in range(len(loc)) if len(clashes[i]) == 0 ]
 
         ## add each point we wanted to keep to the final set of coordinates after fishing the looping functions 
+        added = []
         for p in picks_to_keep:
             x, y, score = loc[p]
             self.add_coordinate(x, y, score)
+            ## same key as add_coordinate
+            added.append((int(x / self.scale_factor), int(y / self.scale_factor), score))
+            if psi[p] != -999.0:
+                self.picks_psi[added[-1]] = psi[p]
 
         ## determine the minimum threshold score and set the slider there so we see all points added after running this command 
         lowest_score = min(loc, key=lambda p:p[2])[2]
         self.picks_threshold = lowest_score
-        self.threshold_LABEL['text'] = "Threshold: %0.2f" % lowest_score
+        self.update_threshold_labels()
 
         self.draw_image_coordinates()
+        return added
+
+    def start_autopick_job(self, name, target, args, on_done):
+        """ Run target(*args, cancel = threading.Event, progress = function) on a worker thread, cancelling any running job first.
+            on_done(result) is called on the main thread if the job finishes while the same image is still displayed.
+        """
+        self.cancel_autopick_job()
+        self.autopick_job = BackgroundJob(name, target, args, image_name = self.image_name)
+        self.autopick_job_callback = on_done
+        self.set_autopick_status("%s :: running on %s" % (name, self.image_name))
+        self.instance.after(100, self.poll_autopick_job, self.autopick_job)
+        return
+
+    def cancel_autopick_job(self):
+        if self.autopick_job is not None:
+            self.autopick_job.cancel()
+            self.set_autopick_status("%s :: cancelled" % self.autopick_job.name)
+            self.autopick_job = None
+        return
+
+    def poll_autopick_job(self, job):
+        """ Read messages from the worker thread of an autopick job, re-scheduling itself until the job ends
+        """
+        ## a cancelled or replaced job is dropped (its thread ends on its next cancel check)
+        if job is not self.autopick_job:
+            return
+        for message, value in job.poll():
+            if message == 'progress':
+                self.set_autopick_status("%s :: %s" % (job.name, value))
+            elif message == 'done':
+                self.autopick_job = None
+                ## results only belong to the image they were calculated on
+                if job.image_name != self.image_name:
+                    print(" Discarding results of '%s' for %s (now on %s)" % (job.name, job.image_name, self.image_name))
+                    return
+                self.set_autopick_status("%s :: done (%.1f s)" % (job.name, time.time() - job.start_time))
+                self.autopick_job_callback(value)
+                return
+            elif message == 'cancelled':
+                self.autopick_job = None
+                return
+            elif message == 'error':
+                self.autopick_job = None
+                self.set_autopick_status("%s :: failed" % job.name)
+                showerror("Autopick error", value)
+                return
+        self.instance.after(100, self.poll_autopick_job, job)
+        return
+
+    def set_autopick_status(self, text):
+        print(" %s" % text)
+        if self.autopickPanel_instance is not None:
+            self.autopickPanel_instance.status_label['text'] = text
         return
 
+
     def MouseWheelHandler(self, event):
         """ See: https://stackoverflow.com/questions/17355902/python-tkinter-binding-mousewheel-to-scrollbar
             Tie the mousewheel to the brush size, draw a green square to show the user the final setting
@@ -915,6 +1384,7 @@ class MainUI:
         canvas.delete('brush')
         # canvas.delete('marker')
         canvas.delete('particle_positions')
+        canvas.delete('exclusion_mask')
         return
 
     def on_middle_mouse_release(self, event):
@@ -922,6 +1392,7 @@ class MainUI:
         """
         print(" Middle mouse released")
         self.draw_image_coordinates()
+        self.draw_exclusion_mask()
         return
 
     def mark_img(self):
@@ -953,6 +1424,13 @@ class MainUI:
         return
 
     def set_threshold(self):
+        ## in percentile mode, the slider position is the percentage of the dataset picks below the threshold
+        if self.threshold_mode.get() == 'percentile' and self.score_histogram.n > 0:
+            percentile = 100 * self.score_histogram.count_below(self.picks_threshold) / self.score_histogram.n
+            print(" threshold value set to = %s (percentile %0.1f of the dataset)" % (self.picks_threshold, percentile))
+            self.threshold_SLIDER.set(percentile)
+            return
+
         current_set_threshold = self.picks_threshold
         current_min = self.threshold_min
         current_max = self.threshold_max
@@ -981,26 +1459,215 @@ class MainUI:
         return 
 
     def on_slider_change(self, slider_value):
-        ## find the absolute range of the current threshold values 
-        current_min = self.threshold_min
-        current_max = self.threshold_max
-        current_range = current_max - current_min 
+        if self.threshold_mode.get() == 'percentile' and self.score_histogram.n > 0:
+            ## the slider position is the percentage of the dataset picks to drop
+            new_set_threshold = self.score_histogram.percentile(float(slider_value))
+        else:
+            ## find the absolute range of the current threshold values 
+            current_min = self.threshold_min
+            current_max = self.threshold_max
+            current_range = current_max - current_min 
 
-        ## get the relative position of the slider 
-        slider_value_relative = float(slider_value) / 100
+            ## get the relative position of the slider 
+            slider_value_relative = float(slider_value) / 100
 
-        ## remap the relative position to the initial range  
-        new_set_threshold = current_min + (current_range * slider_value_relative)
+            ## remap the relative position to the initial range  
+            new_set_threshold = current_min + (current_range * slider_value_relative)
 
         ## set the threshold value to the instance 
         self.picks_threshold = new_set_threshold
         print(" new threshold value picked = (%s -> %s)" % (slider_value, new_set_threshold) )
 
-        self.threshold_LABEL['text'] = "Threshold: %0.2f" % new_set_threshold
+        self.update_threshold_labels()
 
         self.draw_image_coordinates()
         return 
 
+    def update_threshold_labels(self):
+        """ Show the current threshold, and the number of picks in the whole dataset at or above it (see: score_histogram)
+        """
+        self.threshold_LABEL['text'] = "Threshold: %0.2f" % self.picks_threshold
+        if self.score_histogram.n > 0:
+            retained = self.score_histogram.count_above(self.picks_threshold)
+            self.threshold_retained_LABEL['text'] = "Dataset: %s / %s picks" % (retained, self.score_histogram.n)
+        elif self.score_histogram_job is None:
+            self.threshold_retained_LABEL['text'] = "Dataset: --"
+        return
+
+    def update_threshold_range(self, image_min, image_max):
+        """ Set the range of scores the threshold slider spans: that of the picks on the displayed image (given), or that of
+            the whole dataset if the slider is in 'score' or 'percentile' mode and the dataset score histogram is not empty
+        """
+        low, high = None, None
+        if self.threshold_mode.get() != 'image':
+            low, high = self.score_histogram.score_range()
+        if low is None:
+            low, high = image_min, image_max
+        self.threshold_min = low
+        self.threshold_max = high
+        return
+
+    def on_threshold_mode_change(self, mode):
+        print(" Threshold slider mode: %s" % mode)
+        self.update_threshold_range(self.threshold_min, self.threshold_max)
+        self.set_threshold()
+        self.draw_image_coordinates()
+        return
+
+    def start_score_histogram_scan(self):
+        """ Bring the dataset score histogram up to date with the picks of every image in the working directory. Picks are
+            taken from the same source as when loading an image: the session (in session mode), a .STAR file, or else a
+            loaded topaz particles file. .STAR files are read on a worker thread, skipping those unchanged since the last scan.
+        """
+        if self.score_histogram_job is not None:
+            self.score_histogram_job.cancel()
+        image_names = images_in_dir(self.working_dir, self.USE_MRC.get(), DEBUG = False)
+        session_names = set()
+        if self.session is not None:
+            ## the session database is only used from the main thread
+            for image_name, scores in self.session.load_scores().items():
+                self.score_histogram.update_micrograph(image_name, np.maximum(scores, 0))
+                session_names.add(image_name)
+        ## images no longer in the working directory drop out of the histogram
+        for image_name in list(self.score_histogram.contributions):
+            if image_name not in session_names and image_name not in image_names:
+                self.score_histogram.remove_micrograph(image_name)
+
+        self.score_histogram_saved = set()
+        image_names = [ image_name for image_name in image_names if image_name not in session_names ]
+        self.score_histogram_job = BackgroundJob("Score histogram", score_histogram_worker, (self.working_dir, image_names, dict(self.score_histogram.stamps)))
+        self.instance.after(100, self.poll_score_histogram_job, self.score_histogram_job)
+        return
+
+    def poll_score_histogram_job(self, job):
+        """ Read messages from the worker thread of a score histogram scan, re-scheduling itself until the scan ends
+        """
+        if job is not self.score_histogram_job:
+            return
+        for message, value in job.poll():
+            if message == 'progress':
+                self.threshold_retained_LABEL['text'] = "Dataset: %s" % value
+            elif message == 'done':
+                self.score_histogram_job = None
+                self.apply_score_histogram_scan(*value)
+                print(" Score histogram :: %s picks from %s images (%.1f s)" % (self.score_histogram.n, len(self.score_histogram.contributions), time.time() - job.start_time))
+                return
+            elif message in ['cancelled', 'error']:
+                self.score_histogram_job = None
+                if message == 'error':
+                    print(" Problem reading scores for the dataset histogram: %s" % value)
+                self.update_threshold_labels()
+                return
+        self.instance.after(100, self.poll_score_histogram_job, job)
+        return
+
+    def apply_score_histogram_scan(self, updates, no_source):
+        """ Add the results of a score histogram scan (see: score_histogram_worker), then redraw the slider & labels
+        """
+        for image_name in updates:
+            ## images saved during the scan are already up to date
+            if image_name in self.score_histogram_saved:
+                continue
+            stamp, scores = updates[image_name]
+            self.score_histogram.update_micrograph(image_name, scores, stamp = stamp)
+        for image_name in no_source:
+            if image_name in self.score_histogram_saved:
+                continue
+            topaz_picks = self.dataset_particle_data.get(os.path.splitext(image_name)[0], self.dataset_particle_data.get(image_name))
+            if topaz_picks is not None:
+                self.score_histogram.update_micrograph(image_name, np.asarray(topaz_picks)[:, 2])
+            else:
+                self.score_histogram.remove_micrograph(image_name)
+        self.score_histogram_saved = set()
+        self.save_score_histogram()
+
+        self.update_threshold_range(self.threshold_min, self.threshold_max)
+        self.set_threshold()
+        self.update_threshold_labels()
+        return
+
+    def update_score_histogram(self):
+        """ Replace the scores of the displayed image in the dataset score histogram with those of its current picks
+        """
+        self.score_histogram.update_micrograph(self.image_name, [ coordinate[2] for coordinate in self.coordinates ])
+        if self.score_histogram_job is not None:
+            self.score_histogram_saved.add(self.image_name)
+        self.update_threshold_labels()
+        return
+
+    def save_score_histogram(self):
+        ## in session mode the histogram is rebuilt from the session on launch, so it is not written out
+        if self.score_histogram.histogram_file is not None:
+            self.score_histogram.save()
+        return
+
+    def get_exclusion_mask(self):
+        """ The carbon/ice exclusion mask of the current image (see: image_handler.exclusion_mask), made from the display image
+            as loaded (so display processing does not change it) with cells of one particle diameter, and cached per image
+            RETURNS
+                mask = np array of bool (low resolution), True in regions to exclude; covers the display image
+        """
+        display_angpix = get_scale_factor(self.mrc_dimensions, self.jpg_dimensions) * self.pixel_size / self.scale_factor
+        particle_pixels = self.picks_diameter / display_angpix
+        key = (self.image_name, array_digest(self.display_im_source), round(particle_pixels, 1), self.exclusion_sigma)
+        if key in self.exclusion_mask_cache:
+            self.exclusion_mask_cache.move_to_end(key)
+            return self.exclusion_mask_cache[key]
+
+        mask = image_handler.exclusion_mask(self.display_im_source, particle_pixels, sigma = self.exclusion_sigma, DEBUG = DEBUG)
+        self.exclusion_mask_cache[key] = mask
+        while len(self.exclusion_mask_cache) > EXCLUSION_MASK_CACHE_SIZE:
+            self.exclusion_mask_cache.popitem(last = False)
+        return mask
+
+    def toggle_exclusion_mask(self):
+        """ Show/hide the exclusion mask, which also turns its use for autopicking on/off
+        """
+        if self.USE_EXCLUSION_MASK.get():
+            print(" Exclusion mask on, autopicking will skip carbon/ice regions (shaded)")
+        else:
+            print(" Exclusion mask off")
+        self.draw_exclusion_mask()
+        return
+
+    def draw_exclusion_mask(self):
+        """ Shade the excluded regions of the current image, one rectangle per run of excluded cells along each row of the mask
+        """
+        if len(self.displayed_widgets) == 0:
+            return
+        canvas = self.displayed_widgets[0]
+        canvas.delete('exclusion_mask')
+        if not self.USE_EXCLUSION_MASK.get() or self.display_im_source is None or len(self.display_im_arrays[0]) == 0:
+            return
+
+        mask = self.get_exclusion_mask()
+        im_h, im_w = self.display_im_arrays[0].shape[:2]
+        cell_h, cell_w = im_h / mask.shape[0], im_w / mask.shape[1]
+        for row in range(mask.shape[0]):
+            ## starts & ends of the runs of excluded cells in this row
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], mask[row].astype(np.int8), [0]))))
+            for start, end in zip(edges[::2], edges[1::2]):
+                canvas.create_rectangle(start * cell_w, row * cell_h, end * cell_w, (row + 1) * cell_h, fill = 'yellow', stipple = 'gray25', outline = '', tags = 'exclusion_mask')
+        canvas.tag_raise('particle_positions')
+        return
+
+    def remove_masked_picks(self):
+        """ Delete all picks on the current image that are inside the exclusion mask
+        """
+        if len(self.coordinates) == 0 or self.display_im_source is None:
+            return
+        mask = self.get_exclusion_mask()
+        keys = list(self.coordinates)
+        ## coordinates are in .jpg pixels, the mask covers the display image
+        positions = np.array([ (x, y) for x, y, score in keys ], dtype = np.float64) * self.scale_factor
+        excluded = image_handler.points_in_mask(mask, self.display_im_arrays[0].shape[:2], positions[:, 0], positions[:, 1])
+        for index in np.flatnonzero(excluded):
+            del self.coordinates[keys[index]]
+            self.picks_psi.pop(keys[index], None)
+        print(" Removed %s picks in the exclusion mask (%s remaining)" % (np.count_nonzero(excluded), len(self.coordinates)))
+        self.draw_image_coordinates()
+        return
+
     def draw_image_coordinates(self):
         """ Read a dictionary of pixel coordinates and draw boxes centered at each point
         """
@@ -1017,12 +1684,13 @@ class MainUI:
         image_coordinates = []
         for coord in self.coordinates:
             image_coordinates.append(coord)
-        ## update the threshold slider to fit the min/max values of the scores detected 
+        ## update the threshold slider to fit the min/max values of the scores detected (or of the dataset, see: update_threshold_range)
         try:
-            self.threshold_max = max(image_coordinates, key=itemgetter(2))[2]
-            self.threshold_min = min(image_coordinates, key=itemgetter(2))[2]
+            image_max = max(image_coordinates, key=itemgetter(2))[2]
+            image_min = min(image_coordinates, key=itemgetter(2))[2]
             print(" Coordinates found for image:")
-            print("    %s particles, score range = [%s -> %s]" % (len(image_coordinates), self.threshold_min, self.threshold_max))
+            print("    %s particles, score range = [%s -> %s]" % (len(image_coordinates), image_min, image_max))
+            self.update_threshold_range(image_min, image_max)
             self.set_threshold()
 
         except:
@@ -1200,11 +1868,13 @@ class MainUI:
                 particle_data = load_topaz_csv(file_path)
                 ## save the image coordinate data into our instance container 
                 self.coordinates = particle_data
+                self.dataset_particle_data = particle_data
 
             except:
                 showerror("Open Source File", "Failed to read file\n'%s'" % fname)
 
             self.next_img('none')
+            self.start_score_histogram_scan()
         
         return
 
@@ -1431,7 +2101,7 @@ class MainUI:
                 print(" WIP :: get the mrc dimensions here and update the Entry widget, also make that widget locked if we are using mrc files ")
                 img_scaled = resize_image(mrc_im_array, self.scale_factor)
                 img_array = mrc2grayscale(img_scaled, self.pixel_size / self.scale_factor)
-                img_contrasted = sigma_contrast(img_array, self.sigma_contrast)  
+                img_contrasted = self.display_pipeline.reset().sigma_contrast(self.sigma_contrast, clamp = True).run(img_array)
                 im_obj = get_PhotoImage_obj(img_contrasted)
 
                 self.mrc_dimensions = (mrc_im_array.shape[1], mrc_im_array.shape[0])
@@ -1452,7 +2122,7 @@ class MainUI:
 
                     # im = im.convert('RGB') ## make RGB ;; note that local contrast function does not work on RGB images atm   
                     img_array = np.asarray(im)
-                    img_contrasted = sigma_contrast(img_array, self.sigma_contrast)
+                    img_contrasted = self.display_pipeline.reset().sigma_contrast(self.sigma_contrast, clamp = True).run(img_array)
                     im_obj = get_PhotoImage_obj(img_contrasted)
 
                     # im_obj = ImageTk.PhotoImage(im)
@@ -1460,6 +2130,8 @@ class MainUI:
         ## update the display data on the class
         self.display_data = [ im_obj ]
         self.display_im_arrays = [ img_contrasted ]
+        if not isinstance(input_im_array, np.ndarray):
+            self.display_im_source = img_contrasted
         self.image_name = os.path.basename(str(fname))
 
         # a, b = get_fixed_array_index(1, 1)
@@ -1485,10 +2157,23 @@ class MainUI:
 
         ## update coordinates in buffer only if we are loading a new image, not if we are passing in a modified image
         if input_im_array is None:
+            ## a running autopick job & cached autopick results belong to the previous image
+            self.cancel_autopick_job()
+            self.autopick_cache.clear()
+            self.autopick_active_key = None
+            self.autopick_keys = set()
             ## empty any pre-existing image coordinates in memory
             self.coordinates = dict()
+            self.picks_psi = dict()
+
+            ## in session mode, use the coordinates saved in the session if this image has been curated before
+            session_coordinates = None
+            if self.session is not None:
+                session_coordinates = self.session.load_coordinates(self.image_name)
+                if session_coordinates is not None:
+                    self.coordinates = read_coords_from_rows(session_coordinates, get_scale_factor(self.mrc_dimensions, self.jpg_dimensions))
 
-            if len(self.coordinates) == 0: ## avoid overwriting an existing image_coordinates dictionary if it is already present
+            if len(self.coordinates) == 0 and session_coordinates is None: ## avoid overwriting an existing image_coordinates dictionary if it is already present
                 counter = 0
                 star_coordinate_file = ""
                 ## to find matching files we need precise names to look for, set them up here:
@@ -1497,6 +2182,8 @@ class MainUI:
                 match_file2 = img_basename + "_manualpick.star"
                 match_file3 = img_basename + "_CURATED.star"
                 # print("Match file names = %s, %s, %s" % (match_file1, match_file2, match_file3))
+                ## if this image's curated file is still queued for writing, wait for it so we load the latest picks
+                self.writer.flush(match_file3)
 
                 ## find the matching star file if it exists
                 for fname in os.listdir(self.working_dir): ## iterate over the directory
@@ -1515,6 +2202,7 @@ class MainUI:
 
         ## draw image coordinates if necessary
         self.draw_image_coordinates()
+        self.draw_exclusion_mask()
 
         return
 
@@ -1641,6 +2329,9 @@ class MainUI:
         # dropdown_file.add_command(label="Open .mrc", command=self.load_file)
         dropdown_file.add_command(label="Open marked imgs file", command=self.load_marked_filelist)
         dropdown_file.add_command(label="Save marked imgs (Ctrl + S)", command=self.write_marked)
+        if self.session is not None:
+            dropdown_file.add_command(label="Export session .STAR files", command=self.export_session_star)
+            dropdown_file.add_command(label="Export session marked imgs", command=self.export_session_marked)
         # dropdown_file.add_command(label="Quick save particles (Ctrl + Shift + S, or F5)", command=self.write_particles_file)
         dropdown_file.add_command(label="Exit", command=self.quit)
 
@@ -1650,6 +2341,8 @@ class MainUI:
         dropdown_functions.add_command(label="Clear picks on image", command = lambda: self.clear_coordinates())
         dropdown_functions.add_command(label="Reset picks as new", command = lambda: self.reset_coordinates_as_new())
         dropdown_functions.add_command(label="Autopicking (Ctrl + X)", command = lambda: self.open_panel("AutopickPanel"))
+        dropdown_functions.add_checkbutton(label="Exclude carbon/ice from autopicking", variable = self.USE_EXCLUSION_MASK, command = self.toggle_exclusion_mask)
+        dropdown_functions.add_command(label="Remove picks in excluded regions", command = self.remove_masked_picks)
         dropdown_functions.add_command(label="Local contrast", command=self.local_contrast)
         dropdown_functions.add_command(label="Blur", command=self.gaussian_blur)
         dropdown_functions.add_command(label="Local contrast & Blur (Ctrl + C)", command=self.local_contrast_and_blur)
@@ -1659,6 +2352,20 @@ class MainUI:
 
         return
 
+    def export_session_star(self):
+        """ Write a '_CURATED.star' file for every micrograph in the session into the working directory
+        """
+        ## make sure the current image is in the session before exporting
+        if len(self.coordinates) > 0:
+            self.save_starfile()
+        self.session.export_star(self.working_dir)
+        return
+
+    def export_session_marked(self, file = "marked_imgs.txt"):
+        self.session.set_marked(self.marked_imgs)
+        self.session.export_marked(os.path.join(self.working_dir, file))
+        return
+
     def reset_coordinates_as_new(self):
         """
         Mark all active coordinates on the image as 'new', such that you can change the micrograph dimensions to re-calculate the .STAR file coordinates in case it was accidentally missed earlier (i.e. pixel coordinates on .jpg are correct, not wrong on micrograph)
@@ -1765,7 +2472,18 @@ class MainUI:
         return
 
     def quit(self):
+        self.cancel_autopick_job()
+        if self.score_histogram_job is not None:
+            self.score_histogram_job.cancel()
+        self.save_score_histogram()
         self.save_settings()
+        ## make sure all queued files are written before closing
+        self.writer.close()
+        while not self.writer.errors.empty():
+            path, error = self.writer.errors.get()
+            print(" !! ERROR :: Could not write file '%s': %s" % (path, error))
+        if self.session is not None:
+            self.session.close()
         if DEBUG:
             print(" CLOSING PROGRAM")
         sys.exit()
@@ -1842,50 +2560,52 @@ class MainUI:
     #     print(" Wrote %s particles to: %s" % (counter, save_path))
     #     return 
 
+    def get_star_coordinates(self):
+        """ Convert the coordinates on the current image into .STAR (i.e. .MRC) space
+        ### RETURNS
+        ```
+            star_coordinates = list( tuple(x, y, selection_type, psi, score), ... )
+        ```
+        """
+        star_coordinates = []
+        for jpg_coord in self.coordinates:
+            mrc_coord = self.coordinates[jpg_coord]
+            ## new points added on the .GIF with no corresponding .MRC coordinate must interpolate to map the .GIF coordinate onto .MRC
+            ## NOTE: This remapping is imprecise due to uncompression error hence we only do this if it is a 'new_point' in the database
+            if mrc_coord == 'new_point':
+                #### interpolate .MRC coordinate from .GIF position
+                mrc_x, mrc_y, score = jpg2star(jpg_coord, get_scale_factor(self.mrc_dimensions, self.jpg_dimensions))
+                star_coordinates.append((mrc_x, mrc_y, 2, self.picks_psi.get(jpg_coord, -999.0), score))
+            else: # if point is not new, we can just write the original corresponding mrc_coordinate back into the file
+                psi = mrc_coord[3] if len(mrc_coord) > 3 else -999.0
+                star_coordinates.append((mrc_coord[0], mrc_coord[1], -999, psi, jpg_coord[2]))
+        return star_coordinates
+
     def save_starfile(self):
-        ## unpack the global variables for readability
-        # image_coordinates = self.coordinates
-        # box_size = PARAMS['box_size']
-        # img_box_size = PARAMS['img_box_size']
-        # img_pixel_size_x = PARAMS['img_dimensions'][0]
-        # mrc_pixel_size_x = PARAMS['mrc_dimensions'][0]
-        # mrc_pixel_size_y = PARAMS['mrc_dimensions'][1]
+        ## keep the dataset template in step with the saved picks
+        try:
+            self.update_template_accumulator()
+        except Exception as e:
+            print(" Problem updating dataset template: %s" % e)
+        try:
+            self.update_score_histogram()
+        except Exception as e:
+            print(" Problem updating dataset score histogram: %s" % e)
 
         # avoid bugging out when hitting 'next img' and no image is currently loaded
         try:
+            star_coordinates = self.get_star_coordinates()
+            ## in session mode, coordinates are kept in the session database and only written as .STAR files on export
+            if self.session is not None:
+                self.session.save_micrograph(self.image_name, star_coordinates, self.image_name in self.marked_imgs)
+                print(" Saved %s particles into session for: %s" % (len(star_coordinates), self.image_name))
+                return
+
             current_img_base_name = os.path.splitext(self.image_name)[0]
             save_fname = current_img_base_name + '_CURATED.star'
-            with open(save_fname, 'w') as f : # NOTE: 'w' overwrites existing file; as compared to 'a' which appends only
-                ############
-                ## HEADER
-                ############
-                f.write("\n")
-                f.write("data_\n")
-                f.write("\n")
-                f.write("loop_\n")
-                f.write("_rlnCoordinateX #1\n")
-                f.write("_rlnCoordinateY #2\n")
-                f.write("_rlnParticleSelectionType #3\n")
-                f.write("_rlnAnglePsi #4\n")
-                f.write("_rlnAutopickFigureOfMerit #5\n")
-                f.write("\n")
-
-                ############
-                ## BODY
-                ############
-                counter = 0
-                for jpg_coord in self.coordinates:
-                    counter += 1
-                    mrc_coord = self.coordinates[jpg_coord]
-                    ## new points added on the .GIF with no corresponding .MRC coordinate must interpolate to map the .GIF coordinate onto .MRC
-                    ## NOTE: This remapping is imprecise due to uncompression error hence we only do this if it is a 'new_point' in the database
-                    if mrc_coord == 'new_point':
-                        #### interpolate .MRC coordinate from .GIF position
-                        mrc_x, mrc_y, score = jpg2star(jpg_coord, get_scale_factor(self.mrc_dimensions, self.jpg_dimensions))
-                        f.write("%.2f    %.2f   \t 2     -999.0    %.2f \n" % (mrc_x, mrc_y, score))
-                    else: # if point is not new, we can just write the original corresponding mrc_coordinate back into the file
-                        f.write("%.2f    %.2f   \t -999     -999.0    %.2f \n" % (mrc_coord[0], mrc_coord[1], jpg_coord[2]))
-            print(" Wrote %s particles into star file: %s" % (counter, save_fname))
+            ## hand the file off to the background writer so the GUI does not wait on the disk
+            self.writer.submit(save_fname, star_handler.format_coordinates_star(star_coordinates))
+            print(" Queued %s particles for writing into star file: %s" % (len(star_coordinates), save_fname))
         except:
             print(" Problem writing starfile")
             pass
@@ -1902,17 +2622,24 @@ class MainUI:
             print("Abort save settings :: No image is loaded")
             return
 
-        with open(save_path, 'w') as f :
-            f.write("## Last used settings for em_dataset_curator.py\n")
-            f.write("img_loaded %s\n" % self.image_name)
-            f.write("mrc_dimensions %s %s\n" % (self.mrc_dimensions[0], self.mrc_dimensions[1]))
-            f.write("angpix %s\n" % self.pixel_size)
-            f.write("picks_diameter %s\n" % self.picks_diameter)
-            f.write("scale_factor %s\n" % self.scale_factor)
-            f.write("sigma_contrast %s\n" % self.sigma_contrast)
-            f.write("picks_threshold %s\n" % self.picks_threshold)
-            # f.write("particles_file_save_name %s\n" % self.particles_file_save_name)
-        print(" >> Saved current settings to '%s'" % save_path)
+        settings = []
+        settings.append("## Last used settings for em_dataset_curator.py\n")
+        settings.append("img_loaded %s\n" % self.image_name)
+        settings.append("mrc_dimensions %s %s\n" % (self.mrc_dimensions[0], self.mrc_dimensions[1]))
+        settings.append("angpix %s\n" % self.pixel_size)
+        settings.append("picks_diameter %s\n" % self.picks_diameter)
+        settings.append("scale_factor %s\n" % self.scale_factor)
+        settings.append("sigma_contrast %s\n" % self.sigma_contrast)
+        settings.append("picks_threshold %s\n" % self.picks_threshold)
+        settings.append("threshold_mode %s\n" % self.threshold_mode.get())
+        # settings.append("particles_file_save_name %s\n" % self.particles_file_save_name)
+        if self.session is not None:
+            ## store each 'key value(s)' line as a key/value pair in the session
+            self.session.save_settings(dict(line.strip().split(' ', 1) for line in settings if line[0] != '#'))
+            print(" >> Saved current settings to session")
+            return
+        self.writer.submit(save_path, "".join(settings))
+        print(" >> Queued current settings for saving to '%s'" % save_path)
 
         return 
     
@@ -1921,29 +2648,40 @@ class MainUI:
         """
         settingsfile = '.em_dataset_curator.config'
 
-        if os.path.exists(settingsfile):
-            ## update marked file list with file in directory
+        ## in session mode, settings and marked images are stored in the session database
+        if self.session is not None:
+            self.marked_imgs = self.session.load_marked()
+            session_settings = self.session.load_settings()
+            settings_lines = [ "%s %s" % (key, session_settings[key]) for key in session_settings ]
+        elif os.path.exists(settingsfile):
             with open(settingsfile, 'r') as f :
-                for line in f:
-                    line2list = line.split()
-                    if not '#' in line2list[0]: ## ignore comment lines
-                        if line2list[0] == 'img_loaded':
-                            image_to_load = line2list[1]
-                        if line2list[0] == 'picks_diameter':
-                            self.picks_diameter = int(line2list[1])
-                        if line2list[0] == 'scale_factor':
-                            self.scale_factor = float(line2list[1])
-                        if line2list[0] == 'sigma_contrast':
-                            self.sigma_contrast = float(line2list[1])
-                        if line2list[0] == 'picks_threshold':
-                            self.picks_threshold = float(line2list[1])
-                        if line2list[0] == 'angpix':
-                            self.pixel_size = float(line2list[1])
-                        if line2list[0] == 'mrc_dimensions':
-                            self.mrc_dimensions = (int(line2list[1]), int(line2list[2]))
-
-                        # if line2list[0] == 'particles_file_save_name':
-                        #     self.particles_file_save_name = line2list[1]
+                settings_lines = f.readlines()
+        else:
+            settings_lines = []
+
+        ## update instance variables from the saved settings
+        for line in settings_lines:
+            line2list = line.split()
+            if not '#' in line2list[0]: ## ignore comment lines
+                if line2list[0] == 'img_loaded':
+                    image_to_load = line2list[1]
+                if line2list[0] == 'picks_diameter':
+                    self.picks_diameter = int(line2list[1])
+                if line2list[0] == 'scale_factor':
+                    self.scale_factor = float(line2list[1])
+                if line2list[0] == 'sigma_contrast':
+                    self.sigma_contrast = float(line2list[1])
+                if line2list[0] == 'picks_threshold':
+                    self.picks_threshold = float(line2list[1])
+                if line2list[0] == 'threshold_mode':
+                    self.threshold_mode.set(line2list[1])
+                if line2list[0] == 'angpix':
+                    self.pixel_size = float(line2list[1])
+                if line2list[0] == 'mrc_dimensions':
+                    self.mrc_dimensions = (int(line2list[1]), int(line2list[2]))
+
+                # if line2list[0] == 'particles_file_save_name':
+                #     self.particles_file_save_name = line2list[1]
 
         ## update the index to match the image we wanted to load, with a fallback to the first image on a failure
         try:
@@ -1961,26 +2699,35 @@ class MainUI:
         self.save_settings()
         marked_imgs = self.marked_imgs
         image_coordinates = self.coordinates
-        ## if present, determine what entries might already exist in the target file (e.g. if continuing from a previous session)
-        existing_entries = []
-        if os.path.exists(file):
-            with open(file, 'r') as f :
-                for line in f:
-                    existing_entries.append(line.strip())
-
-        ## write new marked images into file, if any present
-        with open(file, 'w') as f :
-            counter = 0
-            for marked_img in marked_imgs:
-                counter += 1
-                ## write all marked_img names into the file from RAM
-                f.write("%s\n" % marked_img)
-            print(" >> %s entries written into 'marked_imgs.txt'" % counter)
+
+        ## in session mode, the marked images are saved into the session database in one transaction
+        if self.session is not None:
+            self.session.set_marked(marked_imgs)
+            print(" >> %s marked images saved to session" % len(marked_imgs))
+            if len(image_coordinates) > 0:
+                self.save_starfile()
+            return
+
+        ## if present, determine what entries might already exist in the target file (e.g. if continuing from a previous session),
+        ## this is only read from disk once, afterwards we remember what we last wrote
+        if self.saved_marked_imgs is None:
+            self.saved_marked_imgs = []
+            if os.path.exists(file):
+                with open(file, 'r') as f :
+                    for line in f:
+                        self.saved_marked_imgs.append(line.strip())
+        existing_entries = self.saved_marked_imgs
+
+        ## queue the marked images for writing into file
+        self.writer.submit(file, "".join("%s\n" % marked_img for marked_img in marked_imgs))
+        print(" >> %s entries queued for writing into '%s'" % (len(marked_imgs), file))
 
         ## indicate which images were dropped from the previous file
+        marked_imgs_set = set(marked_imgs)
         for existing_entry in existing_entries:
-            if not existing_entry in marked_imgs:
+            if not existing_entry in marked_imgs_set:
                 print(" ... %s was removed from previous entries after rewriting file" % existing_entry)
+        self.saved_marked_imgs = list(marked_imgs)
 
         ## also save current image particle coordinates if they are present
         if len(image_coordinates) > 0:
@@ -2026,11 +2773,16 @@ class MainUI:
             return
 
     #region :: IMAGE PROCESSING FUNCTIONS 
+    def local_contrast_box_size(self):
+        """ The particle diameter in pixels of the displayed image, to size the local contrast footprint
+        """
+        display_angpix = get_scale_factor(self.mrc_dimensions, self.jpg_dimensions) * self.pixel_size / self.scale_factor
+        return self.picks_diameter / display_angpix
+
     def local_contrast_and_blur(self):
         ## get the image array from buffer 
         display_im_array = self.display_im_arrays[0]
-        im = image_handler.local_contrast(display_im_array, self.picks_diameter, DEBUG = DEBUG)
-        im = image_handler.gaussian_blur(im, 1.5)
+        im = self.display_pipeline.reset().local_contrast(self.local_contrast_box_size(), method = self.local_contrast_method).gaussian_blur(1.5).run(display_im_array)
 
         ## get the updated array and pass it to the load_img function 
         self.load_img(self.image_name, input_im_array=im)
@@ -2043,7 +2795,7 @@ class MainUI:
         ## get the image array from buffer 
         display_im_array = self.display_im_arrays[0]
         ## send the array to the image_handler function 
-        im = image_handler.local_contrast(display_im_array, self.picks_diameter, DEBUG = DEBUG)
+        im = self.display_pipeline.reset().local_contrast(self.local_contrast_box_size(), method = self.local_contrast_method).run(display_im_array)
         ## get the updated array and pass it to the load_img function 
         self.load_img(self.image_name, input_im_array=im)
         return
@@ -2052,7 +2804,7 @@ class MainUI:
         ## get the image array from buffer 
         display_im_array = self.display_im_arrays[0]
         ## send the array to the image_handler function 
-        im = image_handler.gaussian_blur(display_im_array, 1.5)
+        im = self.display_pipeline.reset().gaussian_blur(1.5).run(display_im_array)
         ## get the updated array and pass it to the load_img function 
         self.load_img(self.image_name, input_im_array=im)
         return
@@ -2063,7 +2815,7 @@ class MainUI:
         ## get the image array from buffer 
         display_im_array = self.display_im_arrays[0]
         ## send the array to the image_handler function 
-        im = image_handler.auto_contrast(display_im_array)
+        im = self.display_pipeline.reset().auto_contrast().run(display_im_array)
         ## get the updated array and pass it to the load_img function 
         self.load_img(self.image_name, input_im_array=im)
         return
@@ -2086,6 +2838,7 @@ class AutopickPanel(MainUI):
         self.canvas_size = 150 # px
         self.picking_threshold = 0.01
         self.gaussian_disk_diameter = int(self.mainUI.picks_diameter * 0.8)
+        self.rotations = 1 ## number of in-plane rotations of the template to match
 
         ## Define widgets
 
@@ -2095,9 +2848,15 @@ class AutopickPanel(MainUI):
         self.save_template_button = tk.Button(self.panel, text="Save template", font = ('Helvetica', '10'), command = lambda: self.save_template(), width=10)
         self.autopick_button = tk.Button(self.panel, text="Autopick", font = ('Helvetica', '12'), command = lambda: self.submit_autopicker_job(), width=10)
         self.clear_coordinates_button = tk.Button(self.panel, text="Clear picks", font = ('Helvetica', '9'), command = lambda: self.clear_picked_coordinates(), width=10)
+        self.dataset_template_button = tk.Button(self.panel, text="Dataset template", font = ('Helvetica', '9'), command = lambda: self.use_dataset_template(), width=12)
         self.gaussian_disk_BUTTON = tk.Button(self.panel, text="Gaussian disk", font = ('Helvetica', '9'), command = lambda: self.create_gaussian_disk(), width=12)
         self.gaussian_disk_diameter_ENTRY = tk.Entry(self.panel, width=10, font=("Helvetica", '9'), justify='right')
         self.gaussian_disk_diameter_ENTRY.insert(tk.END, "%s" % self.gaussian_disk_diameter)
+        self.rotations_label = tk.Label(self.panel, text = 'Rotations:', font = ('Helvetica', '9'))
+        self.rotations_ENTRY = tk.Entry(self.panel, width=10, font=("Helvetica", '9'), justify='right')
+        self.rotations_ENTRY.insert(tk.END, "%s" % self.rotations)
+        ## progress of autopick jobs (see: MainUI.set_autopick_status)
+        self.status_label = tk.Label(self.panel, text = '', anchor = tk.W, font = ('Helvetica', '9'))
 
 
         ## 2. threshold slider
@@ -2132,8 +2891,12 @@ class AutopickPanel(MainUI):
 
         self.gaussian_disk_BUTTON.grid(column = 0, row = 8)
         self.gaussian_disk_diameter_ENTRY.grid(column = 1, row = 8)
+        self.dataset_template_button.grid(column = 2, row = 8)
         self.gaussian_disk_diameter_ENTRY.bind('<Return>', lambda event: self.create_gaussian_disk())
         self.gaussian_disk_diameter_ENTRY.bind('<KP_Enter>', lambda event: self.create_gaussian_disk())
+        self.rotations_label.grid(column = 0, row = 9, pady = 5)
+        self.rotations_ENTRY.grid(column = 1, row = 9, pady = 5)
+        self.status_label.grid(column = 0, row = 10, columnspan = 3, sticky=tk.W, pady=5, padx=10)
 
 
         ## Add some hotkeys for ease of use
@@ -2221,14 +2984,35 @@ class AutopickPanel(MainUI):
             return
         # template = self.mainUI.make_template_from_picks()
         else:
-            print(" Submitting autopick job with template: ", self.loaded_template_im_array.shape)
-            self.mainUI.template_picker(self.loaded_template_im_array, float(self.threshold_slider.get()))
+            ## read the number of rotations to match, resetting the widget on a bad input
+            try:
+                self.rotations = max(1, int(self.rotations_ENTRY.get()))
+            except:
+                self.rotations_ENTRY.delete(0, tk.END)
+                self.rotations_ENTRY.insert(0, "int")
+                return
+            print(" Submitting autopick job with template: ", self.loaded_template_im_array.shape, " rotations = %s" % self.rotations)
+            self.mainUI.template_picker(self.loaded_template_im_array, float(self.threshold_slider.get()), self.rotations)
         return
     
     def generate_template_from_picks(self):
-        template = self.mainUI.make_template_from_picks()
-        if isinstance(template, bool):
-            return 
+        ## the template is made on a worker thread and handed back to set_template
+        self.mainUI.make_template_from_picks(self.set_template)
+        return 
+
+    def use_dataset_template(self):
+        ## the dataset template combines the picks of all images saved since it was started, including the current one
+        template = self.mainUI.make_dataset_template()
+        if template is None:
+            print(" No picks added to the dataset template yet!")
+            return
+        self.set_template(template)
+        return
+
+    def set_template(self, template):
+        ## the panel may have been closed while the template was being made
+        if self.mainUI.autopickPanel_instance is not self:
+            return
         self.loaded_template_im_array = template 
         self.display_template()
         return 
@@ -2268,9 +3052,11 @@ class AutopickPanel(MainUI):
     def on_threshold_change(self, slider_value):
 
         ## set the threshold value to the instance 
-        self.picks_threshold = slider_value
+        self.picking_threshold = float(slider_value)
         print(" Template picking threshold = %s" % slider_value )
 
+        ## picks of the last autopick on this image follow the slider, using the cached peaks
+        self.mainUI.refilter_autopick(self.picking_threshold)
         return 
 
     def clear_picked_coordinates(self):
@@ -2294,6 +3080,10 @@ if __name__ == '__main__':
     import os, sys
     import re ## for use of re.findall() function to extract numbers from strings
     import time
+    import threading
+    import queue
+    from collections import OrderedDict
+    from scipy.spatial import cKDTree
     try:
         from PIL import Image as PIL_Image
         from PIL import ImageTk
@@ -2326,6 +3116,37 @@ if __name__ == '__main__':
     except :
         print(" ERROR :: Check if star_handler.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
 
+    try:
+        sys.path.append(script_path)
+        import template_accumulator
+    except :
+        print(" ERROR :: Check if template_accumulator.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
+
+    try:
+        sys.path.append(script_path)
+        import candidate_store
+    except :
+        print(" ERROR :: Check if candidate_store.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
+
+    try:
+        sys.path.append(script_path)
+        import score_histogram
+    except :
+        print(" ERROR :: Check if score_histogram.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
+
+    ## optionally keep all curation data in a single session database, i.e.:
+    ##      $ em_dataset_curator.py --session            (uses .em_dataset_curator.db)
+    ##      $ em_dataset_curator.py --session my_session.db
+    session = None
+    if '--session' in sys.argv:
+        import session_store
+        session_file = session_store.DEFAULT_SESSION_FILE
+        session_flag_index = sys.argv.index('--session')
+        if len(sys.argv) > session_flag_index + 1 and os.path.splitext(sys.argv[session_flag_index + 1])[1] == '.db':
+            session_file = sys.argv.pop(session_flag_index + 1)
+        sys.argv.pop(session_flag_index)
+        session = session_store.SessionStore(session_file, DEBUG = DEBUG)
+
 
     ## parse the commandline in case the user added specific file to open, it will open the last one if more than one is given 
     start_index =  0
@@ -2336,7 +3157,7 @@ if __name__ == '__main__':
         particle_data = dict() 
 
     root = tk.Tk()
-    app = MainUI(root, start_index, particle_data)
+    app = MainUI(root, start_index, particle_data, session = session)
     root.mainloop()
 
 #endregion 
\ No newline at end of file
@@ -14,9 +14,75 @@ def _memoryview_safe(x):
         x.setflags(write=True)
     return x
 
-def local_contrast(im_array, box_size, DEBUG = False):
-    """ REF: https://scikit-image.org/docs/dev/auto_examples/color_exposure/plot_local_equalize.html
+## footprint radius (in blocks) that the downsampled local contrast is calculated at
+LOCAL_CONTRAST_RADIUS = 4
+## robust standard deviations from the median cell for a region to be excluded from picking, see: exclusion_mask
+EXCLUSION_SIGMA = 3.0
+## size (px) of the tiles of the match map calculated when part of the image is excluded from picking
+MATCH_TILE_SIZE = 256
+## number of pixels that percentiles of float images are estimated from, see: intensity_percentiles
+PERCENTILE_SAMPLES = 2**18
+
+def _binned_equalize(im_array, radius, binning):
+    """ Approximate rank.equalize(im_array, disk(radius)) for large footprints. The histogram of each binning x binning
+        block of the image is summed over the (binned) disk into a local histogram per block, and every full size pixel
+        is ranked against the local histograms of its 4 nearest blocks (bilinear weights). Unlike equalizing a downsampled
+        image, the ranks are of the original pixel values, so pixel noise is preserved. Intensity levels are visited in
+        order with a running cumulative count, so only one level of the local histograms is held in memory at a time.
     """
+    import numpy as np
+    import cv2
+    from skimage.morphology import disk
+
+    im_h, im_w = im_array.shape
+    grid_h, grid_w = -(-im_h // binning), -(-im_w // binning)
+    footprint = disk(max(1, int(round(radius / binning)))).astype(np.float32)
+
+    ## nearest blocks & bilinear weights of each pixel
+    grid_y = np.clip((np.arange(im_h) + 0.5) / binning - 0.5, 0, grid_h - 1)
+    grid_x = np.clip((np.arange(im_w) + 0.5) / binning - 0.5, 0, grid_w - 1)
+    y0, x0 = np.floor(grid_y).astype(np.intp), np.floor(grid_x).astype(np.intp)
+    wy, wx = (grid_y - y0).astype(np.float32), (grid_x - x0).astype(np.float32)
+    y1, x1 = np.minimum(y0 + 1, grid_h - 1), np.minimum(x0 + 1, grid_w - 1)
+    ## total # of pixels under the footprint of each block
+    population = cv2.filter2D(np.bincount((np.arange(im_h) // binning), minlength = grid_h)[:, None] * np.bincount((np.arange(im_w) // binning), minlength = grid_w)[None, :].astype(np.float32),
+                              -1, footprint, borderType = cv2.BORDER_CONSTANT)
+
+    ## group the pixels by intensity level
+    pixels = np.argsort(im_array, axis = None, kind = 'stable')
+    level_offsets = np.concatenate([ [0], np.cumsum(np.bincount(im_array.ravel(), minlength = 256)) ])
+    rows, cols = pixels // im_w, pixels % im_w
+
+    im = np.zeros(im_h * im_w, dtype = np.float32)
+    cumulative = np.zeros((grid_h, grid_w), dtype = np.float32)
+    for level in range(256):
+        start, end = level_offsets[level], level_offsets[level + 1]
+        if start == end:
+            continue
+        r, c = rows[start:end], cols[start:end]
+        counts = np.bincount((r // binning) * grid_w + c // binning, minlength = grid_h * grid_w).reshape(grid_h, grid_w).astype(np.float32)
+        cumulative += cv2.filter2D(counts, -1, footprint, borderType = cv2.BORDER_CONSTANT)
+        cdf = cumulative / population
+        im[pixels[start:end]] = ((1 - wy[r]) * ((1 - wx[c]) * cdf[y0[r], x0[c]] + wx[c] * cdf[y0[r], x1[c]])
+                                 + wy[r] * ((1 - wx[c]) * cdf[y1[r], x0[c]] + wx[c] * cdf[y1[r], x1[c]]))
+    return np.clip(np.rint(im * 255), 0, 255).astype(np.uint8).reshape(im_h, im_w)
+
+def local_contrast(im_array, box_size, method = 'downsample', clip_limit = 4.0, DEBUG = False):
+    """ Local histogram equalization over a disk of radius 2 x box_size around each pixel.
+        REF: https://scikit-image.org/docs/dev/auto_examples/color_exposure/plot_local_equalize.html
+    PARAMETERS
+        im_array = np array of grayscale img (range 0 - 255)
+        box_size = int(); particle diameter in pixels of im_array
+        method = str(); one of:
+                    'rank'       :: exact rank equalization at full size (slow for large footprints)
+                    'downsample' :: rank equalization against local histograms of binned blocks (see: _binned_equalize)
+                    'clahe'      :: OpenCV contrast limited adaptive histogram equalization, with tiles the width of the footprint
+        clip_limit = float(); contrast limit of the 'clahe' method
+    RETURNS
+        im = np array (uint8)
+    """
+    import numpy as np
+    import cv2
     try:
         from skimage.filters import rank
         from skimage.morphology import disk
@@ -30,29 +96,107 @@ def local_contrast(im_array, box_size, DEBUG = False):
         print("     $ pip install --upgrade scikit-image==0.20.0")
         return
 
-    ## ensure the input array is writable 
+    if method not in ['rank', 'downsample', 'clahe']:
+        raise ValueError("Unknown local contrast method: %s (use 'rank', 'downsample' or 'clahe')" % method)
+
+    ## rank filters & CLAHE work on 8-bit images, display arrays are floats in the range 0 - 255
+    if im_array.dtype != np.uint8:
+        im_array = np.clip(np.rint(im_array), 0, 255).astype(np.uint8)
+    ## ensure the input array is writable
     im_array = _memoryview_safe(im_array)
+    im_h, im_w = im_array.shape
+
+    radius = max(1, int(round(box_size * 2)))
+    binning = 1
+    if method == 'clahe':
+        ## one tile per footprint width
+        tile_size = 2 * radius + 1
+        tile_grid = (max(1, int(round(im_w / tile_size))), max(1, int(round(im_h / tile_size))))
+        im = cv2.createCLAHE(clipLimit = clip_limit, tileGridSize = tile_grid).apply(im_array)
+    else:
+        if method == 'downsample':
+            binning = max(1, radius // LOCAL_CONTRAST_RADIUS)
+        ## small footprints are quick enough to equalize exactly
+        if binning >= 4:
+            im = _binned_equalize(im_array, radius, binning)
+        else:
+            binning = 1
+            im = rank.equalize(im_array, disk(radius))
 
-    footprint = disk(box_size * 2)
     if DEBUG:
         print("=======================================")
         print(" image_handler :: local_contrast")
         print("---------------------------------------")
         print("  input img dim = ", im_array.shape)
         print("  box_size = %s px" % box_size)
-        print("  local contrast footprint = ", footprint.shape)
+        print("  method = %s" % method)
+        if method == 'clahe':
+            print("  tile grid = %s x %s, clip limit = %s" % (tile_grid[0], tile_grid[1], clip_limit))
+        else:
+            print("  footprint radius = %s px, binning = %s" % (radius, binning))
         print("=======================================")
-    im = rank.equalize(im_array, footprint)
     return im
 
-def auto_contrast(im_array, DEBUG = True):
+def sample_percentile_error(n_samples, confidence = 0.999):
+    """ Bound on the error (in percentile points) of percentiles estimated from n random samples, i.e. the estimate of
+        the q th percentile lies between the true (q - error) th and (q + error) th percentiles with the given confidence
+        (Dvoretzky-Kiefer-Wolfowitz inequality)
+    """
+    import numpy as np
+    return 100 * np.sqrt(np.log(2 / (1 - confidence)) / (2 * n_samples))
+
+def intensity_percentiles(im_array, percentiles, max_samples = PERCENTILE_SAMPLES, binning = 1):
+    """ Percentiles of the pixel values of an image (as np.percentile, with linear interpolation). For 8 & 16-bit images they
+        are exact, from the cumulative histogram of the pixel values. For other (e.g. float .MRC) images larger than
+        max_samples pixels they are estimated from a random sample of max_samples pixels (see: sample_percentile_error).
+    PARAMETERS
+        im_array = 2d np array
+        percentiles = list( float(), ... ); in the range 0 - 100
+        max_samples = int() or None; None to always calculate percentiles of float images exactly
+        binning = int(); take the percentiles of every n-th pixel along each axis, i.e. of a downsampled image
+    RETURNS
+        values = list( float(), ... )
+    """
+    import numpy as np
+    im = im_array[::binning, ::binning] if binning > 1 else im_array
+
+    if im.dtype in (np.uint8, np.uint16, np.int8, np.int16):
+        ## histogram of the pixel values, counted in blocks of rows so the values are not all cast to intp at once
+        offset = int(np.iinfo(im.dtype).min)
+        counts = np.zeros(int(np.iinfo(im.dtype).max) - offset + 1, dtype = np.int64)
+        rows = max(1, 2**20 // im.shape[1])
+        for y in range(0, im.shape[0], rows):
+            block = im[y : y + rows].ravel()
+            counts += np.bincount(block if offset == 0 else block.astype(np.int32) - offset, minlength = len(counts))
+        cumulative = np.cumsum(counts)
+        values = []
+        for q in percentiles:
+            ## the value of the k th smallest pixel is the first bin the cumulative count exceeds k in
+            position = q / 100 * (cumulative[-1] - 1)
+            below = np.searchsorted(cumulative, int(position), side = 'right')
+            above = np.searchsorted(cumulative, min(int(position) + 1, cumulative[-1] - 1), side = 'right')
+            values.append(float(below + (above - below) * (position - int(position)) + offset))
+        return values
+
+    if max_samples is not None and im.size > max_samples:
+        ## sample with replacement from a fixed seed, so the same image always gets the same contrast
+        rng = np.random.default_rng(0)
+        im = im[rng.integers(0, im.shape[0], max_samples), rng.integers(0, im.shape[1], max_samples)]
+    return [ float(value) for value in np.percentile(im, percentiles) ]
+
+def auto_contrast(im_array, DEBUG = True, binning = 1, max_samples = PERCENTILE_SAMPLES):
     """ Rescale the image intensity levels to a reasonable range using the top/bottom 2 percent
         of the data to define the intensity levels
+    PARAMETERS
+        im_array = 2d np array
+        binning = int(); take the percentiles from a downsampled image (every n-th pixel along each axis), see: intensity_percentiles
+        max_samples = int() or None; estimate the percentiles of float images from this many pixels (None for exact)
+    RETURNS
+        im_array = np array (float32) in the range 0 - 255
     """
     import numpy as np
     ## avoid hotspot pixels by looking at a group of pixels at the extreme ends of the image
-    minval = np.percentile(im_array, 2)
-    maxval = np.percentile(im_array, 98)
+    minval, maxval = intensity_percentiles(im_array, (2, 98), max_samples = max_samples, binning = binning)
 
     if DEBUG:
         print("=======================================")
@@ -61,14 +205,22 @@ def auto_contrast(im_array, DEBUG = True):
         print("  input img dim = ", im_array.shape)
         print("  original img min, max = (%s, %s)" % (np.min(im_array), np.max(im_array)))
         print("  stretch to new min, max = (%s %s)" % (minval, maxval))
+        if binning > 1:
+            print("  percentiles from every %s th pixel" % binning)
+        if im_array.dtype.kind == 'f' and max_samples is not None and im_array[::binning, ::binning].size > max_samples:
+            print("  percentiles from %s samples (error < %.2f percentile points)" % (max_samples, sample_percentile_error(max_samples)))
         print("=======================================")
 
-    ## remove pixels above/below the defined limits
-    im_array = np.clip(im_array, minval, maxval)
-    ## rescale the image into the range 0 - 255
-    im_array = ((im_array - minval) / (maxval - minval)) * 255
+    ## remove pixels above/below the defined limits & rescale the image into the range 0 - 255, in a single float32 array
+    im = np.empty(im_array.shape, dtype = np.float32)
+    np.copyto(im, im_array, casting = 'unsafe')
+    np.clip(im, minval, maxval, out = im)
+    np.subtract(im, np.float32(minval), out = im)
+    np.multiply(im, np.float32(255 / (maxval - minval) if maxval > minval else 0), out = im)
+    ## float32 rounding can overshoot 255 by a fraction
+    np.minimum(im, np.float32(255), out = im)
 
-    return im_array
+    return im
 
 def sigma_contrast(im_array, sigma, DEBUG = True):
     """ Rescale the image intensity levels to a range defined by a sigma value (the # of
@@ -106,60 +258,84 @@ def whiten_outliers(im_array, min, max):
     im_array = np.where(im_array > max, 255, im_array)
     return im_array
 
-def extract_boxes(im_array, box_size, coords, DEBUG = True):
+def _box_corners(im_array, box_size, coords):
+    """ Top left corners of the boxes around each coordinate, and whether each box lies fully inside the image
     """
+    import numpy as np
+    box_size_halfwidth = int( box_size / 2)
+    coords = np.asarray(coords).reshape(-1, 2).astype(np.int64)
+    x0 = coords[:, 0] - box_size_halfwidth
+    y0 = coords[:, 1] - box_size_halfwidth
+    ## sanity check we are still in the image after adding/subtracting from the point
+    in_bounds = (x0 >= 0) & (y0 >= 0) & (x0 + 2 * box_size_halfwidth <= im_array.shape[1]) & (y0 + 2 * box_size_halfwidth <= im_array.shape[0])
+    return x0, y0, in_bounds, 2 * box_size_halfwidth
+
+def extract_box_stack(im_array, box_size, coords, DEBUG = False):
+    """ Gather the boxes around all coordinates in a single indexing operation on a sliding window view of the image
     PARAMETERS
-        im_array = np array (0 - 255)
-        box_size = int(); pixel size of the box to extract
-        coords = list( tuple(x, y), ... ); centered coordinates in pixels (top left == 0,0 by convention)
+        im_array = 2d np array
+        box_size = int(); pixel size of the box to extract (odd sizes are rounded down to the nearest even size)
+        coords = list( tuple(x, y), ... ) or np array [ [x1, y1], ... ]; centered coordinates in pixels (top left == 0,0 by convention)
     RETURNS
-        extracted_imgs = list( np arrays of dimension box_size , ... )
+        boxes = np array (n, box_size, box_size); one box per coordinate that lies fully inside the image
+        in_bounds = np array (len(coords),) of bool; False for coordinates too close to the edge (which have no box)
     """
+    import numpy as np
+    x0, y0, in_bounds, box_width = _box_corners(im_array, box_size, coords)
+    windows = np.lib.stride_tricks.sliding_window_view(im_array, (box_width, box_width))
+    boxes = windows[y0[in_bounds], x0[in_bounds]]
+
     if DEBUG:
         print("==============================")
-        print(" Extract boxes:")
+        print(" Extract box stack:")
         print("------------------------------")
         print("   im_array dim = ", im_array.shape)
         print("   box_size = %s px" % box_size)
-        print("   input_coords = %s particles" % len(coords))
-
-
-    extracted_imgs = []
-    too_close_to_edge = 0
-    ## sanity check that not too many coordinates are being asked to be extracted
-    if len(coords) > 500:
-        print(" ERROR :: extracted_boxes is capped at 500 coordinates to avoid memory issues, remove some and re-run")
-        return extracted_imgs
+        print("   input_coords = %s particles" % len(in_bounds))
+        print("   extracted %s boxes, %s particles were too close to edge" % (len(boxes), np.count_nonzero(~in_bounds)))
+        print("==============================")
 
-    box_size_halfwidth = int( box_size / 2)
+    return boxes, in_bounds
 
-    for coordinate in coords:
-        x0 = coordinate[0] - box_size_halfwidth
-        y0 = coordinate[1] - box_size_halfwidth
-        x1 = coordinate[0] + box_size_halfwidth
-        y1 = coordinate[1] + box_size_halfwidth
-        # print(" input coord (x, y) -> (%s, %s)" % (coordinate[0], coordinate[1]))
-        # print(" box_size_halfwidth = %s" % box_size_halfwidth)
-        # print(" x0, x1 // y0, y1 :: %s, %s // %s %s" % (x0, x1, y0, y1))
-
-        ## sanity check we are still in the image after adding/subtracting from the point 
-        if x0 < 0 or y0 < 0:
-            too_close_to_edge += 1
-            continue 
-        elif x1 > im_array.shape[1] or y1 > im_array.shape[0]:
-            too_close_to_edge += 1
-            continue 
-        else:
-            extracted_img = im_array[y0:y1,x0:x1]
-            extracted_imgs.append(extracted_img)
+def sum_boxes(im_array, box_size, coords, mean = False, chunk_size = 1024, DEBUG = False):
+    """ Sum (or average) the boxes around all coordinates without holding all of them in memory at once, i.e. only chunk_size
+        boxes are gathered at a time. Coordinates too close to the edge are skipped, as in extract_box_stack.
+    RETURNS
+        summed = np array (box_size, box_size) of float64; the sum (or mean) of all boxes
+        n = int(); the number of boxes summed
+    """
+    import numpy as np
+    x0, y0, in_bounds, box_width = _box_corners(im_array, box_size, coords)
+    x0, y0 = x0[in_bounds], y0[in_bounds]
+    windows = np.lib.stride_tricks.sliding_window_view(im_array, (box_width, box_width))
+    summed = np.zeros((box_width, box_width), dtype = np.float64)
+    for start in range(0, len(x0), chunk_size):
+        summed += windows[y0[start : start + chunk_size], x0[start : start + chunk_size]].sum(axis = 0, dtype = np.float64)
+    if mean and len(x0) > 0:
+        summed /= len(x0)
 
     if DEBUG:
+        print("==============================")
+        print(" Sum boxes:")
         print("------------------------------")
-        print(" Extracted %s boxes from image" % len(extracted_imgs))
-        print("  %s particles were too close to edge "  % too_close_to_edge)
+        print("   im_array dim = ", im_array.shape)
+        print("   box_size = %s px" % box_size)
+        print("   %s of %s boxes %s, %s particles were too close to edge" % (len(x0), len(in_bounds), 'averaged' if mean else 'summed', np.count_nonzero(~in_bounds)))
         print("==============================")
 
-    return extracted_imgs
+    return summed, len(x0)
+
+def extract_boxes(im_array, box_size, coords, DEBUG = True):
+    """
+    PARAMETERS
+        im_array = np array (0 - 255)
+        box_size = int(); pixel size of the box to extract
+        coords = list( tuple(x, y), ... ); centered coordinates in pixels (top left == 0,0 by convention)
+    RETURNS
+        extracted_imgs = list( np arrays of dimension box_size , ... ); see extract_box_stack for the same boxes as one array
+    """
+    boxes, in_bounds = extract_box_stack(im_array, box_size, coords, DEBUG = DEBUG)
+    return list(boxes)
 
 def find_intensity_range(im_arrays, DEBUG = True):
     """
@@ -313,9 +489,280 @@ def gaussian_disk(diameter, box_size, sigma = 0.2, background_color = 255, disk_
     ## invert the colors as we expect to pick with black signal 
     window = 255 - window
     # print(" window min max = ", window.min(), window.max())
-    window = gaussian_blur(window, 3)
+    window = gaussian_blur(window, 3, DEBUG = False)
     return window
 
+def _window_sums(im_array, window_h, window_w):
+    """ Sum over every (window_h, window_w) window of the input using an integral image (summed-area table)
+    RETURNS
+        sums = np array of shape (h - window_h + 1, w - window_w + 1), i.e. 'valid' windows only
+    """
+    import numpy as np
+    integral = np.zeros((im_array.shape[0] + 1, im_array.shape[1] + 1), dtype = np.float64)
+    np.cumsum(im_array, axis = 0, out = integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis = 1, out = integral[1:, 1:])
+    return integral[window_h:, window_w:] - integral[:-window_h, window_w:] - integral[window_h:, :-window_w] + integral[:-window_h, :-window_w]
+
+def correlate_fft(im_array, template, normalize = False, DEBUG = False):
+    """ FFT-based equivalent of: scipy.signal.correlate2d(im_array, template, boundary = 'symm', mode = 'same')
+        The image is symmetrically padded by the template size (emulating the 'symm' boundary), both arrays are
+        transformed with real FFTs padded to a fast size, and only the 'valid' part of the result is kept, so
+        there is no wrap-around from the circular correlation. Cost is O(N log N) instead of O(N * M) for
+        an image of N pixels and template of M pixels.
+    PARAMETERS
+        im_array = np array of grayscale img
+        template = np array of grayscale template img
+        normalize = bool(); if True, return the normalized cross correlation coefficient (range -1 to 1, as
+                    cv2.TM_CCOEFF_NORMED) using the local mean & variance under each template position,
+                    calculated from integral images
+    RETURNS
+        cc = np array (float64) with the same shape as im_array
+    """
+    import numpy as np
+    from scipy import fft
+
+    im_array = np.asarray(im_array, dtype = np.float64)
+    template = np.asarray(template, dtype = np.float64)
+    im_h, im_w = im_array.shape
+    t_h, t_w = template.shape
+
+    if normalize:
+        ## subtracting the template mean makes the correlation insensitive to the local image mean
+        template = template - template.mean()
+
+    ## pad as correlate2d does for a 'same' output, i.e. the template origin is at ((t_h - 1) // 2, (t_w - 1) // 2)
+    pad_y, pad_x = (t_h - 1) // 2, (t_w - 1) // 2
+    padded = np.pad(im_array, ((pad_y, t_h - 1 - pad_y), (pad_x, t_w - 1 - pad_x)), mode = 'symmetric')
+
+    ## circular correlation over a padded size >= the padded image leaves the 'valid' region uncorrupted
+    fft_shape = [ fft.next_fast_len(n, real = True) for n in padded.shape ]
+    im_fft = fft.rfft2(padded, fft_shape)
+    ## correlation = convolution with the template rotated 180 deg
+    template_fft = fft.rfft2(template[::-1, ::-1], fft_shape)
+    cc = fft.irfft2(im_fft * template_fft, fft_shape)[t_h - 1 : t_h - 1 + im_h, t_w - 1 : t_w - 1 + im_w]
+
+    if normalize:
+        n = t_h * t_w
+        local_sum = _window_sums(padded, t_h, t_w)
+        local_sum_sq = _window_sums(padded * padded, t_h, t_w)
+        ## variance * n under each window, clipped to avoid sqrt of small negative values from rounding
+        local_var = np.maximum(local_sum_sq - (local_sum * local_sum) / n, 0)
+        denominator = np.sqrt(local_var * np.sum(template * template))
+        cc = np.divide(cc, denominator, out = np.zeros_like(cc), where = denominator > 1e-8 * max(1.0, denominator.max()))
+
+    if DEBUG:
+        print("=======================================")
+        print(" image_handler :: correlate_fft")
+        print("---------------------------------------")
+        print("  input img dim = ", im_array.shape)
+        print("  template dim = ", template.shape)
+        print("  padded dim = %s, fft dim = %s" % (padded.shape, fft_shape))
+        print("  normalize = %s" % normalize)
+        print("=======================================")
+
+    return cc
+
+def benchmark_correlate(img_sizes = (256, 512, 1024, 2048), template_sizes = (16, 50, 100), max_direct_size = 256):
+    """ Compare correlate_fft against scipy.signal.correlate2d over a range of image & template sizes.
+        The direct method is only run up to max_direct_size, beyond which it takes minutes per call.
+    """
+    import time
+    import numpy as np
+    from scipy import signal
+
+    rng = np.random.default_rng(0)
+    print("===================================================================================")
+    print(" image_handler :: benchmark_correlate")
+    print("-----------------------------------------------------------------------------------")
+    print("   img   template    correlate2d (s)    correlate_fft (s)    NCC (s)    max rel diff")
+    for img_size in img_sizes:
+        im = rng.integers(0, 256, (img_size, img_size)).astype(np.float64)
+        for template_size in template_sizes:
+            if template_size >= img_size:
+                continue
+            template = rng.integers(0, 256, (template_size, template_size)).astype(np.float64)
+
+            start = time.perf_counter()
+            cc_fft = correlate_fft(im, template)
+            fft_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            correlate_fft(im, template, normalize = True)
+            ncc_time = time.perf_counter() - start
+
+            if img_size <= max_direct_size:
+                start = time.perf_counter()
+                cc_direct = signal.correlate2d(im, template, boundary = 'symm', mode = 'same')
+                direct_time = "%.3f" % (time.perf_counter() - start)
+                ## relative to the map magnitude, as the sums run to ~1e9
+                diff = "%.2e" % (np.max(np.abs(cc_fft - cc_direct)) / np.max(np.abs(cc_direct)))
+            else:
+                direct_time, diff = '--', '--'
+
+            print("  %5s   %5s    %12s     %15.3f     %10.3f     %10s" % (img_size, template_size, direct_time, fft_time, ncc_time, diff))
+    print("===================================================================================")
+    return
+
+def rotate_template(template, angle):
+    """ Rotate a template counter-clockwise (as displayed) about its center, filling the corners with the template mean
+    """
+    import numpy as np
+    import cv2
+    template = np.asarray(template, dtype = np.float32)
+    h, w = template.shape
+    rotation_matrix = cv2.getRotationMatrix2D(((w - 1) / 2, (h - 1) / 2), angle, 1.0)
+    return cv2.warpAffine(template, rotation_matrix, (w, h), flags = cv2.INTER_LINEAR, borderMode = cv2.BORDER_CONSTANT, borderValue = float(template.mean()))
+
+def template_bank_match(im_array, templates, angles = (0,), cancel = None, progress = None, DEBUG = False):
+    """ Normalized cross correlation of an image against a bank of K templates x R in-plane rotations.
+        The image spectrum and the local image statistics are calculated once, so each template/angle
+        only costs a template FFT, a spectrum multiply and an inverse FFT. Templates of different sizes
+        are centered in the largest box, and each is normalized over its own box size.
+        When templates are rotated only the inscribed circle of each template is compared, so that
+        all angles are scored over the same area.
+    PARAMETERS
+        im_array = np array of grayscale img
+        templates = list( np array, ... ) of grayscale templates (or a single np array)
+        angles = list( float(), ... ); in-plane rotations applied to each template (degrees, counter-clockwise)
+        cancel = threading.Event() or None; checked between templates/angles, returns (None, None, None) once set
+        progress = function(str) or None; called with the number of templates/angles matched so far
+    RETURNS
+        best_score = np array (float32) of the max normalized score at each pixel (range -1 to 1), peaks are template centers,
+                     i.e. the pixel (w // 2, h // 2) of the template as in template_match
+        best_template = np array (int16) of the index of the template with that score
+        best_angle = np array (float32) of the rotation of the template with that score
+    """
+    import numpy as np
+    from scipy import fft
+
+    if isinstance(templates, np.ndarray) and templates.ndim == 2:
+        templates = [ templates ]
+    im_array = np.asarray(im_array, dtype = np.float64)
+    im_h, im_w = im_array.shape
+    box_h = max(t.shape[0] for t in templates)
+    box_w = max(t.shape[1] for t in templates)
+    USE_MASK = any(angle % 360 != 0 for angle in angles)
+
+    ## pad & transform the image once for the largest template (see: correlate_fft), with the origin of even-sized
+    ## boxes on the pixel after the middle, as template_match places its picks (int(x + w / 2))
+    origin_y, origin_x = box_h // 2, box_w // 2
+    padded = np.pad(im_array, ((origin_y, box_h - 1 - origin_y), (origin_x, box_w - 1 - origin_x)), mode = 'symmetric')
+    fft_shape = [ fft.next_fast_len(n, real = True) for n in padded.shape ]
+    im_fft = fft.rfft2(padded, fft_shape)
+    padded_sq = padded * padded
+
+    ## local sums are shared by all templates with the same box (and mask)
+    local_norms = dict()
+    def local_norm(shape, mask):
+        key = (shape, mask is not None)
+        if key not in local_norms:
+            h, w = shape
+            ## offset of this box within the padded image, keeping the template origin on the same pixel
+            y0, x0 = origin_y - h // 2, origin_x - w // 2
+            if mask is None:
+                n = h * w
+                local_sum = _window_sums(padded, h, w)[y0 : y0 + im_h, x0 : x0 + im_w]
+                local_sum_sq = _window_sums(padded_sq, h, w)[y0 : y0 + im_h, x0 : x0 + im_w]
+            else:
+                ## masked sums are correlations with the mask
+                n = mask.sum()
+                mask_fft = fft.rfft2(_embed(mask[::-1, ::-1]), fft_shape)
+                local_sum = fft.irfft2(im_fft * mask_fft, fft_shape)[box_h - 1 : box_h - 1 + im_h, box_w - 1 : box_w - 1 + im_w]
+                local_sum_sq = fft.irfft2(fft.rfft2(padded_sq, fft_shape) * mask_fft, fft_shape)[box_h - 1 : box_h - 1 + im_h, box_w - 1 : box_w - 1 + im_w]
+            local_norms[key] = np.sqrt(np.maximum(local_sum_sq - (local_sum * local_sum) / n, 0))
+        return local_norms[key]
+
+    def _embed(kernel):
+        """ Place a (flipped) kernel in the full box so its origin lines up with the box origin
+        """
+        h, w = kernel.shape
+        box = np.zeros((box_h, box_w))
+        ## a flipped kernel has its origin at (h - 1 - h // 2) from the top, the same holds for the box
+        y0 = (box_h - 1 - origin_y) - (h - 1 - h // 2)
+        x0 = (box_w - 1 - origin_x) - (w - 1 - w // 2)
+        box[y0 : y0 + h, x0 : x0 + w] = kernel
+        return box
+
+    best_score = np.full((im_h, im_w), -np.inf, dtype = np.float32)
+    best_template = np.zeros((im_h, im_w), dtype = np.int16)
+    best_angle = np.zeros((im_h, im_w), dtype = np.float32)
+
+    for k, template in enumerate(templates):
+        template = np.asarray(template, dtype = np.float64)
+        h, w = template.shape
+        mask = None
+        if USE_MASK:
+            yy, xx = np.mgrid[:h, :w]
+            radius = min(h, w) / 2
+            mask = ((yy - (h - 1) / 2) ** 2 + (xx - (w - 1) / 2) ** 2 <= radius ** 2).astype(np.float64)
+        norm = local_norm((h, w), mask)
+
+        for a, angle in enumerate(angles):
+            if cancel is not None and cancel.is_set():
+                return None, None, None
+            if progress is not None:
+                progress("%s / %s templates matched" % (k * len(angles) + a, len(templates) * len(angles)))
+            rotated = rotate_template(template, angle) if angle % 360 != 0 else template
+            rotated = np.asarray(rotated, dtype = np.float64)
+            ## zero-mean template (over the mask) makes the correlation insensitive to the local image mean
+            if mask is None:
+                rotated = rotated - rotated.mean()
+            else:
+                rotated = (rotated - rotated[mask > 0].mean()) * mask
+            template_fft = fft.rfft2(_embed(rotated[::-1, ::-1]), fft_shape)
+            cc = fft.irfft2(im_fft * template_fft, fft_shape)[box_h - 1 : box_h - 1 + im_h, box_w - 1 : box_w - 1 + im_w]
+
+            denominator = norm * np.sqrt(np.sum(rotated * rotated))
+            score = np.divide(cc, denominator, out = np.zeros_like(cc), where = denominator > 1e-8 * max(1.0, denominator.max()))
+
+            ## keep the best score, template & angle at each pixel
+            better = score > best_score
+            best_score[better] = score[better]
+            best_template[better] = k
+            best_angle[better] = angle
+
+    if DEBUG:
+        print("=======================================")
+        print(" image_handler :: template_bank_match")
+        print("---------------------------------------")
+        print("  input img dim = ", im_array.shape)
+        print("  templates = %s, max box = (%s, %s)" % (len(templates), box_w, box_h))
+        print("  angles = %s" % list(angles))
+        print("  fft dim = %s" % fft_shape)
+        print("  score min, max = (%.3f, %.3f)" % (best_score.min(), best_score.max()))
+        print("=======================================")
+
+    return best_score, best_template, best_angle
+
+def template_bank_picks(im_array, templates, angles, threshold, box_size = None, exclude = None, cancel = None, progress = None, DEBUG = False):
+    """ Pick an image against a template bank (see: template_bank_match), suppressing peaks within half a box of a better one
+    PARAMETERS
+        box_size = int(); suppression box (px), defaults to the largest template
+        exclude = np array of bool, optional low resolution mask (see: exclusion_mask) of regions not to pick in
+        cancel, progress = see: template_bank_match, returns (None, []) if cancelled
+    RETURNS
+        best_score = np array of the best normalized score at each pixel
+        loc = list( (x, y, score, template_index, angle), ... )
+    """
+    import numpy as np
+    if isinstance(templates, np.ndarray) and templates.ndim == 2:
+        templates = [ templates ]
+    if box_size is None:
+        box_h = max(t.shape[0] for t in templates)
+        box_w = max(t.shape[1] for t in templates)
+    else:
+        box_h = box_w = box_size
+    best_score, best_template, best_angle = template_bank_match(im_array, templates, angles, cancel = cancel, progress = progress, DEBUG = DEBUG)
+    if best_score is None:
+        return None, []
+    ## the bank is matched over the whole image at once (a single FFT), so excluded regions are only left out of the peak search
+    allowed = None if exclude is None else ~expand_mask(exclude, best_score.shape)
+    peaks = non_maximum_suppression(best_score, box_w, box_h, threshold, mask = allowed)
+    loc = [ (x, y, score, int(best_template[y, x]), float(best_angle[y, x])) for x, y, score in peaks ]
+    if DEBUG:
+        print(" %s template bank matches found " % len(loc))
+    return best_score, loc
+
 def template_cross_correlate(im_array, template, threshold, DEBUG = False):
     """
     PARAMETERS
@@ -326,11 +773,11 @@ def template_cross_correlate(im_array, template, threshold, DEBUG = False):
         cc = cross correlation image as a grayscale (0 - 255), note peaks represent positions aligned with top-right of template!
     """
     import numpy as np
-    from scipy import signal
 
     if DEBUG:
         print("Template info: %s, min = %s, max %s" % (template.shape, np.min(template), np.max(template)))
-    cc = signal.correlate2d(im_array, template, boundary='symm', mode='same')
+    ## same map as signal.correlate2d(im_array, template, boundary='symm', mode='same'), computed via FFT
+    cc = correlate_fft(im_array, template, DEBUG = DEBUG)
     ## determine the threshold at which to keep peaks
     cc_min, cc_max = (np.min(cc), np.max(cc))
     cc_range = cc_max - cc_min
@@ -359,6 +806,220 @@ def bool_img(im_array, threshold, DEBUG = False):
     im_array = np.where(im_array >= threshold, 255, 0)
     return im_array
 
+class Pipeline:
+    """
+    A chain of the image processing functions of this module, run over float32 work buffers that are allocated once
+    and reused for every image of the same size. Each stage works in place (or into the second buffer, e.g. for
+    blurring), and the image is only clipped & cast to uint8 at the end. The time (and with profile = True, the peak
+    memory allocated by numpy, see: tracemalloc) of each stage of the last run are kept in .stats.
+    ### USAGE:
+    ```
+        pipeline = Pipeline().sigma_contrast(3).gaussian_blur(1.5).auto_contrast()
+        im = pipeline.run(im_array) ## np array (uint8)
+        pipeline.reset().gaussian_blur(1.5) ## new stages, same buffers
+    ```
+    """
+    def __init__(self, profile = False, DEBUG = False):
+        self.profile = profile
+        self.DEBUG = DEBUG
+        self.steps = [] ## list( tuple(stage name, dict(parameters)), ... )
+        self.buffers = [] ## float32 work buffers of the size of the last image
+        self.mask = None ## bool work buffer
+        self.stats = [] ## list( dict(stage, seconds, peak_bytes), ... ) of the last run
+        self._integer_input = None
+        return
+
+    def reset(self):
+        """ Remove all stages, keeping the work buffers
+        """
+        self.steps = []
+        return self
+
+    def _add(self, stage, **parameters):
+        self.steps.append((stage, parameters))
+        return self
+
+    def sigma_contrast(self, sigma, clamp = False):
+        """ See: sigma_contrast; with clamp = True the limits are kept within 0 - 255 (as for 8-bit input) """
+        return self._add('sigma_contrast', sigma = sigma, clamp = clamp)
+
+    def auto_contrast(self, binning = 1, max_samples = PERCENTILE_SAMPLES):
+        """ See: auto_contrast """
+        return self._add('auto_contrast', binning = binning, max_samples = max_samples)
+
+    def whiten_outliers(self, min, max):
+        """ See: whiten_outliers """
+        return self._add('whiten_outliers', min = min, max = max)
+
+    def gaussian_blur(self, sigma):
+        """ See: gaussian_blur """
+        return self._add('gaussian_blur', sigma = sigma)
+
+    def bool_img(self, threshold):
+        """ See: bool_img """
+        return self._add('bool_img', threshold = threshold)
+
+    def local_contrast(self, box_size, method = 'downsample', clip_limit = 4.0):
+        """ See: local_contrast (works on an 8-bit copy, so this stage is not done in place) """
+        return self._add('local_contrast', box_size = box_size, method = method, clip_limit = clip_limit)
+
+    def _other(self, im):
+        """ The work buffer that is not im, allocated on first use
+        """
+        import numpy as np
+        if len(self.buffers) < 2:
+            self.buffers.append(np.empty_like(self.buffers[0]))
+        return self.buffers[1] if im is self.buffers[0] else self.buffers[0]
+
+    def _percentiles(self, im, percentiles):
+        """ Percentiles of im as np.percentile (linear interpolation), by partitioning a copy in the other work buffer
+        """
+        import numpy as np
+        scratch = self._other(im).reshape(-1)
+        np.copyto(scratch, im.reshape(-1))
+        positions = [ q / 100 * (scratch.size - 1) for q in percentiles ]
+        kth = sorted(set([ int(p) for p in positions ] + [ min(int(p) + 1, scratch.size - 1) for p in positions ]))
+        scratch.partition(kth)
+        values = []
+        for p in positions:
+            below, above = float(scratch[int(p)]), float(scratch[min(int(p) + 1, scratch.size - 1)])
+            values.append(below + (above - below) * (p - int(p)))
+        return values
+
+    def _rescale(self, im, minval, maxval):
+        """ Clip im to (minval, maxval) and stretch that range onto 0 - 255, in place
+        """
+        import numpy as np
+        np.clip(im, minval, maxval, out = im)
+        np.subtract(im, np.float32(minval), out = im)
+        np.multiply(im, np.float32(255 / (maxval - minval) if maxval > minval else 0), out = im)
+        return im
+
+    def _sigma_contrast(self, im, sigma, clamp):
+        import cv2
+        ## single pass (in double precision) without temporary arrays
+        mean, stdev = cv2.meanStdDev(im)
+        mean, stdev = float(mean[0, 0]), float(stdev[0, 0])
+        minval, maxval = mean - (stdev * sigma), mean + (stdev * sigma)
+        if clamp:
+            minval, maxval = max(minval, 0), min(maxval, 255)
+        return self._rescale(im, minval, maxval)
+
+    def _auto_contrast(self, im, binning, max_samples):
+        if self._integer_input is not None:
+            ## the image is still the 8/16-bit input, so take exact percentiles from its histogram
+            minval, maxval = intensity_percentiles(self._integer_input, (2, 98), binning = binning)
+        elif binning > 1 or (max_samples is not None and im.size > max_samples):
+            minval, maxval = intensity_percentiles(im, (2, 98), max_samples = max_samples, binning = binning)
+        else:
+            minval, maxval = self._percentiles(im, (2, 98))
+        return self._rescale(im, minval, maxval)
+
+    def _whiten_outliers(self, im, min, max):
+        import numpy as np
+        if self.mask is None:
+            self.mask = np.empty(im.shape, dtype = bool)
+        np.less(im, min, out = self.mask)
+        np.copyto(im, 255, where = self.mask)
+        np.greater(im, max, out = self.mask)
+        np.copyto(im, 255, where = self.mask)
+        return im
+
+    def _gaussian_blur(self, im, sigma):
+        import cv2
+        ## same kernel extent (4 sigma) & edge handling as scipy.ndimage.gaussian_filter
+        radius = int(4.0 * sigma + 0.5)
+        blurred = self._other(im)
+        cv2.GaussianBlur(im, (2 * radius + 1, 2 * radius + 1), sigma, dst = blurred, sigmaY = sigma, borderType = cv2.BORDER_REFLECT)
+        return blurred
+
+    def _bool_img(self, im, threshold):
+        import numpy as np
+        if self.mask is None:
+            self.mask = np.empty(im.shape, dtype = bool)
+        np.greater_equal(im, threshold, out = self.mask)
+        np.multiply(self.mask, np.float32(255), out = im)
+        return im
+
+    def _local_contrast(self, im, box_size, method, clip_limit):
+        import numpy as np
+        np.copyto(im, local_contrast(im, box_size, method = method, clip_limit = clip_limit))
+        return im
+
+    def run(self, im_array, out = None):
+        """ PARAMETERS
+                im_array = 2d np array of a grayscale image
+                out = np array (uint8) of the same shape to write the result into, or None for a new array
+            RETURNS
+                im = np array (uint8)
+        """
+        import time
+        import numpy as np
+        import tracemalloc
+
+        STARTED_TRACING = False
+        if self.profile and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            STARTED_TRACING = True
+
+        self.stats = []
+        def record(stage, start_time, start_memory):
+            peak_bytes = None
+            if self.profile:
+                peak_bytes = tracemalloc.get_traced_memory()[1] - start_memory
+            self.stats.append(dict(stage = stage, seconds = time.perf_counter() - start_time, peak_bytes = peak_bytes))
+            return
+
+        def start():
+            if self.profile:
+                tracemalloc.reset_peak()
+                return time.perf_counter(), tracemalloc.get_traced_memory()[0]
+            return time.perf_counter(), 0
+
+        start_time, start_memory = start()
+        ## buffers are only reallocated when the image size changes
+        if len(self.buffers) == 0 or self.buffers[0].shape != im_array.shape:
+            self.buffers = [ np.empty(im_array.shape, dtype = np.float32) ]
+            self.mask = None
+        im = self.buffers[0]
+        np.copyto(im, im_array, casting = 'unsafe')
+        record('load', start_time, start_memory)
+
+        ## 8/16-bit input is kept for the statistics of the first stage (see: _auto_contrast)
+        self._integer_input = im_array if im_array.dtype in (np.uint8, np.uint16, np.int8, np.int16) else None
+        for stage, parameters in self.steps:
+            start_time, start_memory = start()
+            im = getattr(self, '_' + stage)(im, **parameters)
+            self._integer_input = None
+            record(stage, start_time, start_memory)
+
+        start_time, start_memory = start()
+        np.clip(im, 0, 255, out = im)
+        if out is None:
+            out = np.empty(im.shape, dtype = np.uint8)
+        np.copyto(out, im, casting = 'unsafe')
+        record('uint8', start_time, start_memory)
+
+        if STARTED_TRACING:
+            tracemalloc.stop()
+        if self.DEBUG:
+            self.report()
+        return out
+
+    def report(self):
+        """ Print the time (and peak memory) of each stage of the last run
+        """
+        print("=======================================")
+        print(" image_handler :: Pipeline")
+        print("---------------------------------------")
+        for stats in self.stats:
+            memory = "" if stats['peak_bytes'] is None else "  peak = %.1f MB" % (stats['peak_bytes'] / 1e6)
+            print("  %-16s %8.2f ms%s" % (stats['stage'], stats['seconds'] * 1000, memory))
+        print("  total            %8.2f ms" % (sum(stats['seconds'] for stats in self.stats) * 1000))
+        print("  work buffers = %.1f MB" % (sum(buffer.nbytes for buffer in self.buffers) / 1e6))
+        print("=======================================")
+        return
+
 def find_local_peaks(im_array, min_area, max_area, INVERT = False, DEBUG = False):
     """
 
@@ -404,9 +1065,256 @@ def find_local_peaks(im_array, min_area, max_area, INVERT = False, DEBUG = False
 
     return coordinates, labeled_img
 
-def template_match(im_array, template_array, input_threshold):
+def non_maximum_suppression(res, box_w, box_h, threshold, mask = None):
+    """ Find all peaks in a correlation map above a threshold, keeping only the highest peak within any box-sized window.
+        Candidates are the local maxima of the map (pixels equal to the maximum of their 3 x 3 neighbourhood), which are then
+        accepted greedily in order of decreasing score, discarding any within half a box of an accepted peak. A peak beaten by
+        a neighbour that is itself suppressed by a better peak is still picked up, as with a minMaxLoc loop that zeroes the
+        window around each pick.
+    PARAMETERS
+        res = np array of the correlation map (e.g. output of cv2.matchTemplate)
+        box_w, box_h = int(); size of the suppression window (px)
+        threshold = float(); minimum score of a peak
+        mask = np array of bool (same shape as res), optional; peaks are only taken where it is True
+    RETURNS
+        peaks = list( (x, y, score), ... ) in order of decreasing score, in pixel positions of res
+    """
+    import numpy as np
+    from scipy import ndimage
+
+    half_w, half_h = box_w // 2, box_h // 2
+    local_max = ndimage.maximum_filter(res, size = 3, mode = 'constant', cval = -np.inf)
+    candidates = (res == local_max) & (res > threshold)
+    if mask is not None:
+        candidates &= mask
+    ys, xs = np.nonzero(candidates)
+    scores = res[ys, xs]
+    order = np.argsort(-scores, kind = 'stable')
+    xs, ys, scores = xs[order], ys[order], scores[order]
+
+    keep = _greedy_suppression(xs, ys, half_w, half_h)
+    return [ (int(xs[i]), int(ys[i]), float(scores[i])) for i in keep ]
+
+def _greedy_suppression(xs, ys, half_w, half_h):
+    """ For points sorted by decreasing score, return the indices of those kept when each accepted point removes
+        all later points within (half_w, half_h) of it
+    """
+    import numpy as np
+    from scipy.spatial import cKDTree
+
+    ## scale each axis by the half-box so a chebyshev (p = inf) radius of 1 matches the suppression window
+    points = np.column_stack((np.asarray(xs) / max(half_w, 0.5), np.asarray(ys) / max(half_h, 0.5)))
+    suppressed = np.zeros(len(points), dtype = bool)
+    keep = []
+    if len(points) > 0:
+        tree = cKDTree(points)
+        for i in range(len(points)):
+            if suppressed[i]:
+                continue
+            keep.append(i)
+            suppressed[tree.query_ball_point(points[i], r = 1, p = np.inf)] = True
+    return keep
+
+def exclusion_mask(im_array, box_size, sigma = EXCLUSION_SIGMA, DEBUG = False):
+    """ A low resolution mask of the regions of a micrograph that are unlike the bulk of it, e.g. carbon, gold or thick ice.
+        The image is binned into cells of about one particle diameter, and the mean & standard deviation of each cell
+        (averaged with its neighbours) are compared against the median over all cells. Cells more than sigma robust standard
+        deviations (1.4826 x median absolute deviation) away in either are excluded, with a border of one cell around them.
+    PARAMETERS
+        im_array = np array of grayscale img
+        box_size = float(); particle diameter (px), i.e. the size of a mask cell
+        sigma = float(); cutoff (robust standard deviations) for a cell to be excluded
+    RETURNS
+        mask = np array of bool (rows, columns of cells), True where excluded. Cells map proportionally onto any image of
+               the micrograph at another scale, see: expand_mask & points_in_mask
+    """
+    import numpy as np
+    import cv2
+
+    im = np.asarray(im_array, dtype = np.float32)
+    im_h, im_w = im.shape
+    grid = (max(1, int(round(im_w / box_size))), max(1, int(round(im_h / box_size))))
+    mean = cv2.resize(im, grid, interpolation = cv2.INTER_AREA)
+    stdev = np.sqrt(np.maximum(cv2.resize(im * im, grid, interpolation = cv2.INTER_AREA) - mean * mean, 0))
+    ## average each cell with its neighbours, so single particles or aggregates do not stand out
+    mean = cv2.blur(mean, (3, 3))
+    stdev = cv2.blur(stdev, (3, 3))
+
+    def robust_z(values):
+        median = np.median(values)
+        spread = 1.4826 * np.median(np.abs(values - median))
+        return (values - median) / max(spread, 1e-6)
+
+    mask = (np.abs(robust_z(mean)) > sigma) | (np.abs(robust_z(stdev)) > sigma)
+    mask = cv2.dilate(mask.astype(np.uint8), np.ones((3, 3), dtype = np.uint8)) > 0
+
+    if DEBUG:
+        print("=======================================")
+        print(" image_handler :: exclusion_mask")
+        print("---------------------------------------")
+        print("  input img dim = ", im_array.shape)
+        print("  cells = %s x %s (%.1f px), sigma = %s" % (grid[0], grid[1], box_size, sigma))
+        print("  excluded = %.1f%% of the image" % (100 * np.count_nonzero(mask) / mask.size))
+        print("=======================================")
+    return mask
+
+def expand_mask(mask, shape):
+    """ Expand a low resolution mask (see: exclusion_mask) to a full size np array of bool of the given (rows, columns)
+    """
+    import numpy as np
+    mask = np.asarray(mask, dtype = bool)
+    rows = np.arange(shape[0]) * mask.shape[0] // shape[0]
+    cols = np.arange(shape[1]) * mask.shape[1] // shape[1]
+    return mask[rows[:, None], cols[None, :]]
+
+def points_in_mask(mask, shape, xs, ys):
+    """ Look up many points at once in a low resolution mask (see: exclusion_mask) of an image of the given (rows, columns)
+    PARAMETERS
+        xs, ys = np arrays (or lists) of pixel positions on that image
+    RETURNS
+        np array of bool, True for each point in a masked cell (points off the image are not masked)
+    """
+    import numpy as np
+    mask = np.asarray(mask, dtype = bool)
+    xs = np.asarray(xs, dtype = np.float64)
+    ys = np.asarray(ys, dtype = np.float64)
+    on_image = (xs >= 0) & (ys >= 0) & (xs < shape[1]) & (ys < shape[0])
+    rows = np.clip(np.floor(ys * mask.shape[0] / shape[0]).astype(np.int64), 0, mask.shape[0] - 1)
+    cols = np.clip(np.floor(xs * mask.shape[1] / shape[1]).astype(np.int64), 0, mask.shape[1] - 1)
+    return on_image & mask[rows, cols]
+
+def _allowed_positions(exclude, im_shape, template_shape):
+    """ For a match map of an image against a template (top-left corner positions, as cv2.matchTemplate), the np array of
+        bool of positions whose template center is not in an excluded cell
+    """
+    template_h, template_w = template_shape
+    res_h, res_w = im_shape[0] - template_h + 1, im_shape[1] - template_w + 1
+    return ~expand_mask(exclude, im_shape)[template_h // 2 : template_h // 2 + res_h, template_w // 2 : template_w // 2 + res_w]
+
+def _masked_match(im, template, allowed, tile_size):
+    """ cv2.matchTemplate (TM_CCOEFF_NORMED) in tiles of the map, skipping tiles without any allowed position (-1 there)
+    """
+    import numpy as np
+    import cv2
+    template_h, template_w = template.shape
+    res = np.full(allowed.shape, -1, dtype = np.float32)
+    for y0 in range(0, res.shape[0], tile_size):
+        for x0 in range(0, res.shape[1], tile_size):
+            y1, x1 = min(y0 + tile_size, res.shape[0]), min(x0 + tile_size, res.shape[1])
+            if not allowed[y0:y1, x0:x1].any():
+                continue
+            res[y0:y1, x0:x1] = cv2.matchTemplate(im[y0 : y1 + template_h - 1, x0 : x1 + template_w - 1], template, cv2.TM_CCOEFF_NORMED)
+    return res
+
+def _match_tile(mrc_data, template, threshold, core, halo, exclude = None):
+    """ Correlate one tile of a (memory-mapped) image and return the peaks whose position falls inside its core
+    PARAMETERS
+        core = tuple(y0, y1, x0, x1); region of the image this tile is responsible for
+        halo = int(); extra border read around the core (>= template size), so the correlation & peak search are exact in the core
+        exclude = np array of bool, optional low resolution mask (see: exclusion_mask) of the whole image, peaks in it are dropped
+    RETURNS
+        peaks = list( (x, y, score), ... ) in image pixels
+    """
+    import numpy as np
+    y0, y1, x0, x1 = core
+    im_h, im_w = mrc_data.shape
+    ry0, ry1 = max(0, y0 - halo), min(im_h, y1 + halo)
+    rx0, rx1 = max(0, x0 - halo), min(im_w, x1 + halo)
+    ## only this slice of the file is read into memory
+    region = np.array(mrc_data[ry0:ry1, rx0:rx1], dtype = np.float32)
+    cc = correlate_fft(region, template, normalize = True)
+    ## correlate_fft puts the template origin at ((h - 1) // 2, (w - 1) // 2), shift even-sized templates by a pixel
+    ## so picks are centered as in template_match (int(x + w / 2))
+    shift_y, shift_x = (template.shape[0] + 1) % 2, (template.shape[1] + 1) % 2
+    peaks = []
+    for x, y, score in non_maximum_suppression(cc, template.shape[1], template.shape[0], threshold):
+        x, y = x + rx0 + shift_x, y + ry0 + shift_y
+        if y0 <= y < y1 and x0 <= x < x1:
+            peaks.append((x, y, score))
+    if exclude is not None and len(peaks) > 0:
+        excluded = points_in_mask(exclude, mrc_data.shape, [ p[0] for p in peaks ], [ p[1] for p in peaks ])
+        peaks = [ peak for peak, masked in zip(peaks, excluded) if not masked ]
+    return peaks
+
+def tiled_template_match(mrc_file, template, threshold, memory_limit = 1024, jobs = 1, exclude = None, DEBUG = True):
+    """ Template match a full-resolution .MRC micrograph in overlapping tiles, so only a few tiles of float data &
+        correlation maps are in memory at any time (the file itself is memory-mapped). Each tile owns a core region
+        and is read with a halo of one template size around it, so scores & local maxima in the core are the same
+        as matching the whole image at once. Peaks from all tiles are then stitched with the same non-maximum
+        suppression used by template_match.
+    PARAMETERS
+        mrc_file = str(); path to a 2D .MRC file
+        template = np array of the template at the pixel size of the .MRC
+        threshold = float(); minimum normalized cross correlation score (0 - 1)
+        memory_limit = float(); approximate cap (MB) on the memory used for tiles, which sets the tile size
+        jobs = int(); number of tiles to match in parallel (threads)
+        exclude = np array of bool, optional low resolution mask (see: exclusion_mask) of regions not to pick in,
+                  tiles whose core is entirely excluded are not read or matched
+    RETURNS
+        loc = list( (x, y, score), ... ) in .MRC pixels, in order of decreasing score
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        import mrcfile
+    except ImportError:
+        print(" ERROR :: mrcfile not installed, try:")
+        print("     pip install mrcfile")
+        ## there is no result to fall back on, so let the caller fail here rather than on a missing list of picks
+        raise
+
+    ## approximate bytes per pixel of a tile held while matching (float image, padded copy, spectra, integral images & maps)
+    BYTES_PER_PIXEL = 120
+
+    template = np.asarray(template, dtype = np.float64)
+    t_h, t_w = template.shape
+    halo = max(t_h, t_w)
+    jobs = max(1, jobs)
+
+    with mrcfile.mmap(mrc_file, mode = 'r', permissive = True) as mrc:
+        mrc_data = mrc.data
+        if mrc_data.ndim == 3:
+            mrc_data = mrc_data[0]
+        im_h, im_w = mrc_data.shape
+
+        ## largest square tile (core + halo) that fits the memory limit for all parallel jobs
+        tile_size = int(np.sqrt(memory_limit * 1024 * 1024 / (BYTES_PER_PIXEL * jobs)))
+        core_size = max(tile_size - 2 * halo, halo)
+        cores = [ (y, min(y + core_size, im_h), x, min(x + core_size, im_w)) for y in range(0, im_h, core_size) for x in range(0, im_w, core_size) ]
+        n_tiles = len(cores)
+        if exclude is not None:
+            allowed = ~expand_mask(exclude, (im_h, im_w))
+            cores = [ core for core in cores if allowed[core[0]:core[1], core[2]:core[3]].any() ]
+
+        if DEBUG:
+            print("=======================================")
+            print(" image_handler :: tiled_template_match")
+            print("---------------------------------------")
+            print("  input mrc = %s, dim = (%s, %s)" % (mrc_file, im_w, im_h))
+            print("  template dim = (%s, %s)" % (t_w, t_h))
+            print("  memory limit = %s MB, jobs = %s" % (memory_limit, jobs))
+            print("  tile core = %s px, halo = %s px, %s tiles (%s skipped as excluded)" % (core_size, halo, len(cores), n_tiles - len(cores)))
+            print("=======================================")
+
+        with ThreadPoolExecutor(max_workers = jobs) as pool:
+            tile_peaks = list(pool.map(lambda core: _match_tile(mrc_data, template, threshold, core, halo, exclude), cores))
+
+    ## stitch the tiles, suppressing any peaks within half a template of a better one across tile borders
+    candidates = sorted([ peak for peaks in tile_peaks for peak in peaks ], key = lambda p: -p[2])
+    keep = _greedy_suppression([ p[0] for p in candidates ], [ p[1] for p in candidates ], t_w // 2, t_h // 2)
+    loc = [ candidates[i] for i in keep ]
+
+    if DEBUG:
+        print(" %s template matches found " % len(loc))
+
+    return loc
+
+def template_match(im_array, template_array, input_threshold, DEBUG = True, levels = 1, margin = None, coarse_threshold = None, exclude = None):
     """
         REF: https://docs.opencv.org/4.x/d4/dc6/tutorial_py_template_matching.html
+        With levels > 1 the image is searched coarse-to-fine, see: pyramid_template_match
+        With an exclusion mask (see: exclusion_mask) the map is calculated in tiles, skipping those that are entirely
+        excluded (-1 in res), and no peaks are taken in excluded regions
     """
     try:
         globals()['cv2'] = __import__('cv2')
@@ -423,52 +1331,399 @@ def template_match(im_array, template_array, input_threshold):
 
     img_w, img_h = im_array.shape[::-1]
     template_w, template_h = template_array.shape[::-1]
-    print(" im array shape = ", im_array.shape)
-    print(" template array shape = ", template_array.shape)
-
-    print("===========================")
-    print("   Image_handler :: template_match")
-    print("---------------------------")
-    print("  input_img :: (x, y) [grayscale range] -> (%s, %s) [%s, %s]" % (img_w, img_h, np.min(im_array), np.max(im_array)))
-    print("  input_template :: (x, y) [grayscale range] -> (%s, %s) [%s, %s]" % (template_w, template_h, np.min(template_array), np.max(template_array)))
-    print("  picking threshold :: %s" % input_threshold)
-    print("===========================")
-
-    res = cv2.matchTemplate(np.uint8(im_array), np.uint8(template_array), cv2.TM_CCOEFF_NORMED)
+    if DEBUG:
+        print(" im array shape = ", im_array.shape)
+        print(" template array shape = ", template_array.shape)
+
+        print("===========================")
+        print("   Image_handler :: template_match")
+        print("---------------------------")
+        print("  input_img :: (x, y) [grayscale range] -> (%s, %s) [%s, %s]" % (img_w, img_h, np.min(im_array), np.max(im_array)))
+        print("  input_template :: (x, y) [grayscale range] -> (%s, %s) [%s, %s]" % (template_w, template_h, np.min(template_array), np.max(template_array)))
+        print("  picking threshold :: %s" % input_threshold)
+        if levels > 1:
+            print("  pyramid levels :: %s" % levels)
+        print("===========================")
+
     threshold = input_threshold
+    if levels > 1:
+        res, peaks = pyramid_template_match(im_array, template_array, threshold, levels = levels, margin = margin, coarse_threshold = coarse_threshold, exclude = exclude, DEBUG = DEBUG)
+    elif exclude is not None:
+        allowed = _allowed_positions(exclude, im_array.shape, template_array.shape)
+        res = _masked_match(np.uint8(im_array), np.uint8(template_array), allowed, max(MATCH_TILE_SIZE, 4 * max(template_w, template_h)))
+        peaks = non_maximum_suppression(res, template_w, template_h, threshold, mask = allowed)
+    else:
+        res = cv2.matchTemplate(np.uint8(im_array), np.uint8(template_array), cv2.TM_CCOEFF_NORMED)
+        peaks = non_maximum_suppression(res, template_w, template_h, threshold)
+    ## matchTemplate positions are the top-left corner of the template, shift them to its center
+    loc = [ (int(x + template_w/2), int(y + template_h/2), score) for x, y, score in peaks ]
 
-    """ REF: https://stackoverflow.com/questions/50579050/template-matching-with-multiple-objects-in-opencv-python/58514954#58514954
-    """
-    # fake out max_val for first run through loop
-    max_val = 1
-    loc = []
-    prev_min_val, prev_max_val, prev_min_loc, prev_max_loc = None, None, None, None
-    while max_val > threshold:
-        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
-        
-        # Prevent infinite loop. If those 4 values are the same as previous ones, break the loop.
-        if prev_min_val == min_val and prev_max_val == max_val and prev_min_loc == min_loc and prev_max_loc == max_loc:
-            break
-        else:
-            prev_min_val, prev_max_val, prev_min_loc, prev_max_loc = min_val, max_val, min_loc, max_loc
-        
-        if max_val > threshold:
-            # Prevent start_row, end_row, start_col, end_col be out of range of image
-            start_row = max(0, max_loc[1] - template_h // 2)
-            start_col = max(0, max_loc[0] - template_w // 2)
-            end_row = min(res.shape[0], max_loc[1] + template_h // 2 + 1)
-            end_col = min(res.shape[1], max_loc[0] + template_w // 2 + 1)
-
-            res[start_row: end_row, start_col: end_col] = 0
-            match = (int(max_loc[0] + template_w/2), int(max_loc[1] + template_h/2), max_val)
-            # print(" point found @ (%s, %s) score = %s" % (match[0], match[1], max_val))
-            loc.append(match)
-
-    print(" %s template matches found " % len(loc))
+    if DEBUG:
+        print(" %s template matches found " % len(loc))
 
     return res, loc
 
+def pyramid_template_match(im_array, template_array, threshold, levels = 3, margin = None, coarse_threshold = None, exclude = None, DEBUG = False):
+    """ Coarse-to-fine template matching. The image & template are reduced levels - 1 times by a factor of 2 (gaussian pyramid)
+        and matched at the coarsest level, with a lower threshold, to find candidates. The full resolution map is then only
+        calculated in a small window (+/- margin px) around the predicted position of each candidate, the best position in the
+        window is kept (re-centering the window once if it lies on its edge), and the refined candidates are suppressed within
+        half a template of a better one as in non_maximum_suppression.
+    PARAMETERS
+        levels = int(); number of pyramid levels, i.e. the coarse search is on a (2 ** (levels - 1))x reduced image
+                 (fewer levels are used if the template would become smaller than 16 px, below which noise gives too many candidates)
+        margin = int(); search radius (full resolution px) around each candidate, defaults to 2x the reduction factor
+        coarse_threshold = float(); threshold for candidates at the coarse level, defaults to 0.6x the threshold
+        exclude = np array of bool, optional low resolution mask (see: exclusion_mask); coarse candidates in excluded regions are not refined
+    RETURNS
+        res = np array of the full resolution correlation map (-1 outside of the searched windows)
+        peaks = list( (x, y, score), ... ) in order of decreasing score, in pixel positions of res (as non_maximum_suppression)
+    """
+    import numpy as np
+    import cv2
+
+    im = np.uint8(im_array)
+    template = np.uint8(template_array)
+    template_h, template_w = template.shape
+
+    ## build the pyramid, stopping before the template gets too small to be meaningful
+    coarse_im, coarse_template = im, template
+    used_levels = 1
+    while used_levels < levels and min(coarse_template.shape) >= 32:
+        coarse_im = cv2.pyrDown(coarse_im)
+        coarse_template = cv2.pyrDown(coarse_template)
+        used_levels += 1
+    factor = 2 ** (used_levels - 1)
+    if margin is None:
+        margin = 2 * factor
+    if coarse_threshold is None:
+        coarse_threshold = 0.6 * threshold
+
+    if factor == 1:
+        ## template too small for a pyramid, search everywhere
+        if DEBUG:
+            print(" pyramid_template_match :: template too small to reduce (%s x %s px), using a single-scale search" % (template_w, template_h))
+        if exclude is not None:
+            allowed = _allowed_positions(exclude, im.shape, template.shape)
+            res = _masked_match(im, template, allowed, max(MATCH_TILE_SIZE, 4 * max(template_w, template_h)))
+            return res, non_maximum_suppression(res, template_w, template_h, threshold, mask = allowed)
+        res = cv2.matchTemplate(im, template, cv2.TM_CCOEFF_NORMED)
+        return res, non_maximum_suppression(res, template_w, template_h, threshold)
+
+    res_h, res_w = im.shape[0] - template_h + 1, im.shape[1] - template_w + 1
+    res = np.full((res_h, res_w), -1, dtype = np.float32)
+    coarse_h, coarse_w = coarse_template.shape
+    coarse_res = cv2.matchTemplate(coarse_im, coarse_template, cv2.TM_CCOEFF_NORMED)
+    candidates = non_maximum_suppression(coarse_res, coarse_w, coarse_h, coarse_threshold)
+    if exclude is not None and len(candidates) > 0:
+        excluded = points_in_mask(exclude, im.shape, [ (x + coarse_w / 2) * factor for x, y, score in candidates ], [ (y + coarse_h / 2) * factor for x, y, score in candidates ])
+        candidates = [ candidate for candidate, masked in zip(candidates, excluded) if not masked ]
+
+    refined = dict() ## { (x, y) : score }
+    searched = 0
+    for x, y, score in candidates:
+        ## predicted top-left corner at full resolution, from the center of the coarse match
+        px = int(round((x + coarse_w / 2) * factor - template_w / 2))
+        py = int(round((y + coarse_h / 2) * factor - template_h / 2))
+        for attempt in range(2):
+            x0, x1 = max(0, px - margin), min(res_w, px + margin + 1)
+            y0, y1 = max(0, py - margin), min(res_h, py + margin + 1)
+            if x0 >= x1 or y0 >= y1:
+                break
+            window = cv2.matchTemplate(im[y0 : y1 + template_h - 1, x0 : x1 + template_w - 1], template, cv2.TM_CCOEFF_NORMED)
+            res[y0:y1, x0:x1] = window
+            searched += window.size
+            wy, wx = np.unravel_index(np.argmax(window), window.shape)
+            px, py = x0 + int(wx), y0 + int(wy)
+            ## a best position on the edge of the window (but not of the image) may be the slope of a peak just outside it
+            on_edge = (wx == 0 and x0 > 0) or (wx == window.shape[1] - 1 and x1 < res_w) or (wy == 0 and y0 > 0) or (wy == window.shape[0] - 1 and y1 < res_h)
+            if not on_edge:
+                break
+        if x0 < x1 and y0 < y1 and res[py, px] > threshold:
+            if exclude is not None and points_in_mask(exclude, im.shape, [ px + template_w // 2 ], [ py + template_h // 2 ])[0]:
+                continue
+            refined[(px, py)] = float(res[py, px])
+
+    ## suppress refined candidates within half a template of a better one
+    positions = sorted(refined, key = lambda p: -refined[p])
+    xs = np.array([ p[0] for p in positions ], dtype = np.int64)
+    ys = np.array([ p[1] for p in positions ], dtype = np.int64)
+    keep = _greedy_suppression(xs, ys, template_w // 2, template_h // 2)
+    peaks = [ (int(xs[i]), int(ys[i]), refined[positions[i]]) for i in keep ]
+
+    if DEBUG:
+        print("=======================================")
+        print(" image_handler :: pyramid_template_match")
+        print("---------------------------------------")
+        print("  levels = %s (coarse search at 1/%s size)" % (used_levels, factor))
+        print("  coarse threshold = %.3f, margin = %s px" % (coarse_threshold, margin))
+        print("  %s candidates, %.1f%% of the map searched" % (len(candidates), 100 * searched / res.size))
+        print("=======================================")
 
+    return res, peaks
+
+def benchmark_pyramid(img_size = 2048, particle_diameters = (32, 64, 128), levels = (2, 3, 4), threshold = 0.3, n_particles = 200):
+    """ Compare pyramid template matching against a single-scale search on synthetic images of gaussian disk 'particles' in noise.
+        Recall is the fraction of the single-scale picks that the pyramid search also finds (within 2 px).
+            $ image_handler.py --benchmark_pyramid
+    """
+    import time
+    import numpy as np
+    from scipy.spatial import cKDTree
+
+    rng = np.random.default_rng(0)
+    print("===================================================================================")
+    print(" image_handler :: benchmark_pyramid (%s px image, threshold = %s)" % (img_size, threshold))
+    print("-----------------------------------------------------------------------------------")
+    print("   diameter   levels    single-scale (s)    pyramid (s)    speedup    picks    recall")
+    for diameter in particle_diameters:
+        box_size = int(diameter * 1.4)
+        template = gaussian_disk(diameter, box_size, background_color = 160, disk_color = 90)
+        im = np.full((img_size, img_size), 160, dtype = np.float32)
+        for x, y in rng.integers(box_size, img_size - box_size, (n_particles, 2)):
+            im[y - box_size // 2 : y - box_size // 2 + box_size, x - box_size // 2 : x - box_size // 2 + box_size] = np.minimum(im[y - box_size // 2 : y - box_size // 2 + box_size, x - box_size // 2 : x - box_size // 2 + box_size], template)
+        im = np.clip(im + rng.normal(0, 40, im.shape), 0, 255).astype(np.uint8)
+
+        start = time.perf_counter()
+        res, single_loc = template_match(im, template, threshold, DEBUG = False)
+        single_time = time.perf_counter() - start
+        for level in levels:
+            start = time.perf_counter()
+            res, pyramid_loc = template_match(im, template, threshold, DEBUG = False, levels = level)
+            pyramid_time = time.perf_counter() - start
+            recall = 1.0
+            if len(single_loc) > 0:
+                if len(pyramid_loc) > 0:
+                    distances, indices = cKDTree([ (x, y) for x, y, score in pyramid_loc ]).query([ (x, y) for x, y, score in single_loc ])
+                    recall = np.count_nonzero(distances <= 2) / len(single_loc)
+                else:
+                    recall = 0.0
+            print("   %8s   %6s    %16.3f    %11.3f    %6.1fx    %5s    %5.1f%%" % (diameter, level, single_time, pyramid_time, single_time / pyramid_time, "%s/%s" % (len(pyramid_loc), len(single_loc)), 100 * recall))
+    print("===================================================================================")
+    return
+
+def check_non_maximum_suppression(n_images = 5, img_size = 1500, box_size = 40, threshold = 0.2, n_particles = 1500):
+    """ Compare non_maximum_suppression against the minMaxLoc loop it replaced (pick the best pixel, zero the box around it,
+        repeat) on seeded synthetic images of gaussian disk 'particles' in noise. A pick of the loop is missed if it is a
+        local maximum of the correlation map (5 x 5) and more than half a box away from every peak non_maximum_suppression keeps.
+            $ image_handler.py --check_nms
+        RETURNS
+            True if no such picks are missed on any image
+    """
+    import time
+    import numpy as np
+    import cv2
+    from scipy import ndimage
+
+    def minmaxloc_peaks(res, box_w, box_h, threshold):
+        res = res.copy()
+        peaks = []
+        while True:
+            min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
+            if max_val <= threshold:
+                break
+            res[max(0, max_loc[1] - box_h // 2) : max_loc[1] + box_h // 2 + 1, max(0, max_loc[0] - box_w // 2) : max_loc[0] + box_w // 2 + 1] = 0
+            peaks.append((max_loc[0], max_loc[1], max_val))
+        return peaks
+
+    rng = np.random.default_rng(0)
+    template = gaussian_disk(int(box_size / 1.4), box_size, background_color = 160, disk_color = 90)
+    all_passed = True
+    print("===================================================================================")
+    print(" image_handler :: check_non_maximum_suppression (%s px images, %s px template, threshold = %s)" % (img_size, box_size, threshold))
+    print("-----------------------------------------------------------------------------------")
+    print("   image    loop picks (s)    nms picks (s)    missed local maxima")
+    for i in range(n_images):
+        im = np.full((img_size, img_size), 160, dtype = np.float32)
+        for x, y in rng.integers(box_size, img_size - box_size, (n_particles, 2)):
+            window = im[y - box_size // 2 : y - box_size // 2 + box_size, x - box_size // 2 : x - box_size // 2 + box_size]
+            window[...] = np.minimum(window, template)
+        im = np.clip(im + rng.normal(0, 40, im.shape), 0, 255).astype(np.uint8)
+        res = cv2.matchTemplate(im, np.uint8(template), cv2.TM_CCOEFF_NORMED)
+
+        start = time.perf_counter()
+        loop_peaks = minmaxloc_peaks(res, box_size, box_size, threshold)
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        peaks = non_maximum_suppression(res, box_size, box_size, threshold)
+        nms_time = time.perf_counter() - start
+
+        local_max = ndimage.maximum_filter(res, size = 5, mode = 'constant', cval = -np.inf) == res
+        kept = np.array([ (x, y) for x, y, score in peaks ], dtype = np.int64).reshape(-1, 2)
+        missed = 0
+        for x, y, score in loop_peaks:
+            if not local_max[y, x]:
+                continue
+            if len(kept) == 0 or np.min(np.max(np.abs(kept - (x, y)), axis = 1)) > box_size // 2:
+                missed += 1
+        all_passed = all_passed and missed == 0
+        print("   %5s    %5s (%.3f)    %5s (%.3f)    %s" % (i, len(loop_peaks), loop_time, len(peaks), nms_time, missed))
+    if not all_passed:
+        print(" FAIL :: non_maximum_suppression misses local maxima the minMaxLoc loop picks")
+    print("===================================================================================")
+    return all_passed
+
+def check_template_bank(img_size = 800, box_sizes = (28, 29, 30, 41, 56), threshold = 0.3):
+    """ Check that template_bank_picks with a single template at angle 0 gives the same picks as template_match, for even &
+        odd template sizes, on seeded synthetic images of separated gaussian disk 'particles' in weak noise:
+            $ image_handler.py --check_bank
+        RETURNS
+            True if the picks are identical for every template size
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    all_passed = True
+    print("===================================================================================")
+    print(" image_handler :: check_template_bank (%s px images, threshold = %s)" % (img_size, threshold))
+    print("-----------------------------------------------------------------------------------")
+    print("   template    template_match    template_bank_picks    identical")
+    for box_size in box_sizes:
+        template = gaussian_disk(int(box_size / 1.4), box_size, background_color = 160, disk_color = 90)
+        im = np.full((img_size, img_size), 160, dtype = np.float32)
+        ## one particle per cell of a grid, jittered, so that no two particles compete for a pick
+        for grid_y in range(box_size, img_size - box_size, 2 * box_size):
+            for grid_x in range(box_size, img_size - box_size, 2 * box_size):
+                x, y = grid_x + rng.integers(-(box_size // 4), box_size // 4 + 1), grid_y + rng.integers(-(box_size // 4), box_size // 4 + 1)
+                window = im[y - box_size // 2 : y - box_size // 2 + box_size, x - box_size // 2 : x - box_size // 2 + box_size]
+                window[...] = np.minimum(window, template)
+        im = np.clip(im + rng.normal(0, 10, im.shape), 0, 255).astype(np.uint8)
+
+        res, loc = template_match(im, template, threshold, DEBUG = False)
+        best_score, bank_loc = template_bank_picks(im, [ template ], [ 0 ], threshold)
+        identical = sorted((x, y) for x, y, score in loc) == sorted((x, y) for x, y, score, template_index, angle in bank_loc)
+        all_passed = all_passed and identical
+        print("   %8s    %14s    %19s    %9s" % (box_size, len(loc), len(bank_loc), identical))
+    if not all_passed:
+        print(" FAIL :: template_bank_picks & template_match pick different positions")
+    print("===================================================================================")
+    return all_passed
+
+def benchmark_local_contrast(img_size = 1024, particle_diameters = (8, 16, 32, 64), clip_limits = (2.0, 4.0, 40.0), n_particles = 200):
+    """ Compare the speed of the local contrast methods, and how close the fast methods come to the exact 'rank' method,
+        on synthetic images of gaussian disk 'particles' in noise over an uneven (ice gradient) background.
+            $ image_handler.py --benchmark_local_contrast
+    """
+    import time
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    print("===================================================================================")
+    print(" image_handler :: benchmark_local_contrast (%s px image)" % img_size)
+    print("-----------------------------------------------------------------------------------")
+    print("   diameter    method          time (s)    speedup    correlation    mean abs diff")
+    y, x = np.mgrid[0:img_size, 0:img_size] / img_size
+    background = 100 + 80 * np.sin(2 * x + 1) * np.cos(3 * y)
+    for diameter in particle_diameters:
+        box_size = int(diameter * 1.4)
+        template = gaussian_disk(diameter, box_size, background_color = 0, disk_color = 255).astype(np.float32) / 255
+        im = background.copy()
+        for px, py in rng.integers(box_size, img_size - box_size, (n_particles, 2)):
+            im[py - box_size // 2 : py - box_size // 2 + box_size, px - box_size // 2 : px - box_size // 2 + box_size] -= 30 * template
+        im = np.clip(im + rng.normal(0, 20, im.shape), 0, 255).astype(np.uint8)
+
+        start = time.perf_counter()
+        exact = local_contrast(im, diameter, method = 'rank').astype(np.float64)
+        exact_time = time.perf_counter() - start
+        print("   %8s    %-12s    %8.3f    %6s     %10s    %13s" % (diameter, 'rank', exact_time, '--', '--', '--'))
+        runs = [ ('downsample', None) ] + [ ('clahe', clip_limit) for clip_limit in clip_limits ]
+        for method, clip_limit in runs:
+            start = time.perf_counter()
+            if clip_limit is None:
+                im_out = local_contrast(im, diameter, method = method)
+            else:
+                im_out = local_contrast(im, diameter, method = method, clip_limit = clip_limit)
+            run_time = time.perf_counter() - start
+            im_out = im_out.astype(np.float64)
+            correlation = np.corrcoef(exact.ravel(), im_out.ravel())[0, 1]
+            label = method if clip_limit is None else "%s %s" % (method, clip_limit)
+            print("   %8s    %-12s    %8.3f    %6.1fx     %10.3f    %13.1f" % (diameter, label, run_time, exact_time / run_time, correlation, np.mean(np.abs(exact - im_out))))
+    print("===================================================================================")
+    return
+
+def benchmark_pipeline(img_sizes = (1024, 2048, 4096), repeats = 5):
+    """ Compare the time & peak memory of a chain of the processing functions of this module (as called from the GUI, cast
+        to uint8 at the end) with the same chain as a Pipeline, and how many pixel values differ between them.
+            $ image_handler.py --benchmark_pipeline
+    """
+    import time
+    import tracemalloc
+    import numpy as np
+
+    def chained(im):
+        im = sigma_contrast(im, 3, DEBUG = False)
+        im = gaussian_blur(im, 1.5, DEBUG = False)
+        im = auto_contrast(im, DEBUG = False)
+        return np.clip(im, 0, 255).astype(np.uint8)
+
+    def measure(function, im):
+        times = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            function(im)
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        result = function(im)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, np.median(times), peak
+
+    rng = np.random.default_rng(0)
+    print("===================================================================================")
+    print(" image_handler :: benchmark_pipeline (sigma_contrast > gaussian_blur > auto_contrast)")
+    print("-----------------------------------------------------------------------------------")
+    print("   img size    method       time (s)    speedup    peak memory (MB)    pixels differing")
+    for img_size in img_sizes:
+        im = np.clip(rng.normal(128, 30, (img_size, img_size)), 0, 255).astype(np.uint8)
+        pipeline = Pipeline().sigma_contrast(3).gaussian_blur(1.5).auto_contrast()
+        ## the first run allocates the work buffers, later images of the same size reuse them
+        pipeline.run(im)
+        reference, chained_time, chained_peak = measure(chained, im)
+        result, pipeline_time, pipeline_peak = measure(pipeline.run, im)
+        differing = np.count_nonzero(reference != result) / reference.size
+        print("   %8s    %-9s    %8.3f    %6s     %16.1f    %16s" % (img_size, 'chained', chained_time, '--', chained_peak / 1e6, '--'))
+        print("   %8s    %-9s    %8.3f    %6.1fx     %16.1f    %15.2f%%" % (img_size, 'Pipeline', pipeline_time, chained_time / pipeline_time, pipeline_peak / 1e6, 100 * differing))
+    print("===================================================================================")
+    return
+
+def benchmark_auto_contrast(img_sizes = (1024, 4096), repeats = 3):
+    """ Compare the time of the auto_contrast percentiles with np.percentile on the full image, and their error (in
+        percentile points, i.e. the percentage of pixels between each estimate and the exact value), for 8-bit & float images.
+            $ image_handler.py --benchmark_auto_contrast
+    """
+    import time
+    import numpy as np
+
+    def measure(function):
+        times = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            values = function()
+            times.append(time.perf_counter() - start)
+        return values, np.median(times)
+
+    rng = np.random.default_rng(0)
+    print("===================================================================================")
+    print(" image_handler :: benchmark_auto_contrast (2 & 98 th percentiles)")
+    print("-----------------------------------------------------------------------------------")
+    print("   img size    dtype      method               time (s)    speedup    error (percentile points)")
+    for img_size in img_sizes:
+        float_im = rng.normal(0, 1, (img_size, img_size)).astype(np.float32)
+        float_im += np.linspace(-1, 1, img_size, dtype = np.float32) ## uneven background
+        uint8_im = np.clip(64 * float_im + 128, 0, 255).astype(np.uint8)
+        for im in [ uint8_im, float_im ]:
+            reference, reference_time = measure(lambda: [ np.percentile(im, 2), np.percentile(im, 98) ])
+            print("   %8s    %-7s    %-18s    %8.3f    %6s     %s" % (img_size, im.dtype, 'np.percentile', reference_time, '--', '--'))
+            for binning in [ 1, 4 ]:
+                values, run_time = measure(lambda: intensity_percentiles(im, (2, 98), binning = binning))
+                error = max(100 * np.mean((im > min(value, exact)) & (im < max(value, exact))) for value, exact in zip(values, reference))
+                method = 'histogram' if im.dtype == np.uint8 else 'sampled'
+                if binning > 1:
+                    method += ' (bin %s)' % binning
+                print("   %8s    %-7s    %-18s    %8.3f    %6.1fx     %.3f" % (img_size, im.dtype, method, run_time, reference_time / run_time, error))
+    print("  sampled percentiles are within %.2f percentile points (99.9 %% confidence)" % sample_percentile_error(PERCENTILE_SAMPLES))
+    print("===================================================================================")
+    return
 
 #############################################
 ##  RUN BLOCK
@@ -478,6 +1733,40 @@ if __name__ == "__main__":
     import sys, os
     from tkinter import *
 
+    ## compare the FFT & direct cross correlation methods via:
+    ##      $ image_handler.py  --benchmark
+    if '--benchmark' in sys.argv:
+        benchmark_correlate()
+        sys.exit()
+    ## compare coarse-to-fine & single-scale template matching via:
+    ##      $ image_handler.py  --benchmark_pyramid
+    if '--benchmark_pyramid' in sys.argv:
+        benchmark_pyramid()
+        sys.exit()
+    ## check the vectorized peak finding against the minMaxLoc loop via:
+    ##      $ image_handler.py  --check_nms
+    if '--check_nms' in sys.argv:
+        sys.exit(0 if check_non_maximum_suppression() else 1)
+    ## check the template bank picks against template_match via:
+    ##      $ image_handler.py  --check_bank
+    if '--check_bank' in sys.argv:
+        sys.exit(0 if check_template_bank() else 1)
+    ## compare the speed & quality of the local contrast methods via:
+    ##      $ image_handler.py  --benchmark_local_contrast
+    if '--benchmark_local_contrast' in sys.argv:
+        benchmark_local_contrast()
+        sys.exit()
+    ## compare the processing functions chained one by one with a Pipeline via:
+    ##      $ image_handler.py  --benchmark_pipeline
+    if '--benchmark_pipeline' in sys.argv:
+        benchmark_pipeline()
+        sys.exit()
+    ## compare the auto_contrast percentiles with np.percentile via:
+    ##      $ image_handler.py  --benchmark_auto_contrast
+    if '--benchmark_auto_contrast' in sys.argv:
+        benchmark_auto_contrast()
+        sys.exit()
+
     from PIL import Image as PIL_Image
     g = gaussian_disk(150, 200, background_color = 100, disk_color = 70)
     img = PIL_Image.fromarray(g).convert('L')
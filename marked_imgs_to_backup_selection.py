@@ -2,6 +2,7 @@
 
 ## 2019-04-24: Wrote script
 ## 2020-11-11: Adapt script to work with reworked GIF_dataset_curator.py program
+## 2026-10-19: Use hash sets & stream the input .STAR file for large datasets, accept multiple marked lists and input files
 
 """
     The RELION Select job uses a simple backup_selection.star file to label micrographs as either
@@ -15,6 +16,11 @@
             ...
     And based on the input .STAR file to the Select job return a 'backup_selection.star' file
     with micrographs corresponding to those in the list are set as not selected.
+
+    Any number of marked lists (.txt) and input .STAR files can be given, e.g.:
+        $ marked_imgs_to_backup_selection.py  marked_imgs.txt  marked_imgs_2.txt  CtfFind/job003/micrographs_ctf.star
+    All marked lists are merged into a single set. With one input .STAR file the output is written to
+    'backup_selection.star', with several they are numbered in the order given (e.g. 'backup_selection_001.star').
 """
 
 #############################
@@ -24,99 +30,54 @@
 def usage():
     """ This script requires several input arguments to work correctly. Check they exist, otherwise print usage and exit.
     """
-    if not len(sys.argv) == 3:
-        print("=================================================================================================================")
-        print(" Create a 'backup_selection.star' file for a Select job (with CtfFind 'micrographs_ctf.star' as the input) ")
-        print(" from a given list of bad micrographs, where listed micrographs in the file are set as inactive.")
-        print(" Copy the output 'backup_selection.star' file into the Select job directory and run the job to implement.")
-        print("=================================================================================================================")
-        print(" USAGE:")
-        print("    $ marked_imgs_to_backup_selection.py  marked_imgs.txt  /path/to/micrographs_ctf.star")
-        print("=================================================================================================================")
-        sys.exit()
-    else:
-        return
-
-def parse_select_job_input_file(file):
-    """ INPUT
-            file = micrographs_ctf.star file used as input to the Select job
+    print("=================================================================================================================")
+    print(" Create a 'backup_selection.star' file for a Select job (with CtfFind 'micrographs_ctf.star' as the input) ")
+    print(" from a given list of bad micrographs, where listed micrographs in the file are set as inactive.")
+    print(" Copy the output 'backup_selection.star' file into the Select job directory and run the job to implement.")
+    print("=================================================================================================================")
+    print(" USAGE:")
+    print("    $ marked_imgs_to_backup_selection.py  marked_imgs.txt  /path/to/micrographs_ctf.star")
+    print(" Multiple marked lists (.txt) and input .star files may be given, each input gets its own numbered output file")
+    print("=================================================================================================================")
+    sys.exit()
+
+def read_input(cmdline):
+    """ Sort the commandline arguments into marked lists (.txt) and input .STAR files
         RETURNS
-            ordered_list_of_micrographs = list of entries as they appear in the input file, e.g.: [ _rlnMicrographName1, _rlnMicrographName2, ... ]
-    """
-
-    print(" >>> PARSING %s" % file)
-    print("========================")
-
-    ## initialize the list that will hold the name of each micrograph in the .star file
-    ordered_list_of_micrographs = []
-
-    with open(file, 'r') as f :
-        line_num = 0
-
-        line_num_rlnMicrographName = -1 ## line corresponding to the header that gives the column number
-        line_num_data_begins = -1 ## line corresponding to the first data entry to read
-
-        FIRST_LINE = True ## flag to trigger when found the first line after the header that is not empty
-
-        for line in f :
-            line_num += 1
-
-            if "_rlnMicrographName" in line:
-                line_num_rlnMicrographName = line_num
-                column_num_rlnMicrographName = int(line.split()[1].replace("#",""))
-                print(" _rlnMicrographName column number = ", column_num_rlnMicrographName)
-
-            ## find the line number for the first data entry
-            if ( line_num > line_num_rlnMicrographName ) and ( line_num_rlnMicrographName > 0 ):
-                if not is_first_char(line, "_") and FIRST_LINE:
-                    line_num_data_begins = line_num
-                    print(" First data entry after header is on line = ", line_num_data_begins)
-                    print("     FIRST DATA ENTRY : %s ..." % line[:65])
-                    FIRST_LINE = False ## consume the flag
-
-            ## parse the order of the micrographs as they appear by name in the star file
-            if not FIRST_LINE and ( line_num >= line_num_data_begins ):
-                current_micrograph_name = find_star_info(line, column_num_rlnMicrographName) ## false if no name found
-                if (current_micrograph_name): ## avoids empty lines being added
-                    ordered_list_of_micrographs.append(current_micrograph_name)
-                    # print("MICROGRAPH NAME ADDED TO LIST : ", current_micrograph_name)
-        print(" %s micrographs detected in star file" % len(ordered_list_of_micrographs))
-
-        return ordered_list_of_micrographs
-
-def is_first_char(input_string, char):
-    """ INPUT:
-            input_string = string of any length, typically a line in a file being parsed
-            char = string of the character we want to compare with to determine a match
-        RETURN:
-            True  ; if char == first character in input_string
-            False ; if char != first character in input_string, or if input_string is empty
+            marked_files = list( str(), ... )
+            star_files = list( str(), ... )
     """
-    input_string = input_string.strip() # remove empty spaces around string
-
-    if len(input_string) == 0 :
-        return False
-    if ( input_string[0] == char ):
-        return True
-    return False
-
-def find_star_info(line, column):
-    """ For a given .STAR file line entry, extract the data at the given column index.
-        If the column does not exist (e.g. for a header line read in), return 'False'
+    marked_files = []
+    star_files = []
+    for arg in cmdline[1:]:
+        if arg in ['-h', '--h', '--help']:
+            usage()
+        extension = os.path.splitext(arg)[1].lower()
+        if extension == '.txt':
+            marked_files.append(arg)
+        elif extension == '.star':
+            star_files.append(arg)
+        else:
+            print(" ERROR :: Unrecognized input (expected .txt or .star): %s" % arg)
+            usage()
+
+    if len(marked_files) == 0 or len(star_files) == 0:
+        usage()
+
+    return marked_files, star_files
+
+def micrograph_key(mic_name):
+    """ Micrographs are compared by their basename without extension, e.g.:
+            MotionCorr/job002/Movies/mic_0001.mrc -> mic_0001
+            mic_0001.jpg -> mic_0001
     """
-    # break an input line into a list data type for column-by-column indexing
-    line_to_list = line.split()
-    try:
-        column_value = line_to_list[column-1]
-        return column_value
-    except:
-        return False
+    return os.path.splitext(os.path.basename(mic_name))[0]
 
-def parse_mics_from_file(file):
-    """ Load a list of micrograph names from a file
+def parse_mics_from_file(file, mic_set = None):
+    """ Load micrograph names from a file into a set, optionally adding to an existing set
 
         RETURNS
-            mic_list : list of strings, e.g. [ 'mic_name1', 'mic_name2', ... ]
+            mic_set : set of strings, e.g. { 'mic_name1', 'mic_name2', ... }
     """
 
     print("========================")
@@ -124,7 +85,10 @@ def parse_mics_from_file(file):
     print("========================")
 
     ## initialize a fresh variable to hold the names of each micrograph
-    mic_list = []
+    if mic_set is None:
+        mic_set = set()
+    previous_size = len(mic_set)
+
     with open(file,'r') as f :
         for line in f :
             line = line.strip()
@@ -134,19 +98,45 @@ def parse_mics_from_file(file):
             # comment handling
             elif line[0] == "#":
                 pass
-            elif len(line) > 0 :
-                if line not in mic_list:
-                    mic_list.append(line)
-    print(" %s micrographs found in list" % len(mic_list) )
-    return mic_list
+            else:
+                ## in cases where multiple entries exist per line, take only the first entry
+                mic_set.add(micrograph_key(line.split()[0]))
+    print(" %s new micrographs found in list (%s total)" % (len(mic_set) - previous_size, len(mic_set)))
+    return mic_set
+
+def find_micrograph_column(file):
+    """ Find the _rlnMicrographName column of the micrographs table of the input .STAR file, supporting both
+        RELION v3.1+ ('data_micrographs') and older ('data_') layouts.
+        RETURNS
+            column_num = int()
+            data_start = int(); line number of the first data entry
+    """
+    for table_title in ['data_micrographs', 'data_']:
+        columns, data_start = star_handler.get_star_columns(file, table_title)
+        if '_rlnMicrographName' in columns:
+            print(" _rlnMicrographName column number = %s (table '%s')" % (columns['_rlnMicrographName'], table_title))
+            return columns['_rlnMicrographName'], data_start
+
+    print(" ERROR :: Input .STAR file: %s, is missing a column for: _rlnMicrographName" % file)
+    sys.exit()
 
-def write_backup_selection(ordered_list_of_micrographs, marked_micrographs_list):
+def write_backup_selection(select_job_input_file, marked_micrographs, output_file = "backup_selection.star"):
+    """ Stream the input .STAR file and write one selection flag per micrograph, in the order they appear
+        RETURNS
+            selected = int()
+            unselected = int()
+    """
 
     print("========================")
-    print(" >>> WRITING NEW 'backup_selection.star'")
+    print(" >>> WRITING '%s' for %s" % (output_file, select_job_input_file))
     print("========================")
 
-    with open("backup_selection.star", 'w') as f :  # mode 'w' overwrites any existing file, if present
+    column_num, data_start = find_micrograph_column(select_job_input_file)
+    column_index = column_num - 1
+
+    selected = 0
+    unselected = 0 ## keep track of the number of micrographs unselected by this function
+    with open(output_file, 'w') as f :  # mode 'w' overwrites any existing file, if present
         ############
         ## HEADER
         ############
@@ -159,43 +149,57 @@ def write_backup_selection(ordered_list_of_micrographs, marked_micrographs_list)
         ############
         ## BODY
         ############
-        counter = 0 ## iterator to keep track of the number of micrographs unselected by this function
-        for mic in ordered_list_of_micrographs:
-            mic_path_removed = os.path.basename(mic)
-            mic_path_removed_no_extension = os.path.splitext(mic_path_removed)[0]
-            if mic_path_removed_no_extension in marked_micrographs_list:
+        for row in star_handler.iter_star_rows(select_job_input_file, data_start):
+            if micrograph_key(row[column_index]) in marked_micrographs:
                 ## if the micrograph name appears in the marked list, set its value to '0' (e.g. not selected)
                 f.write("\t0\n")
-                counter += 1
+                unselected += 1
             else:
                 ## if the micrograph is not in the marked list, set its value to '1' (E.g. selected)
                 f.write("\t1\n")
+                selected += 1
 
-        print(" %s micrographs of %s total were set as unselected" % (counter, len(ordered_list_of_micrographs)) )
+    print(" %s micrographs of %s total were set as unselected" % (unselected, selected + unselected))
+    return selected, unselected
 
 #############################
 ###     RUN BLOCK
 #############################
 
 if __name__ == "__main__":
-    import string
     import os
     import sys
 
-    usage()
+    ## Get the execution path of this script so we can find local modules
+    script_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    try:
+        sys.path.append(script_path)
+        import star_handler
+    except :
+        print(" ERROR :: Check if star_handler.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
+        sys.exit()
 
-    # read bash arguments $1 and $2 as variables
-    marked_img_file = sys.argv[1]
-    select_job_input_file = sys.argv[2]
+    marked_img_files, select_job_input_files = read_input(sys.argv)
 
     print("... Running job")
     print("========================")
 
-    ordered_micrographs = parse_select_job_input_file(select_job_input_file)
-
-    micrographs_in_marked_img_file = parse_mics_from_file(marked_img_file)
+    micrographs_in_marked_img_files = set()
+    for marked_img_file in marked_img_files:
+        parse_mics_from_file(marked_img_file, micrographs_in_marked_img_files)
 
-    write_backup_selection(ordered_micrographs, micrographs_in_marked_img_file)
+    summary = []
+    for i in range(len(select_job_input_files)):
+        if len(select_job_input_files) == 1:
+            output_file = "backup_selection.star"
+        else:
+            output_file = "backup_selection_%03d.star" % (i + 1)
+        selected, unselected = write_backup_selection(select_job_input_files[i], micrographs_in_marked_img_files, output_file)
+        summary.append((select_job_input_files[i], output_file, selected, unselected))
 
     print("========================")
+    print(" SUMMARY :: (input -> output :: selected / unselected)")
+    for select_job_input_file, output_file, selected, unselected in summary:
+        print("   %s -> %s :: %s / %s" % (select_job_input_file, output_file, selected, unselected))
+    print("========================")
     print("... job completed.")
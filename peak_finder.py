@@ -6,6 +6,9 @@
 """ A program to take in an image and return an predicted particle centroid positions
 """
 
+import dataclasses
+from dataclasses import dataclass
+
 ####################################################
 ## DEFINITIONS
 ####################################################
@@ -15,6 +18,8 @@ def usage():
     print(" A script to find centroids of particles from a grayscale image:")
     print("    $ peak_finder.py  image.jpg")
     print(" Manually edit the variables in the script before running if desired")
+    print(" Time & check the coordinate filtering functions on 100k random points (exits non-zero on a mismatch) with:")
+    print("    $ peak_finder.py  --benchmark")
     print("========================================================================================================")
     # print(" Optional flags: ")
     # print("     --h   :: print this usage")
@@ -32,6 +37,9 @@ def read_input():
         # if the help flag is called, pring usage and exit
         if sys.argv[n] == '-h' or sys.argv[n] == '--help':
             usage()
+        # time the point filtering functions on a large random dataset and exit
+        if sys.argv[n] == '--benchmark':
+            sys.exit(0 if benchmark_point_filters() else 1)
 
     ## read all commandline arguments and adjust variables accordingly
     for n in range(len(sys.argv[1:])+1):
@@ -42,10 +50,18 @@ def read_input():
             # base_file_name = os.path.splitext(input_file_name)[0]
     return
 
+DEPENDENCIES_LOADED = False
+
 def load_dependencies():
     """ Load all packages needed for this script to run using __import__ to make the packages globally accessible to all functions
         REF: https://stackoverflow.com/questions/11990556/how-to-make-global-imports-from-a-function
+        The scipy & skimage submodules used by the functions below are imported here as well, so nothing is imported at call time.
+        Packages are only loaded on the first call, later calls return immediately.
     """
+    global DEPENDENCIES_LOADED
+    if DEPENDENCIES_LOADED:
+        return
+
     ## sys and os are built-in packages, if they fail to load then python install is completely wrong!
     globals()['sys'] = __import__('sys')
     globals()['os'] = __import__('os')
@@ -63,7 +79,9 @@ def load_dependencies():
         sys.exit()
 
     try:
-        globals()['scipy'] = __import__('scipy')
+        ## importing a submodule by name returns the top level package, with the submodule attached to it (i.e. scipy.ndimage)
+        globals()['scipy'] = __import__('scipy.ndimage')
+        __import__('scipy.spatial')
     except:
         print(" ERROR :: Failed to import 'scipy'. Try: pip install scipy")
         sys.exit()
@@ -75,11 +93,14 @@ def load_dependencies():
         sys.exit()
 
     try:
-        globals()['skimage'] = __import__('skimage')
+        globals()['skimage'] = __import__('skimage.exposure')
+        for submodule in ['skimage.feature', 'skimage.filters', 'skimage.measure', 'skimage.morphology']:
+            __import__(submodule)
     except:
         print(" ERROR :: Failed to import 'skimage'. Try: pip install skimage")
         sys.exit()
 
+    DEPENDENCIES_LOADED = True
     return
 
 def image_to_array(file):
@@ -92,6 +113,8 @@ def invert_image(im_array, color_depth = 255):
     return inverted_im
 
 def display_image(im_array, fig_title = '') :
+    from matplotlib import pyplot as plt
+
     plt.figure()
     plt.imshow(im_array, cmap="gray")
     plt.title(fig_title)
@@ -129,25 +152,21 @@ def increase_contrast(im, method = 'adaptive'):
     """ Adative method seems to deal with background gradients the best, but two other options are possible using scikit package
     """
     ## SEE: https://scikit-image.org/docs/dev/auto_examples/color_exposure/plot_equalize.html
-    from skimage import exposure
-
     if method == 'adaptive':
-        img_hicontrast = exposure.equalize_adapthist(im, clip_limit=0.03)
+        img_hicontrast = skimage.exposure.equalize_adapthist(im, clip_limit=0.03)
 
     if method == 'contrast_stretching':
         p2, p98 = np.percentile(im, (2, 98))
-        img_hicontrast = exposure.rescale_intensity(im, in_range=(p2, p98))
+        img_hicontrast = skimage.exposure.rescale_intensity(im, in_range=(p2, p98))
 
     if method == 'histogram_equalization':
         img_hicontrast = skimage.exposure.equalize_hist(im)
 
     return img_hicontrast
 
-def find_local_peaks(im_array, im_array_filtered = None, particle_diameter_pixels = -1, min_peak_distance = -1, peak_threshold = 0.5, blurring_factor = 2, NEGATIVE_STAIN = False):
-    from skimage.feature import peak_local_max
-    from skimage.filters import gaussian
-    from scipy import ndimage
-
+def find_local_peaks(im_array, im_array_filtered = None, particle_diameter_pixels = -1, min_peak_distance = -1, peak_threshold = 0.5, blurring_factor = 2, NEGATIVE_STAIN = False, exclude = None):
+    """ exclude = np array of bool, optional low resolution mask (see: image_handler.exclusion_mask) of regions where no peaks are searched for
+    """
     if blurring_factor < 0:
         ## prevent the blurring factor from being negative
         blurring_factor = 2
@@ -175,35 +194,37 @@ def find_local_peaks(im_array, im_array_filtered = None, particle_diameter_pixel
     ## if a filtered image is provided, use that
     if im_array_filtered is not None:
         im = im_array_filtered
-        print("    filtered image supplied for analysis" % NEGATIVE_STAIN)
+        print("    filtered image supplied for analysis")
     else:
         im = im_array
 
     ## blur the input image slightly
-    filtered_im = gaussian(im, sigma = blurring_factor)
+    filtered_im = skimage.filters.gaussian(im, sigma = blurring_factor)
 
     ## if we have a negative stain image, we need to invert the image color space
     if NEGATIVE_STAIN == True:
         filtered_im = invert_image(filtered_im)
 
     # image_max is the dilation of im with a structuring element of given size
-    image_max = ndimage.maximum_filter(filtered_im, size=background_window_size, mode='nearest')
+    image_max = scipy.ndimage.maximum_filter(filtered_im, size=background_window_size, mode='nearest')
     # using the max background, subtract the image to create an inverted signal (white = high signal, black = low)
     subtracted_im = image_max - filtered_im
 
     subtracted_im = increase_contrast(subtracted_im)
 
+    ## only search for peaks outside of excluded regions
+    labels = None
+    if exclude is not None:
+        import image_handler
+        labels = (~image_handler.expand_mask(exclude, subtracted_im.shape)).astype(np.uint8)
+        print("    excluded regions = %.1f%% of the image" % (100 - 100 * np.mean(labels)))
+
     # Comparison between image_max and im to find the coordinates of local maxima
-    coordinates = peak_local_max(subtracted_im, min_distance = min_peak_distance, threshold_rel = peak_threshold)
+    coordinates = skimage.feature.peak_local_max(subtracted_im, min_distance = min_peak_distance, threshold_rel = peak_threshold, labels = labels)
 
     print("-------------------------------------------------------")
     print(" >> %s peaks found" % coordinates.shape[0])
 
-    ## this script is not very efficient, so abort running if there are too many peaks and tell the user to adjust parameters and run again
-    if coordinates.shape[0] > 1500:
-        print(" !! Too many peaks, try increasing the Threshold value or Min. distance and run again")
-        return
-
     ## although it shouldn't, the peak_local_max algorithm sometimes returns duplicate coordintes, clean the the coordinate dataset by removing these duplicates manually
     coordinates = remove_duplicates(coordinates, particle_diameter_pixels = particle_diameter_pixels)
 
@@ -221,36 +242,18 @@ def remove_edge_coords(data, particle_diameter_pixels, im_shape):
                [y2, x2]
                ...
                [yn, xn] ]
-    This function will return a new numpy array with the offending points removed (keeping the first instance of a clashing/duplicate point).
+    This function will return a new numpy array (same order, in (row, column) form) with the offending points removed.
     """
 
     ## if minimum distance given is out of range, set it arbitrarily to 45 pixels (75% of 60 pixel diameter)
     edge_cutoff_threshold = int(particle_diameter_pixels * 0.75)
 
-    # initialize the list variables for use in algorithm
-    edge_points = []
-    edge_points_removed = []
-    ## convert the numpy arrays for each point into tuples of the form (x, y), which requires inverting the incoming tuple
-    input_data =  list(map(tuple, np.flip(data, axis = 1)))
-
-    for step in range(len(input_data)) :
-        ## extract first entry in the list before removing it
-        first_entry = input_data[0]
-        x, y = first_entry
-        # update the list of points to remove the current one to be worked on
-        del input_data[0]
-        # test if point is along any of the edges of the image
-        if x < edge_cutoff_threshold or y < edge_cutoff_threshold :
-            if first_entry not in edge_points:
-                # print("Edge detected = (x, y) -> (%s, %s)" % (x, y))
-                edge_points.append(first_entry)
-        elif x > im_shape[1] - edge_cutoff_threshold or y > im_shape[0] - edge_cutoff_threshold :
-            if first_entry not in edge_points:
-                # print("Edge detected = (x, y) -> (%s, %s)" % (x, y))
-                edge_points.append(first_entry)
-        else:
-            ## we can add this point to the output list
-            edge_points_removed.append(first_entry)
+    data = np.asarray(data).reshape(-1, 2)
+    y, x = data[:, 0], data[:, 1]
+
+    ## test all points at once for being along any of the edges of the image
+    edge_points = (x < edge_cutoff_threshold) | (y < edge_cutoff_threshold) | (x > im_shape[1] - edge_cutoff_threshold) | (y > im_shape[0] - edge_cutoff_threshold)
+    output_data = data[~edge_points]
 
     print("======================================================================")
     print(" Removing points too close to edge... ")
@@ -259,17 +262,7 @@ def remove_edge_coords(data, particle_diameter_pixels, im_shape):
     print("    particle_diameter_pixels = %s px" % particle_diameter_pixels)
     print("    edge_cutoff_threshold = %s px" % int(particle_diameter_pixels * 0.75))
     print("-------------------------------------------------------")
-    print(" >> %s points removed, %s remaining " % ( len(edge_points), len(edge_points_removed)))
-
-    ## convert the output coordinates back to a numpy array of arrays in the order of (row, column), e.g. (y, x)
-    for i in range(len(edge_points_removed)-1):
-        ## for the first point we initialize a new numpy array with the first entry
-        if i == 0:
-            output_data = np.array((edge_points_removed[i][1], edge_points_removed[i][0]))
-        ## for subsequent points we stack onto the previously created array
-        else :
-            coord_array = np.array((edge_points_removed[i][1], edge_points_removed[i][0]))
-            output_data = np.vstack((output_data, coord_array))
+    print(" >> %s points removed, %s remaining " % ( np.count_nonzero(edge_points), len(output_data)))
 
     return output_data
 
@@ -282,44 +275,30 @@ def remove_duplicates(data, min_distance = -1, particle_diameter_pixels = -1):
                [y2, x2]
                ...
                [yn, xn] ]
-    This function will return a new numpy array with the offending points removed (keeping the first instance of a clashing/duplicate point).
+    This function will return a new numpy array with the offending points removed: both points of any pair closer than min_distance
+    are dropped (as are exact duplicates), and the remaining points keep their input order.
+    Pairs are found with a k-d tree (cKDTree.query_pairs), so large numbers of peaks can be handled.
     """
     if min_distance <= 0 : ## in pixels
         ## if minimum distance given is out of range, set it arbitrarily to 45 pixels (75% of 60 pixel diameter)
         min_distance = int(particle_diameter_pixels * 0.6)
 
-    # initialize the list variables for use in algorithm
-    clashing_points = []
-    duplicate_points = []
-    duplicates_removed = list(map(tuple, np.flip(data, axis = 1)))
-    ## convert the numpy arrays for each point into tuples of the form (x, y), which requires inverting the incoming tuple
-    input_data =  list(map(tuple, np.flip(data, axis = 1)))
-
-    for step in range(len(input_data)):
-    	# extract first entry in the list
-    	first_entry = input_data[0]
-    	# update the list of points to remove the current one to be worked on
-    	del input_data[0]
-    	# test current point against all others in the dataset
-    	for point in input_data:
-    		# calculate the different vector for each pointwise comparison
-    		diff_vector = np.subtract(first_entry[:2], point[:2])
-    		# calculate the norm (length) of each difference vector
-    		norm = np.linalg.norm(diff_vector)
-    		# check if there are duplicates in the dataset
-    		if norm <= 0 :
-    			if first_entry not in duplicate_points:
-    				duplicate_points.append(first_entry)
-    		# add each point to the offending list if their norms are shorter than a given cutoff
-    		if norm <= min_distance :
-    			# add each point to the offending list only if it is not already present
-    			if first_entry not in clashing_points:
-    				clashing_points.append(first_entry)
-    			if point not in clashing_points:
-    				clashing_points.append(point)
-
-    ## remove all points that are present in either duplicates or clashing points lists
-    duplicates_removed = set(duplicates_removed) - set(clashing_points + duplicate_points)
+    data = np.asarray(data).reshape(-1, 2)
+
+    ## collapse exact duplicates first, keeping the order in which points first appear
+    unique_points, first_index, counts = np.unique(data, axis = 0, return_index = True, return_counts = True)
+    order = np.argsort(first_index)
+    unique_points, counts = unique_points[order], counts[order]
+    duplicate_points = counts > 1
+
+    ## find all pairs of points within the clashing distance of each other (in one pass over a k-d tree), and flag both points of each pair
+    clashing_points = np.zeros(len(unique_points), dtype = bool)
+    if len(unique_points) > 1:
+        pairs = scipy.spatial.cKDTree(unique_points).query_pairs(r = min_distance, output_type = 'ndarray')
+        clashing_points[pairs.ravel()] = True
+
+    ## remove all points that are either duplicated or clashing
+    output_data = unique_points[~(clashing_points | duplicate_points)]
 
     print("======================================================================")
     print(" Removing duplicate/clashing points... ")
@@ -327,20 +306,7 @@ def remove_duplicates(data, min_distance = -1, particle_diameter_pixels = -1):
     print("    min_distance = %s px" % min_distance)
     print("    particle_diameter_pixels = %s px" % particle_diameter_pixels)
     print("-------------------------------------------------------")
-    print(" >> %s points removed, %s remaining (%s duplicates, %s clashes)" % ( len(duplicate_points) + len(clashing_points), len(duplicates_removed), len(duplicate_points), len(clashing_points)))
-
-
-    ## convert the output coordinates back to a numpy array of arrays in the order of (row, column), e.g. (y, x)
-    i = 0
-    for coord in duplicates_removed:
-        ## for the first point we initialize a new numpy array with the first entry
-        if i == 0:
-            output_data = np.array((coord[1], coord[0]))
-        else:
-            coord_array = np.array((coord[1], coord[0]))
-            output_data = np.vstack((output_data, coord_array))
-        i += 1
-
+    print(" >> %s points removed, %s remaining (%s duplicates, %s clashes)" % ( len(data) - len(output_data), len(output_data), np.count_nonzero(duplicate_points), np.count_nonzero(clashing_points)))
 
     return output_data
 
@@ -350,15 +316,13 @@ def simplify_image(im_array, iterations = 3):
     return im_cleaned
 
 def multi_dil(im,num):
-    from skimage import morphology
     for i in range(num):
-        im = morphology.dilation(im)
+        im = skimage.morphology.dilation(im)
     return im
 
 def multi_ero(im,num):
-    from skimage import morphology
     for i in range(num):
-        im = morphology.erosion(im)
+        im = skimage.morphology.erosion(im)
     return im
 
 def circle_region(resolution, center, radius):
@@ -374,9 +338,13 @@ def circle_region(resolution, center, radius):
     r = center[0] + radius*np.sin(radians)
     return np.array([c, r]).T
 
-def refine_coordinates(im_array, init_coords, im_array_filtered = None, search_box_size = -1, max_refinement_distance = -1, particle_radius = -1, blurring_factor = -1, refine_method = "thresholding", refinement_threshold = -1, display_results = False, NEGATIVE_STAIN = False):
-    from matplotlib import pyplot as plt
-
+def refine_coordinates(im_array, init_coords, im_array_filtered = None, search_box_size = -1, max_refinement_distance = -1, particle_radius = -1, blurring_factor = -1, refine_method = "thresholding", refinement_threshold = -1, display_results = False, NEGATIVE_STAIN = False, processes = None):
+    """ Move each coordinate to the center of mass of the signal in a search box around it.
+        All peaks are refined together: for 'thresholding' the image is blurred once and the search boxes are
+        gathered into a stack (in chunks) so all centers of mass are calculated together; for 'contouring'
+        the search boxes are spread over a process pool (processes = None uses all cores).
+        Coordinates are in (row, column) form, i.e. [ [y1, x1], ... ].
+    """
     ## ensure the max refinement distance is within a logical range
     if max_refinement_distance <= 0 or max_refinement_distance > search_box_size:
         max_refinement_distance = int(particle_radius * 1.8)
@@ -385,9 +353,8 @@ def refine_coordinates(im_array, init_coords, im_array_filtered = None, search_b
     if search_box_size <= 0:
         search_box_size = particle_radius * 3
 
-    ## set the refinement_threshold default and make sure the input value is within a logical range of [0, 1]
-    if  0 > refinement_threshold > 1:
-        refinement_threshold = 0.1
+    ## keep the refinement_threshold within a logical range of [0, 1] (as in the find_center_of_mass functions)
+    refinement_threshold = min(max(refinement_threshold, 0), 1)
 
     print("======================================================================")
     print(" Refine peak positions by local %s ... " % refine_method)
@@ -399,130 +366,155 @@ def refine_coordinates(im_array, init_coords, im_array_filtered = None, search_b
     print("    refinement_threshold = %s" % refinement_threshold)
     print("    negative stain mode = %s" % NEGATIVE_STAIN)
 
-    ## prepare the data structure for output coordinates
-    refined_coordinates = np.zeros(shape = init_coords.shape, dtype=np.int16)
-
     ## if a filtered image is provided, use that for processing
     if im_array_filtered is not None:
         im = im_array_filtered
-        print("    specific filtered image supplied for analysis" % NEGATIVE_STAIN)
+        print("    specific filtered image supplied for analysis")
     else:
         im = im_array
 
     print("-------------------------------------------------------")
 
-    ## prepare the figure to hold data as we draw if we choose to display results
-    if display_results == True:
-        fig, axes = plt.subplots(3, 3, sharex=True, sharey=True)
-        ax = axes.ravel()
-
-    ## iterate over each coordinate provided and carve out a region on the image for analysis by the chosen refinement method
-    n = 0
-    t = 0
-    for coord in init_coords:
-        n += 1
-        print(" >> Refining peak #%s" % n, end='\r')
-        y, x = coord[0], coord[1]
-
-        ## edge detection, dont run refinement if point is too near an edge
-        search_box_halfsize = int(search_box_size / 2)
-        if x < search_box_halfsize or y < search_box_halfsize :
-            refined_offset = [search_box_halfsize + 1 , search_box_halfsize + 1]
-        elif x > im.shape[1] - search_box_halfsize or y > im.shape[0] - search_box_halfsize :
-            refined_offset = [search_box_halfsize + 1 , search_box_halfsize + 1]
-        else :
-            local_region = im[y - search_box_halfsize : y + search_box_halfsize + 1, x - search_box_halfsize : x + search_box_halfsize + 1]
-            if refine_method == "thresholding":
-                refined_offset, origin_offset, input_img, blurred_img, bool_img = find_center_of_mass_via_thresholding(local_region, blur_sigma = blurring_factor, threshold = refinement_threshold, NEGATIVE_STAIN = NEGATIVE_STAIN)
-
-                ## display 3 example cases of refined positions and what the algorithm is seeing
-                if display_results == True and t < 9:
-                    refined_points = circle_region(50, [refined_offset[1], refined_offset[0]], 2)
-                    origin_points = circle_region(50, [origin_offset[1], origin_offset[0]], 2)
-                    alpha_level = 0.6
-                    line_width = 3
-
-                    ax[t].imshow(input_img, cmap=plt.cm.gray)
-                    ax[t].axis('off')
-                    ax[t].set_title("Raw img")
-                    ax[t].plot(refined_points[:, 0], refined_points[:, 1], 'r', lw = line_width, alpha = alpha_level)
-                    ax[t].plot(origin_points[:, 0], origin_points[:, 1], 'b', lw = line_width, alpha = alpha_level)
-                    ## draw a connected line to show the offset more clearly
-                    ax[t].plot( [origin_offset[0], refined_offset[0]], [origin_offset[1], refined_offset[1]], linewidth = line_width, color='lime', alpha = alpha_level)
-                    t += 1
-                    ax[t].imshow(blurred_img, cmap=plt.cm.gray)
-                    ax[t].axis('off')
-                    ax[t].set_title("Blurred img")
-                    t += 1
-                    ax[t].imshow(bool_img, cmap=plt.cm.gray)
-                    ax[t].axis('off')
-                    ax[t].set_title("Bool img")
-                    ax[t].plot(refined_points[:, 0], refined_points[:, 1], 'r', lw = line_width, alpha = alpha_level)
-                    ax[t].plot(origin_points[:, 0], origin_points[:, 1], 'b', lw = line_width, alpha = alpha_level)
-                    ax[t].plot( [origin_offset[0], refined_offset[0]], [origin_offset[1], refined_offset[1]], linewidth = line_width, color='lime', alpha = alpha_level)
-                    t += 1
-
-            elif refine_method == "contouring":
-                refined_offset, origin_offset, input_img, blurred_img, bool_img, contours = find_center_of_mass_via_contouring(local_region, blur_sigma = blurring_factor, threshold = refinement_threshold, NEGATIVE_STAIN = NEGATIVE_STAIN)
-
-                ## display 3 example cases of refined positions and what the algorithm is seeing
-                if display_results == True and t < 9:
-                    refined_points = circle_region(50, [refined_offset[1], refined_offset[0]], 2)
-                    origin_points = circle_region(50, [origin_offset[1], origin_offset[0]], 2)
-                    alpha_level = 0.6
-                    line_width = 3
-
-                    ax[t].imshow(input_img, cmap=plt.cm.gray)
-                    ax[t].axis('off')
-                    ax[t].set_title("Raw img")
-                    ax[t].plot(refined_points[:, 0], refined_points[:, 1], 'r', lw = line_width, alpha = alpha_level)
-                    ax[t].plot(origin_points[:, 0], origin_points[:, 1], 'b', lw = line_width, alpha = alpha_level)
-                    ## draw a connected line to show the offset more clearly
-                    ax[t].plot( [origin_offset[0], refined_offset[0]], [origin_offset[1], refined_offset[1]], linewidth = line_width, color='lime', alpha = alpha_level)
-                    if len(contours) > 0:
-                        for contour in contours:
-                            ax[t].plot(contour[:, 1], contour[:, 0], linewidth = 3, alpha = 1)
-                    t += 1
-                    ax[t].imshow(blurred_img, cmap=plt.cm.gray)
-                    ax[t].axis('off')
-                    ax[t].set_title("Blurred img")
-                    t += 1
-                    ax[t].imshow(bool_img, cmap=plt.cm.gray)
-                    ax[t].axis('off')
-                    ax[t].set_title("Bool img")
-                    ax[t].plot(refined_points[:, 0], refined_points[:, 1], 'r', lw = line_width, alpha = alpha_level)
-                    ax[t].plot(origin_points[:, 0], origin_points[:, 1], 'b', lw = line_width, alpha = alpha_level)
-                    ax[t].plot( [origin_offset[0], refined_offset[0]], [origin_offset[1], refined_offset[1]], linewidth = 4, color='lime', alpha = alpha_level)
-                    if len(contours) > 0:
-                        for contour in contours:
-                            ax[t].plot(contour[:, 1], contour[:, 0], linewidth= 3, alpha = 1)
-                    t += 1
+    init_coords = np.asarray(init_coords).reshape(-1, 2)
+    refined_coordinates = np.array(init_coords, dtype = np.int64)
+    search_box_halfsize = int(search_box_size / 2)
 
-            else:
-                print(" ERROR :: Incorrect refine_method supplied -> %s " % refine_method)
-                sys.exit()
+    ## edge detection, dont run refinement if point is too near an edge (its search box would be cut off)
+    y, x = init_coords[:, 0], init_coords[:, 1]
+    interior = (x >= search_box_halfsize) & (y >= search_box_halfsize) & (x < im.shape[1] - search_box_halfsize) & (y < im.shape[0] - search_box_halfsize)
+    interior_coords = init_coords[interior]
 
-            # print("Initial coordinate: %s -> refined position %s" % (coord, refined_position))
+    if refine_method == "thresholding":
+        offsets = center_of_mass_offsets_via_thresholding(im, interior_coords, search_box_halfsize, threshold = refinement_threshold, blur_sigma = blurring_factor, NEGATIVE_STAIN = NEGATIVE_STAIN)
+    elif refine_method == "contouring":
+        offsets = center_of_mass_offsets_via_contouring(im, interior_coords, search_box_halfsize, threshold = refinement_threshold, blur_sigma = blurring_factor, NEGATIVE_STAIN = NEGATIVE_STAIN, processes = processes)
+    else:
+        print(" ERROR :: Incorrect refine_method supplied -> %s " % refine_method)
+        sys.exit()
 
-        if np.isnan(refined_offset[0]) or np.isnan(refined_offset[1]):
-            refined_offset = [search_box_halfsize + 1 , search_box_halfsize + 1]
-        refined_x = x - search_box_halfsize + refined_offset[1]
-        refined_y = y - search_box_halfsize + refined_offset[0]
-        ## update the coordinates for this point in the array we will output
-        refined_coordinates[n - 1, 0] = refined_y
-        refined_coordinates[n - 1, 1] = refined_x
+    ## offsets are (x, y) positions in the search box; points without any signal stay where they are
+    offsets = np.where(np.isnan(offsets), search_box_halfsize, offsets)
+    refined_coordinates[interior, 0] = interior_coords[:, 0] - search_box_halfsize + offsets[:, 1]
+    refined_coordinates[interior, 1] = interior_coords[:, 1] - search_box_halfsize + offsets[:, 0]
 
-    print(" >> %s peaks refined " % (n - 1))
+    print(" >> %s peaks refined (%s too close to the edge to refine)" % (len(interior_coords), len(init_coords) - len(interior_coords)))
 
     if display_results == True:
-        fig.tight_layout()
-        plt.show()
+        display_refinement_examples(im, interior_coords[:3], search_box_halfsize, blurring_factor, refine_method, refinement_threshold, NEGATIVE_STAIN)
 
     refined_coordinates = remove_duplicates(refined_coordinates, particle_diameter_pixels = particle_radius * 2)
     refined_coordinates = remove_edge_coords(refined_coordinates, particle_radius * 2, im_array.shape)
 
     return refined_coordinates
 
+def center_of_mass_offsets_via_thresholding(im_array, coords, search_box_halfsize, threshold = 0.1, blur_sigma = -1, NEGATIVE_STAIN = False, chunk_size = 256):
+    """ Batched equivalent of find_center_of_mass_via_thresholding for all coordinates at once. The image is blurred once,
+        then the search boxes are taken as views of the blurred image and processed as a stack (chunk_size boxes at a time,
+        to bound memory), with the center of mass of every box in a chunk calculated together.
+    PARAMETERS
+        coords = np array [ [y1, x1], ... ] of points at least search_box_halfsize from the image edges
+    RETURNS
+        offsets = np array [ [x1, y1], ... ] of the center of mass in each search box (nan if no pixels pass the threshold)
+    """
+    ## avoid negative values for the blurring factor
+    if blur_sigma < 0:
+        blur_sigma = 0
+
+    ## blur the whole image once
+    im = skimage.filters.gaussian(im_array, sigma = blur_sigma)
+    if not NEGATIVE_STAIN:
+        ## invert the image so particle is white
+        im = 1 - im
+
+    box_size = 2 * search_box_halfsize + 1
+    windows = np.lib.stride_tricks.sliding_window_view(im, (box_size, box_size))
+    positions = np.arange(box_size)
+    offsets = np.full((len(coords), 2), np.nan)
+    for start in range(0, len(coords), chunk_size):
+        chunk = coords[start : start + chunk_size]
+        ## fancy indexing on the window view gathers the boxes centered on each point into an (n, box, box) stack
+        stack = windows[chunk[:, 0] - search_box_halfsize, chunk[:, 1] - search_box_halfsize]
+        ## pixels above a threshold defined by the average intensity of each box and the user adjustable threshold
+        average_intensity = stack.mean(axis = (1, 2))
+        bool_stack = stack > (average_intensity * (1 + threshold))[:, None, None]
+        ## center of mass of each box from its row and column projections
+        mass = bool_stack.sum(axis = (1, 2))
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            offsets[start : start + len(chunk), 0] = (bool_stack.sum(axis = 1) @ positions) / mass
+            offsets[start : start + len(chunk), 1] = (bool_stack.sum(axis = 2) @ positions) / mass
+    return offsets
+
+def _contouring_offset(args):
+    """ Worker function for center_of_mass_offsets_via_contouring
+    """
+    local_region, threshold, blur_sigma, NEGATIVE_STAIN = args
+    refined_offset = find_center_of_mass_via_contouring(local_region, threshold = threshold, blur_sigma = blur_sigma, NEGATIVE_STAIN = NEGATIVE_STAIN)[0]
+    return refined_offset
+
+def center_of_mass_offsets_via_contouring(im_array, coords, search_box_halfsize, threshold = 0.1, blur_sigma = -1, NEGATIVE_STAIN = False, processes = None):
+    """ Run find_center_of_mass_via_contouring on the search box of every coordinate, using a process pool
+    RETURNS
+        offsets = np array [ [x1, y1], ... ] of the refined position in each search box
+    """
+    import multiprocessing
+
+    tasks = [ (im_array[y - search_box_halfsize : y + search_box_halfsize + 1, x - search_box_halfsize : x + search_box_halfsize + 1], threshold, blur_sigma, NEGATIVE_STAIN) for y, x in coords ]
+    if len(tasks) == 0:
+        return np.zeros((0, 2))
+    with multiprocessing.Pool(processes, initializer = load_dependencies) as pool:
+        offsets = pool.map(_contouring_offset, tasks, chunksize = max(1, len(tasks) // (4 * (processes or os.cpu_count()))))
+    return np.array(offsets, dtype = np.float64).reshape(-1, 2)
+
+def display_refinement_examples(im, coords, search_box_halfsize, blurring_factor, refine_method, refinement_threshold, NEGATIVE_STAIN):
+    """ Display up to 3 example cases of refined positions and what the algorithm is seeing
+    """
+    from matplotlib import pyplot as plt
+
+    fig, axes = plt.subplots(3, 3, sharex=True, sharey=True)
+    ax = axes.ravel()
+    alpha_level = 0.6
+    line_width = 3
+
+    t = 0
+    for y, x in coords:
+        local_region = im[y - search_box_halfsize : y + search_box_halfsize + 1, x - search_box_halfsize : x + search_box_halfsize + 1]
+        contours = []
+        if refine_method == "thresholding":
+            refined_offset, origin_offset, input_img, blurred_img, bool_img = find_center_of_mass_via_thresholding(local_region, blur_sigma = blurring_factor, threshold = refinement_threshold, NEGATIVE_STAIN = NEGATIVE_STAIN)
+        else:
+            refined_offset, origin_offset, input_img, blurred_img, bool_img, contours = find_center_of_mass_via_contouring(local_region, blur_sigma = blurring_factor, threshold = refinement_threshold, NEGATIVE_STAIN = NEGATIVE_STAIN)
+
+        refined_points = circle_region(50, [refined_offset[1], refined_offset[0]], 2)
+        origin_points = circle_region(50, [origin_offset[1], origin_offset[0]], 2)
+
+        ax[t].imshow(input_img, cmap=plt.cm.gray)
+        ax[t].axis('off')
+        ax[t].set_title("Raw img")
+        ax[t].plot(refined_points[:, 0], refined_points[:, 1], 'r', lw = line_width, alpha = alpha_level)
+        ax[t].plot(origin_points[:, 0], origin_points[:, 1], 'b', lw = line_width, alpha = alpha_level)
+        ## draw a connected line to show the offset more clearly
+        ax[t].plot( [origin_offset[0], refined_offset[0]], [origin_offset[1], refined_offset[1]], linewidth = line_width, color='lime', alpha = alpha_level)
+        for contour in contours:
+            ax[t].plot(contour[:, 1], contour[:, 0], linewidth = 3, alpha = 1)
+        t += 1
+        ax[t].imshow(blurred_img, cmap=plt.cm.gray)
+        ax[t].axis('off')
+        ax[t].set_title("Blurred img")
+        t += 1
+        ax[t].imshow(bool_img, cmap=plt.cm.gray)
+        ax[t].axis('off')
+        ax[t].set_title("Bool img")
+        ax[t].plot(refined_points[:, 0], refined_points[:, 1], 'r', lw = line_width, alpha = alpha_level)
+        ax[t].plot(origin_points[:, 0], origin_points[:, 1], 'b', lw = line_width, alpha = alpha_level)
+        ax[t].plot( [origin_offset[0], refined_offset[0]], [origin_offset[1], refined_offset[1]], linewidth = line_width, color='lime', alpha = alpha_level)
+        for contour in contours:
+            ax[t].plot(contour[:, 1], contour[:, 0], linewidth = 3, alpha = 1)
+        t += 1
+
+    fig.tight_layout()
+    plt.show()
+    return
+
 def find_center_of_mass_via_contouring(im_array, threshold = 0.1, blur_sigma = -1, NEGATIVE_STAIN = False):
     """ A slower and more deliberate method for recentering peaks around continuous shapes. If the signal is strong enough, can be more accurate
         than thresholding as the center will be calculated for a non-circular shape (e.g. whatever the contouring algorithm finds), choosing the
@@ -538,13 +530,8 @@ def find_center_of_mass_via_contouring(im_array, threshold = 0.1, blur_sigma = -
     if blur_sigma < 0:
         blur_sigma = 0
 
-    from skimage.filters import gaussian
-    from skimage import measure
-    from skimage.measure import label, regionprops
-    import scipy.ndimage as ndimage
-
     ## blur the input image
-    im = gaussian(im_array, sigma = blur_sigma)
+    im = skimage.filters.gaussian(im_array, sigma = blur_sigma)
 
     if NEGATIVE_STAIN:
         ## if negative stain, we do not need to invert the image
@@ -566,16 +553,16 @@ def find_center_of_mass_via_contouring(im_array, threshold = 0.1, blur_sigma = -
     bool_img[im_mask] = 1
 
     ## find contours in the image
-    contours = measure.find_contours(bool_img, level = 0.5, fully_connected = 'high')
+    contours = skimage.measure.find_contours(bool_img, level = 0.5, fully_connected = 'high')
 
     ## prepare variable to hold center of all contours
     all_contour_centroids = [] ## populate with tuples of the form: (x, y, sq_distance_to_origin)
     origin = (im.shape[1] / 2, im.shape[0] / 2) # (x, y)
 
     ## convert the boolean image into a labeled data structure
-    label_img = label(bool_img)
+    label_img = skimage.measure.label(bool_img)
     ## pass the labeled data structure into the regionprops function so we can extract its properties
-    regions = regionprops(label_img)
+    regions = skimage.measure.regionprops(label_img)
     ## calculate a max distance limit for new coordinates
     max_sq_distance = ((origin[0] / 2)**2 + (origin[1] / 2)**2) * 0.5
     for props in regions:
@@ -609,9 +596,6 @@ def find_center_of_mass_via_thresholding(im_array, threshold = 0.1, blur_sigma =
 
         Returns the refined coordinate and images used in this algorithm for user feedback if desired.
     """
-    from skimage.filters import gaussian
-    import scipy.ndimage as ndimage
-
     ## keep threshold within a range of 0 and 1
     if threshold < 0 :
         threshold = 0
@@ -622,7 +606,7 @@ def find_center_of_mass_via_thresholding(im_array, threshold = 0.1, blur_sigma =
         blur_sigma = 0
 
     ## blur the input image
-    im = gaussian(im_array, sigma = blur_sigma)
+    im = skimage.filters.gaussian(im_array, sigma = blur_sigma)
 
     if NEGATIVE_STAIN:
         ## if negative stain, we do not need to invert the image
@@ -643,7 +627,7 @@ def find_center_of_mass_via_thresholding(im_array, threshold = 0.1, blur_sigma =
     bool_img[im_mask] = 1
 
     ## find the center point of all white pixels
-    center_of_mass_coordinate = ndimage.center_of_mass(bool_img)
+    center_of_mass_coordinate = scipy.ndimage.center_of_mass(bool_img)
 
     return ((center_of_mass_coordinate[1], center_of_mass_coordinate[0]), origin, im_array, im, bool_img)
 
@@ -698,10 +682,104 @@ def gif2star(gif_coord, gif_dimensions, mrc_dimensions):
 
     return (rescaled_gif_coordinate_x, inverted_rescaled_gif_coordinate_y)
 
+@dataclass
+class PeakFinderConfig:
+    """ All settings for a PeakFinder, in pixels of the image being picked.
+        refine_method = 'thresholding', 'contouring' or 'none'; values <= 0 for min_distance_pixels, search_box_size & refinement_threshold use the defaults of the functions they are passed to.
+        exclusion_sigma = if > 0, carbon/ice/gold regions are masked out of the search (see: image_handler.exclusion_mask)
+    """
+    particle_diameter_pixels: int = 50
+    min_distance_pixels: int = -1
+    threshold: float = 0.5
+    blur: float = 2
+    NEGATIVE_STAIN: bool = False
+    contrast_method: str = 'adaptive'
+    refine_method: str = 'thresholding'
+    refinement_threshold: float = -1
+    search_box_size: int = -1
+    processes: int = None
+    display_refinement_imgs: bool = False
+    exclusion_sigma: float = -1
+
+@dataclass
+class PeakFinderResult:
+    """ source = the path of the image, or its index in the input sequence for arrays
+        image_shape = (rows, columns) of the picked image
+        coordinates = np array [ [x1, y1], ... ] of picked positions
+    """
+    source: object
+    image_shape: tuple
+    coordinates: object
+
+class PeakFinder:
+    """
+    A reusable peak finder, dependencies are loaded once on creation and the same settings are applied to every image.
+    ### USAGE:
+    ```
+        finder = PeakFinder(PeakFinderConfig(particle_diameter_pixels = 60, threshold = 0.3))
+        for result in finder.find(['mic_0001.jpg', 'mic_0002.jpg']):
+            print(result.source, len(result.coordinates))
+        coordinates = finder.find_in_array(im_array) ## [ [y1, x1], ... ]
+    ```
+    """
+    REFINE_METHODS = ['thresholding', 'contouring', 'none']
+
+    def __init__(self, config = None, **kwargs):
+        """ Settings are taken from the config (if given), and any keyword arguments are applied on top, e.g. PeakFinder(threshold = 0.3)
+        """
+        if config is None:
+            config = PeakFinderConfig()
+        self.config = dataclasses.replace(config, **kwargs)
+        if self.config.refine_method not in self.REFINE_METHODS:
+            raise ValueError("Incorrect refinement method keyword used -> (%s), try: %s" % (self.config.refine_method, ", ".join(self.REFINE_METHODS)))
+        load_dependencies()
+        return
+
+    def find_in_array(self, im_array, exclude = None):
+        """ Run peak finding (and refinement, if on) on a single grayscale image array
+            PARAMETERS
+                exclude = np array of bool, optional low resolution mask of regions not to pick in (see: image_handler.exclusion_mask),
+                          made from the image if not given and config.exclusion_sigma > 0
+            RETURNS
+                coordinates = np array [ [y1, x1], ... ] in (row, column) form
+        """
+        config = self.config
+        if exclude is None and config.exclusion_sigma > 0:
+            import image_handler
+            exclude = image_handler.exclusion_mask(im_array, config.particle_diameter_pixels, sigma = config.exclusion_sigma)
+        ## use local contrasting to enhances features before picking
+        img_filtered = increase_contrast(im_array, method = config.contrast_method)
+
+        coordinates = find_local_peaks(img_filtered, peak_threshold = config.threshold, particle_diameter_pixels = config.particle_diameter_pixels, min_peak_distance = config.min_distance_pixels, blurring_factor = config.blur, NEGATIVE_STAIN = config.NEGATIVE_STAIN, exclude = exclude)
+
+        ## refine the position by searching a local area ...
+        if config.refine_method != 'none' and len(coordinates) > 0:
+            coordinates = refine_coordinates(img_filtered, coordinates, search_box_size = config.search_box_size, particle_radius = int(config.particle_diameter_pixels / 2), blurring_factor = config.blur, refine_method = config.refine_method, refinement_threshold = config.refinement_threshold, display_results = config.display_refinement_imgs, NEGATIVE_STAIN = config.NEGATIVE_STAIN, processes = config.processes)
+
+        return np.asarray(coordinates).reshape(-1, 2)
+
+    def find(self, images):
+        """ Yield a PeakFinderResult for each image, where images is an image path, a 2D array, or an iterable of either.
+            Images are read one at a time as the results are consumed.
+        """
+        if isinstance(images, str) or (isinstance(images, np.ndarray) and images.ndim == 2):
+            images = [ images ]
+        for index, image in enumerate(images):
+            if isinstance(image, str):
+                source = image
+                im_array = image_to_array(image)
+            else:
+                source = index
+                im_array = np.asarray(image)
+            coordinates = self.find_in_array(im_array)
+            ## flip each (row, column) into (x, y)
+            yield PeakFinderResult(source, im_array.shape[:2], coordinates[:, ::-1])
+
 def get_peaks(gif_file, particle_diameter_pixels, min_distance_pixels, threshold, blur = 2, NEGATIVE_STAIN = False, REFINE = True, refine_method = 'thresholding', refinement_threshold = -1, display_refinement_imgs = False, PRINT_STAR = False):
     """ Entry point function for external scripts to run analysis on a given image and
         returns a set of coordinates for use by the calling script in the form of:
             [(x1, y1), (x2, y2), ... (xn, yn)]
+        For many images, create a PeakFinder once and use its find() method instead.
     """
     print()
     print(" ... RUNNING peak_finder.py")
@@ -709,53 +787,61 @@ def get_peaks(gif_file, particle_diameter_pixels, min_distance_pixels, threshold
 
     print(" Input parameters :: gif_file = %s, particle_diameter_pixels = %s, min_distance_pixels = %s, threshold = %s, blur = %s, NEGATIVE_STAIN = %s, REFINE = %s, refine_method = %s, refinement_threshold = %s,  display_refinement_imgs = %s, PRINT_STAR = %s" % (gif_file, particle_diameter_pixels, min_distance_pixels, threshold, blur, NEGATIVE_STAIN, REFINE, refine_method, refinement_threshold, display_refinement_imgs, PRINT_STAR))
 
-    load_dependencies()
-
-    ## read the image in as an array
-    img = image_to_array(gif_file)
-
-    ## use local contrasting to enhances features before picking
-    img_filtered = increase_contrast(img)
-
-    initial_coordinates = find_local_peaks(img_filtered, peak_threshold = threshold, particle_diameter_pixels = particle_diameter_pixels, min_peak_distance = min_distance_pixels, blurring_factor = blur, NEGATIVE_STAIN = NEGATIVE_STAIN) ## pick filtered image and display filtered image
-
     ## check if peak refinement is on
-    if refine_method == "none":
-        REFINE = False
-
-    ## refine the position by searching a local area ...
-    if REFINE == True:
-        if refine_method == 'thresholding':
-            refined_coordinates = refine_coordinates(img_filtered, initial_coordinates, search_box_size = -1, particle_radius = int(particle_diameter_pixels / 2), blurring_factor = blur,  refine_method = "thresholding", refinement_threshold = refinement_threshold, display_results = display_refinement_imgs, NEGATIVE_STAIN = NEGATIVE_STAIN)
-        elif refine_method == 'contouring':
-            refined_coordinates = refine_coordinates(img_filtered, initial_coordinates, search_box_size = -1, particle_radius = int(particle_diameter_pixels / 2), blurring_factor = blur,  refine_method = "contouring", refinement_threshold = refinement_threshold, display_results = display_refinement_imgs, NEGATIVE_STAIN = NEGATIVE_STAIN)
-        else:
-            print(" ERROR :: Incorrect refinement method keyword used -> (%s), try: 'thresholding' or 'contouring'" % refinement_method)
+    if REFINE == False:
+        refine_method = 'none'
+
+    finder = PeakFinder(particle_diameter_pixels = particle_diameter_pixels, min_distance_pixels = min_distance_pixels, threshold = threshold, blur = blur, NEGATIVE_STAIN = NEGATIVE_STAIN, refine_method = refine_method, refinement_threshold = refinement_threshold, display_refinement_imgs = display_refinement_imgs)
+    result = next(finder.find(gif_file))
 
     ## print output files section
     if PRINT_STAR == True:
-        if run_coordinate_refinement == True:
-            write_star_file(refined_coordinates, input_file, (img.shape[1], img.shape[0]))
-        else:
-            write_star_file(initial_coordinates, input_file, (img.shape[1], img.shape[0]))
+        write_star_file(result.coordinates[:, ::-1], gif_file, (result.image_shape[1], result.image_shape[0]))
 
     print("========================================================================================================")
     print(" ... peak_finder.py COMPLETE")
 
-    ## format the coordinates for use by the calling script
-    output_coords = []
-    if REFINE == True:
-        if len(refined_coordinates) > 0:
-            for (coord_y, coord_x) in refined_coordinates:
-                output_coords.append((coord_x, coord_y))
-    else:
-        try:
-            if len(initial_coordinates):
-                for (coord_y, coord_x) in initial_coordinates:
-                    output_coords.append((coord_x, coord_y))
-        except:
-            return output_coords
-    return output_coords
+    ## format the coordinates for use by the calling script as a list of (x, y) tuples
+    return list(map(tuple, result.coordinates.tolist()))
+
+def benchmark_point_filters(n_points = 100000, im_shape = (40000, 40000), particle_diameter_pixels = 40):
+    """ Time remove_duplicates & remove_edge_coords on a random set of points, and check their output against a direct per-point calculation:
+            $ peak_finder.py --benchmark
+        RETURNS
+            True if remove_edge_coords matches the direct calculation (and keeps the interior last point)
+    """
+    import time
+    import contextlib
+    import io
+    load_dependencies()
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, min(im_shape), (n_points, 2))
+    ## make sure the last point is an interior point, which the old list-based remove_edge_coords would drop
+    data[-1] = (im_shape[0] // 2, im_shape[1] // 2)
+
+    print("======================================================================")
+    print(" peak_finder :: benchmark_point_filters (%s points)" % n_points)
+    print("-------------------------------------------------------")
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        no_edges = remove_edge_coords(data, particle_diameter_pixels, im_shape)
+        edge_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        no_duplicates = remove_duplicates(data, particle_diameter_pixels = particle_diameter_pixels)
+        duplicates_time = time.perf_counter() - start
+
+    cutoff = int(particle_diameter_pixels * 0.75)
+    expected = [ (y, x) for y, x in data.tolist() if cutoff <= x <= im_shape[1] - cutoff and cutoff <= y <= im_shape[0] - cutoff ]
+    matches_direct = expected == list(map(tuple, no_edges.tolist()))
+    last_point_kept = len(no_edges) > 0 and tuple(no_edges[-1]) == tuple(data[-1])
+    print("    remove_edge_coords :: %.3f s, %s points kept, matches direct calculation = %s, last point kept = %s" % (edge_time, len(no_edges), matches_direct, last_point_kept))
+    print("    remove_duplicates :: %.3f s, %s points kept" % (duplicates_time, len(no_duplicates)))
+    if not (matches_direct and last_point_kept):
+        print(" FAIL :: remove_edge_coords does not match the direct calculation")
+    print("======================================================================")
+    return matches_direct and last_point_kept
 
 
 ####################################################
@@ -772,6 +858,7 @@ if __name__ == '__main__':
     blurring_factor = 4
     ## local peaks variables
     local_peak_threshold = 0.2 # 0 to 1, reduce to get more peaks
+    exclusion_sigma = -1 ## if > 0, skip carbon/ice/gold regions that differ from the bulk of the image by this many robust standard deviations
 
     ## refinement variables
     run_coordinate_refinement = True
@@ -797,33 +884,15 @@ if __name__ == '__main__':
     ## check proper usage and read in variables if correct
     read_input()
 
-    ## read the image in as an array
-    img = image_to_array(input_file)
-
-    ## use local contrasting to enhances features before picking
-    img_filtered = increase_contrast(img)
-
-    ## Find particles using a local peak search algorithm
-    # initial_coordinates = find_local_peaks(img, particle_diameter_pixels = particle_diameter_pixels, min_distance_pixels = min_distance_pixels, NEGATIVE_STAIN = NEGATIVE_STAIN) ## pick unfiltered image
-    # initial_coordinates = find_local_peaks(img, im_array_filtered = img_filtered, particle_diameter_pixels = particle_diameter_pixels, min_distance_pixels = min_distance_pixels, NEGATIVE_STAIN = NEGATIVE_STAIN) ## pick filtered image but display unfiltered image
-    initial_coordinates = find_local_peaks(img_filtered, peak_threshold = local_peak_threshold, particle_diameter_pixels = particle_diameter_pixels, min_peak_distance = min_distance_pixels, NEGATIVE_STAIN = NEGATIVE_STAIN) ## pick filtered image and display filtered image
-
-    if run_coordinate_refinement:
-        ## refine the position by searching a local area ...
-        if refinement_method in ['thresholding', 'contouring']:
-            refined_coordinates = refine_coordinates(img_filtered, initial_coordinates, search_box_size = int(particle_diameter_pixels * 1.5), particle_radius = int(particle_diameter_pixels / 2), blurring_factor = blurring_factor, refine_method = refinement_method, display_results = display_refinement_results, NEGATIVE_STAIN = NEGATIVE_STAIN)
-        elif refinement_method == 'none':
-            pass
-        else:
-            print("Incorrect refinement method option used (%s), try: 'thresholding' or 'contouring'" % refinement_method)
-
+    ## run peak finding with the settings above
+    config = PeakFinderConfig(particle_diameter_pixels = particle_diameter_pixels, min_distance_pixels = min_distance_pixels, threshold = local_peak_threshold, blur = blurring_factor, NEGATIVE_STAIN = NEGATIVE_STAIN,
+                              refine_method = refinement_method if run_coordinate_refinement else 'none', refinement_threshold = refinement_threshold, search_box_size = int(particle_diameter_pixels * 1.5), display_refinement_imgs = display_refinement_results,
+                              exclusion_sigma = exclusion_sigma)
+    result = next(PeakFinder(config).find(input_file))
 
     ## file output section
     if print_star_file == True:
-        if run_coordinate_refinement == True:
-            write_star_file(refined_coordinates, input_file, (img.shape[1], img.shape[0]))
-        else:
-            write_star_file(initial_coordinates, input_file, (img.shape[1], img.shape[0]))
+        write_star_file(result.coordinates[:, ::-1], input_file, (result.image_shape[1], result.image_shape[0]))
 
     print("========================================================================================================")
     print(" ... COMPLETE")
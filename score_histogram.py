@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+## 2026-10-19: Wrote module
+
+"""
+    A dataset-wide histogram of pick scores, so a threshold can be read as an absolute score or a percentile of the
+    whole dataset instead of the range of the micrograph on screen. Scores are counted into fixed-width bins that
+    extend as new scores come in, and the bins each micrograph added are remembered so that saving a micrograph again
+    replaces its contribution. A stamp (e.g. the modification time of the source .STAR file) is kept per micrograph,
+    so only micrographs whose source has changed need to be read again. The state persists in a single .npz file, e.g.:
+        $ score_histogram.py  .score_histogram.npz  --percentile 20
+    Import this module directly via:
+        from score_histogram import ScoreHistogram
+"""
+
+import os
+import sys
+import numpy as np
+
+DEFAULT_HISTOGRAM_FILE = '.score_histogram.npz'
+DEFAULT_BIN_WIDTH = 0.01
+
+class ScoreHistogram:
+    """
+    Streaming histogram of the pick scores of every micrograph of a dataset, in bins of a fixed width.
+    If the histogram file exists it is loaded, and its bin width is used instead of the one given.
+    ### USAGE:
+    ```
+        histogram = ScoreHistogram('.score_histogram.npz')
+        histogram.update_micrograph('mic_0001.jpg', [ score1, score2, ... ], stamp = os.path.getmtime('mic_0001_CURATED.star'))
+        n_retained = histogram.count_above(0.4)
+        threshold = histogram.percentile(20) ## the score that drops the lowest 20 % of picks
+        histogram.save()
+    ```
+    """
+    def __init__(self, histogram_file = DEFAULT_HISTOGRAM_FILE, bin_width = DEFAULT_BIN_WIDTH, DEBUG = False):
+        self.histogram_file = histogram_file
+        self.DEBUG = DEBUG
+        if histogram_file is not None and os.path.exists(histogram_file):
+            self.load()
+        else:
+            self.bin_width = float(bin_width)
+            self.origin = 0 ## bin number of counts[0], i.e. counts[i] holds scores in [ (origin + i) * bin_width, (origin + i + 1) * bin_width )
+            self.counts = np.zeros(0, dtype = np.int64)
+            self.n = 0
+            ## { micrograph name : tuple(np array of bin numbers, np array of counts) } of the scores in the histogram
+            self.contributions = dict()
+            ## { micrograph name : float } of the source each micrograph was last read from
+            self.stamps = dict()
+        self._cumulative = None
+        return
+
+    def _add_bins(self, bins, counts, sign = 1):
+        """ Add counts into the given bin numbers (or subtract them, with sign = -1), extending the bins if necessary
+        """
+        if len(bins) == 0:
+            return
+        low, high = int(bins.min()), int(bins.max())
+        if len(self.counts) == 0:
+            self.origin = low
+            self.counts = np.zeros(high - low + 1, dtype = np.int64)
+        elif low < self.origin or high >= self.origin + len(self.counts):
+            new_origin = min(low, self.origin)
+            new_counts = np.zeros(max(high + 1, self.origin + len(self.counts)) - new_origin, dtype = np.int64)
+            new_counts[self.origin - new_origin : self.origin - new_origin + len(self.counts)] = self.counts
+            self.origin, self.counts = new_origin, new_counts
+        ## bin numbers can repeat (e.g. when adding the contributions of several micrographs at once)
+        np.add.at(self.counts, bins - self.origin, sign * counts)
+        self.n += sign * int(counts.sum())
+        self._cumulative = None
+        return
+
+    def update_micrograph(self, name, scores, stamp = None):
+        """ Replace the scores of a micrograph in the histogram
+            PARAMETERS
+                name = str(); micrograph name (e.g. 'mic_0001.jpg')
+                scores = list( float(), ... ) or np array; all current pick scores of the micrograph
+                stamp = float() or None; identifies the source the scores were read from (e.g. file modification time)
+        """
+        scores = np.asarray(scores, dtype = np.float64).ravel()
+        scores = scores[np.isfinite(scores)]
+        self.remove_micrograph(name)
+        bins, counts = np.unique(np.floor(scores / self.bin_width).astype(np.int64), return_counts = True)
+        self._add_bins(bins, counts.astype(np.int64))
+        self.contributions[name] = (bins, counts.astype(np.int64))
+        if stamp is not None:
+            self.stamps[name] = float(stamp)
+        if self.DEBUG:
+            print(" Score histogram :: %s scores for %s, %s scores from %s micrographs" % (len(scores), name, self.n, len(self.contributions)))
+        return
+
+    def remove_micrograph(self, name):
+        if name in self.contributions:
+            bins, counts = self.contributions.pop(name)
+            self._add_bins(bins, counts, sign = -1)
+        self.stamps.pop(name, None)
+        return
+
+    def cumulative(self):
+        """ RETURNS
+                cumulative = np array (len(counts) + 1) of int64; cumulative[i] = number of scores in the bins below bin i (cached until the next change)
+        """
+        if self._cumulative is None:
+            self._cumulative = np.concatenate(([0], np.cumsum(self.counts)))
+        return self._cumulative
+
+    def score_range(self):
+        """ RETURNS
+                low, high = float(), float(); lower edge of the lowest & upper edge of the highest non-empty bin (None, None if empty)
+        """
+        filled = np.flatnonzero(self.counts)
+        if len(filled) == 0:
+            return None, None
+        return (self.origin + filled[0]) * self.bin_width, (self.origin + filled[-1] + 1) * self.bin_width
+
+    def count_below(self, threshold):
+        """ Number of scores below a threshold (or an array of thresholds), assuming the scores are spread evenly within each bin
+        """
+        cumulative = self.cumulative()
+        position = np.clip(np.asarray(threshold, dtype = np.float64) / self.bin_width - self.origin, 0, len(self.counts))
+        return np.interp(position, np.arange(len(cumulative)), cumulative)
+
+    def count_above(self, threshold):
+        """ Number of scores at or above a threshold (or an array of thresholds), rounded to whole picks
+        """
+        return np.rint(self.n - self.count_below(threshold)).astype(np.int64)
+
+    def percentile(self, q):
+        """ The score below which q % (0 - 100) of all scores lie, or None if the histogram is empty
+        """
+        if self.n <= 0:
+            return None
+        cumulative = self.cumulative()
+        target = np.clip(np.asarray(q, dtype = np.float64), 0, 100) / 100 * self.n
+        ## the first bin that reaches the target (always a non-empty bin, except for q = 0), then interpolate within it
+        bins = np.minimum(np.searchsorted(cumulative[1:], target, side = 'left'), len(self.counts) - 1)
+        bins = np.where(target > 0, bins, np.flatnonzero(self.counts)[0])
+        fraction = np.clip((target - cumulative[bins]) / np.maximum(self.counts[bins], 1), 0, 1)
+        position = self.origin + bins + fraction
+        return position * self.bin_width if np.ndim(position) > 0 else float(position) * self.bin_width
+
+    def save(self, histogram_file = None):
+        """ Write the histogram to its .npz file (via a temporary file, so an interrupted write keeps the previous state)
+        """
+        if histogram_file is None:
+            histogram_file = self.histogram_file
+        names = sorted(self.contributions)
+        lengths = [ len(self.contributions[name][0]) for name in names ]
+        bins = np.concatenate([ self.contributions[name][0] for name in names ]) if len(names) > 0 else np.zeros(0, dtype = np.int64)
+        counts = np.concatenate([ self.contributions[name][1] for name in names ]) if len(names) > 0 else np.zeros(0, dtype = np.int64)
+        stamps = [ self.stamps.get(name, np.nan) for name in names ]
+        tmp_file = histogram_file + '.tmp.npz'
+        np.savez(tmp_file, bin_width = self.bin_width, names = np.array(names, dtype = str), lengths = np.array(lengths, dtype = np.int64),
+                 bins = bins, counts = counts, stamps = np.array(stamps, dtype = np.float64))
+        os.replace(tmp_file, histogram_file)
+        if self.DEBUG:
+            print(" Saved score histogram (%s scores from %s micrographs): %s" % (self.n, len(names), histogram_file))
+        return
+
+    def load(self, histogram_file = None):
+        """ Read a histogram written by save(), the totals are rebuilt from the contributions of each micrograph
+        """
+        if histogram_file is None:
+            histogram_file = self.histogram_file
+        with np.load(histogram_file) as data:
+            self.bin_width = float(data['bin_width'])
+            names = data['names'].tolist()
+            offsets = np.cumsum(data['lengths'])[:-1]
+            bins = np.split(data['bins'], offsets)
+            counts = np.split(data['counts'], offsets)
+            stamps = data['stamps']
+        self.origin = 0
+        self.counts = np.zeros(0, dtype = np.int64)
+        self.n = 0
+        self.contributions = dict()
+        self.stamps = dict()
+        self._cumulative = None
+        if len(names) > 0:
+            self._add_bins(np.concatenate(bins), np.concatenate(counts))
+        for name, micrograph_bins, micrograph_counts, stamp in zip(names, bins, counts, stamps):
+            self.contributions[name] = (micrograph_bins, micrograph_counts)
+            if np.isfinite(stamp):
+                self.stamps[name] = float(stamp)
+        if self.DEBUG:
+            print(" Loaded score histogram (bin width %s, %s scores from %s micrographs): %s" % (self.bin_width, self.n, len(names), histogram_file))
+        return
+
+def read_star_scores(starfile):
+    """ Read only the scores (_rlnAutopickFigureOfMerit) of a coordinate .STAR file, with negative scores read as 0
+        (as when the coordinates are loaded for display)
+        RETURNS
+            scores = np array of float64 (empty if the file has no score column)
+    """
+    import star_handler
+
+    columns, DATA_START = star_handler.get_star_columns(starfile, 'data_')
+    if '_rlnAutopickFigureOfMerit' not in columns:
+        return np.zeros(0, dtype = np.float64)
+    score_column = columns['_rlnAutopickFigureOfMerit'] - 1
+    scores = [ float(row[score_column]) for row in star_handler.iter_star_rows(starfile, DATA_START) if len(row) > score_column ]
+    return np.maximum(np.array(scores, dtype = np.float64), 0)
+
+def usage():
+    print("===================================================================================================")
+    print(" Print a summary of the dataset-wide score histogram kept by em_dataset_curator.py:")
+    print("    $ score_histogram.py  %s" % DEFAULT_HISTOGRAM_FILE)
+    print(" Options: ")
+    print("     --threshold  <n>  :: number of picks at or above this score")
+    print("    --percentile  <n>  :: score that drops the lowest n % of picks")
+    print("===================================================================================================")
+    sys.exit()
+
+#############################################
+##  RUN BLOCK
+#############################################
+if __name__ == "__main__":
+
+    ## Get the execution path of this script so we can find local modules
+    sys.path.append(os.path.dirname(os.path.abspath(sys.argv[0])))
+
+    if len(sys.argv) < 2 or '--help' in sys.argv or '-h' in sys.argv:
+        usage()
+
+    histogram_file = sys.argv[1]
+    options = {}
+    for i in range(2, len(sys.argv) - 1, 2):
+        options[sys.argv[i]] = sys.argv[i + 1]
+    for option in options:
+        if option not in ['--threshold', '--percentile']:
+            print(" ERROR :: Unrecognized option: %s" % option)
+            usage()
+    if not os.path.exists(histogram_file):
+        print(" ERROR :: Could not find histogram file: %s" % histogram_file)
+        usage()
+
+    histogram = ScoreHistogram(histogram_file, DEBUG = True)
+    if histogram.n <= 0:
+        print(" No scores in the histogram yet")
+        sys.exit()
+    low, high = histogram.score_range()
+    print(" %s picks from %s micrographs, scores %.2f - %.2f" % (histogram.n, len(histogram.contributions), low, high))
+    if '--threshold' in options:
+        threshold = float(options['--threshold'])
+        print("   at or above %s :: %s picks" % (threshold, histogram.count_above(threshold)))
+    elif '--percentile' in options:
+        q = float(options['--percentile'])
+        threshold = histogram.percentile(q)
+        print("   %s th percentile :: score %.3f (%s picks at or above)" % (q, threshold, histogram.count_above(threshold)))
+    else:
+        for q in range(10, 100, 10):
+            threshold = histogram.percentile(q)
+            print("   %2s th percentile :: score %.3f (%s picks at or above)" % (q, threshold, histogram.count_above(threshold)))
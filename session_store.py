@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+## 2026-10-19: Wrote module
+
+"""
+    An optional single-file session database (SQLite, WAL mode) for em_dataset_curator.py.
+    Instead of one '_CURATED.star' file per micrograph, a 'marked_imgs.txt' file and a settings file, all
+    curation state is kept in one file:
+        micrographs  :: one row per curated micrograph (name, marked flag)
+        coordinates  :: particle coordinates in .MRC pixels with their selection type, psi angle & score
+        settings     :: key/value pairs of the last used program settings
+    Saving a micrograph replaces all of its coordinates in a single transaction. STAR, marked-list and topaz
+    outputs are materialized on demand with the export functions, e.g.:
+        $ session_store.py  .em_dataset_curator.db  --export_star curated/  --export_marked marked_imgs.txt
+    Import this module directly via:
+        from session_store import SessionStore
+"""
+
+import os
+import sys
+import sqlite3
+
+DEFAULT_SESSION_FILE = '.em_dataset_curator.db'
+## image suffixes em_dataset_curator.py opens, in the order an image is matched to a .STAR file when several exist
+IMAGE_FORMATS = ['.jpg', '.jpeg', '.gif', '.mrc']
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS micrographs (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        marked INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS coordinates (
+        micrograph_id INTEGER NOT NULL REFERENCES micrographs(id),
+        x REAL NOT NULL,
+        y REAL NOT NULL,
+        selection_type INTEGER NOT NULL DEFAULT -999,
+        psi REAL NOT NULL DEFAULT -999.0,
+        score REAL NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS coordinates_by_micrograph ON coordinates(micrograph_id);
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+"""
+
+class SessionStore:
+    """
+    Read/write access to a curation session database. Opening a session only creates the tables (if missing);
+    coordinates are fetched per micrograph on demand, so opening is fast regardless of dataset size.
+    ### USAGE:
+    ```
+        session = SessionStore('.em_dataset_curator.db')
+        session.save_micrograph('mic_0001.jpg', [ (x, y, selection_type, psi, score), ... ], marked = False)
+        coordinates = session.load_coordinates('mic_0001.jpg')
+        session.export_star('curated/')
+        session.close()
+    ```
+    """
+    def __init__(self, db_file = DEFAULT_SESSION_FILE, DEBUG = False):
+        self.db_file = db_file
+        self.DEBUG = DEBUG
+        self.connection = sqlite3.connect(db_file)
+        ## write-ahead logging keeps commits cheap and lets readers (e.g. an export) run alongside the GUI
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+        if DEBUG:
+            print(" Opened session database: %s" % os.path.abspath(db_file))
+        return
+
+    def close(self):
+        self.connection.close()
+        return
+
+    def _micrograph_id(self, name):
+        """ Return the id for the micrograph name, adding a new row if necessary (call within a transaction)
+        """
+        self.connection.execute("INSERT OR IGNORE INTO micrographs (name) VALUES (?)", (name,))
+        return self.connection.execute("SELECT id FROM micrographs WHERE name = ?", (name,)).fetchone()[0]
+
+    def save_micrograph(self, name, coordinates, marked = None):
+        """ Replace all coordinates of a micrograph (and optionally its marked flag) in a single transaction
+            PARAMETERS
+                name = str(); image name (e.g. 'mic_0001.jpg')
+                coordinates = list( tuple(x, y, selection_type, psi, score), ... ); in .MRC pixels
+                marked = bool() or None; None leaves the flag unchanged
+        """
+        with self.connection:
+            self._replace_coordinates(name, coordinates, marked)
+        return
+
+    def _replace_coordinates(self, name, coordinates, marked = None):
+        """ Replace all coordinates of a micrograph, see: save_micrograph (call within a transaction)
+        """
+        micrograph_id = self._micrograph_id(name)
+        if marked is not None:
+            self.connection.execute("UPDATE micrographs SET marked = ? WHERE id = ?", (int(marked), micrograph_id))
+        self.connection.execute("DELETE FROM coordinates WHERE micrograph_id = ?", (micrograph_id,))
+        self.connection.executemany("INSERT INTO coordinates (micrograph_id, x, y, selection_type, psi, score) VALUES (?, ?, ?, ?, ?, ?)",
+                                    ((micrograph_id, x, y, int(selection_type), psi, score) for x, y, selection_type, psi, score in coordinates))
+        return
+
+    def load_coordinates(self, name):
+        """ RETURNS
+                coordinates = list( tuple(x, y, selection_type, psi, score), ... ), or None if the micrograph was never saved in this session
+        """
+        row = self.connection.execute("SELECT id FROM micrographs WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return self.connection.execute("SELECT x, y, selection_type, psi, score FROM coordinates WHERE micrograph_id = ?", (row[0],)).fetchall()
+
+    def load_scores(self):
+        """ RETURNS
+                scores = dict(); { micrograph name : list( score, ... ) } for every micrograph saved in this session (in one query)
+        """
+        scores = { row[0] : [] for row in self.connection.execute("SELECT name FROM micrographs") }
+        for name, score in self.connection.execute("SELECT m.name, c.score FROM coordinates c JOIN micrographs m ON m.id = c.micrograph_id"):
+            scores[name].append(score)
+        return scores
+
+    def set_marked(self, names):
+        """ Replace the set of marked micrographs in a single transaction
+        """
+        with self.connection:
+            self._replace_marked(names)
+        return
+
+    def _replace_marked(self, names):
+        """ Replace the set of marked micrographs, see: set_marked (call within a transaction)
+        """
+        self.connection.execute("UPDATE micrographs SET marked = 0 WHERE marked != 0")
+        self.connection.executemany("INSERT INTO micrographs (name, marked) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET marked = 1",
+                                    ((name,) for name in names))
+        return
+
+    def load_marked(self):
+        """ RETURNS
+                marked = list( str(), ... ); names of all marked micrographs
+        """
+        return [ row[0] for row in self.connection.execute("SELECT name FROM micrographs WHERE marked != 0 ORDER BY name") ]
+
+    def save_settings(self, settings):
+        """ settings = dict(); { key : value, ... }, values are stored as strings
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                                        ((key, str(settings[key])) for key in settings))
+        return
+
+    def load_settings(self):
+        """ RETURNS
+                settings = dict(); { key : str(value), ... }
+        """
+        return dict(self.connection.execute("SELECT key, value FROM settings").fetchall())
+
+    def import_curated_dir(self, input_dir = '.', marked_file = None, image_dir = '.'):
+        """ Populate the session from an existing set of '_CURATED.star' files (and optionally a marked images file) in a
+            single transaction, so an interrupted import leaves the session as it was
+            PARAMETERS
+                input_dir = str(); directory of '_CURATED.star' files
+                marked_file = str() or None; marked images file (e.g. marked_imgs.txt)
+                image_dir = str(); directory of the images, whose file names the session is keyed on (input_dir is also searched)
+        """
+        import star_handler
+        suffix = '_CURATED.star'
+        counter = 0
+        ## the session is keyed on the image file name, so find the image each .STAR file belongs to (e.g. mic_0001_CURATED.star -> mic_0001.gif)
+        image_names = dict()
+        images = []
+        for directory in [input_dir, image_dir]:
+            if os.path.isdir(directory):
+                images.extend(sorted(os.listdir(directory)))
+        for image_format in IMAGE_FORMATS:
+            for image in images:
+                basename, extension = os.path.splitext(image)
+                if extension.lower() == image_format and basename not in image_names:
+                    image_names[basename] = image
+        unmatched = []
+        with self.connection:
+            for fname in sorted(os.listdir(input_dir)):
+                if not fname.endswith(suffix):
+                    continue
+                star_file = os.path.join(input_dir, fname)
+                columns, data_start = star_handler.get_star_columns(star_file, 'data_')
+                if '_rlnCoordinateX' not in columns or '_rlnCoordinateY' not in columns:
+                    continue
+                x_index = columns['_rlnCoordinateX'] - 1
+                y_index = columns['_rlnCoordinateY'] - 1
+                type_index = columns.get('_rlnParticleSelectionType', 0) - 1
+                psi_index = columns.get('_rlnAnglePsi', 0) - 1
+                score_index = columns.get('_rlnAutopickFigureOfMerit', 0) - 1
+                coordinates = []
+                for row in star_handler.iter_star_rows(star_file, data_start):
+                    coordinates.append((float(row[x_index]), float(row[y_index]),
+                                        int(float(row[type_index])) if type_index >= 0 else -999,
+                                        float(row[psi_index]) if psi_index >= 0 else -999.0,
+                                        float(row[score_index]) if score_index >= 0 else 0.0))
+                basename = fname[:-len(suffix)]
+                if basename not in image_names:
+                    ## no image found, assume a .jpg
+                    unmatched.append(fname)
+                self._replace_coordinates(image_names.get(basename, basename + '.jpg'), coordinates)
+                counter += 1
+            if marked_file is not None and os.path.exists(marked_file):
+                with open(marked_file, 'r') as f :
+                    names = [ line.split()[0] for line in f if len(line.split()) > 0 and line[0] != '#' ]
+                self._replace_marked(names)
+        print(" Imported %s '%s' files into session: %s" % (counter, suffix, self.db_file))
+        if len(unmatched) > 0:
+            print(" WARNING :: No image found for %s '%s' files (saved as '.jpg' images), e.g.: %s" % (len(unmatched), suffix, unmatched[0]))
+        return counter
+
+    def export_star(self, output_dir = '.'):
+        """ Write a '_CURATED.star' file for every micrograph saved in the session
+        """
+        import star_handler
+        os.makedirs(output_dir, exist_ok = True)
+        counter = 0
+        micrographs = self.connection.execute("SELECT id, name FROM micrographs ORDER BY name").fetchall()
+        for micrograph_id, name in micrographs:
+            coordinates = self.connection.execute("SELECT x, y, selection_type, psi, score FROM coordinates WHERE micrograph_id = ?", (micrograph_id,))
+            save_fname = os.path.join(output_dir, os.path.splitext(name)[0] + '_CURATED.star')
+            with open(save_fname, 'w') as f :
+                f.write(star_handler.format_coordinates_star(coordinates))
+            counter += 1
+        print(" Exported %s '_CURATED.star' files into: %s" % (counter, os.path.abspath(output_dir)))
+        return counter
+
+    def export_marked(self, output_file = 'marked_imgs.txt'):
+        """ Write the names of all marked micrographs into a file (one per line)
+        """
+        marked = self.load_marked()
+        with open(output_file, 'w') as f :
+            for name in marked:
+                f.write("%s\n" % name)
+        print(" Exported %s marked micrographs into: %s" % (len(marked), output_file))
+        return len(marked)
+
+    def export_topaz(self, output_file = 'particles.txt', binning = 1.0):
+        """ Write all coordinates into a topaz-style particles file (image_name, x_coord, y_coord, score; tab-separated).
+            Coordinates are divided by the binning factor, to match images topaz was run on.
+        """
+        counter = 0
+        with open(output_file, 'w') as f :
+            f.write("%s\t%s\t%s\t%s\n" % ('image_name', 'x_coord', 'y_coord', 'score'))
+            rows = self.connection.execute("SELECT m.name, c.x, c.y, c.score FROM coordinates c JOIN micrographs m ON m.id = c.micrograph_id ORDER BY m.name")
+            for name, x, y, score in rows:
+                f.write("%s\t%s\t%s\t%s\n" % (os.path.splitext(name)[0], int(x / binning), int(y / binning), score))
+                counter += 1
+        print(" Exported %s particles into: %s" % (counter, output_file))
+        return counter
+
+def usage():
+    print("===================================================================================================")
+    print(" Export (or import) the contents of an em_dataset_curator.py session database:")
+    print("    $ session_store.py  %s  --export_star curated/" % DEFAULT_SESSION_FILE)
+    print(" Options: ")
+    print("       --export_star  <dir>  :: write a '_CURATED.star' file per micrograph")
+    print("     --export_marked  <file> :: write the marked images list (e.g. marked_imgs.txt)")
+    print("      --export_topaz  <file> :: write all particles as a topaz-style particles file")
+    print("            --binning  <n>   :: (with --export_topaz) divide coordinates by this factor")
+    print("             --import  <dir> :: load existing '_CURATED.star' files (and marked_imgs.txt) into the session")
+    print("             --images  <dir> :: (with --import) directory of the images the '.STAR' files belong to (default: .)")
+    print("===================================================================================================")
+    sys.exit()
+
+#############################################
+##  RUN BLOCK
+#############################################
+if __name__ == "__main__":
+    import time
+
+    ## Get the execution path of this script so we can find local modules
+    sys.path.append(os.path.dirname(os.path.abspath(sys.argv[0])))
+
+    if len(sys.argv) < 3 or '--help' in sys.argv or '-h' in sys.argv:
+        usage()
+
+    db_file = sys.argv[1]
+    options = {}
+    for i in range(2, len(sys.argv) - 1, 2):
+        options[sys.argv[i]] = sys.argv[i + 1]
+    for option in options:
+        if option not in ['--export_star', '--export_marked', '--export_topaz', '--binning', '--import', '--images']:
+            print(" ERROR :: Unrecognized option: %s" % option)
+            usage()
+
+    start_time = time.time()
+    session = SessionStore(db_file, DEBUG = True)
+    if '--import' in options:
+        session.import_curated_dir(options['--import'], os.path.join(options['--import'], 'marked_imgs.txt'), options.get('--images', '.'))
+    if '--export_star' in options:
+        session.export_star(options['--export_star'])
+    if '--export_marked' in options:
+        session.export_marked(options['--export_marked'])
+    if '--export_topaz' in options:
+        session.export_topaz(options['--export_topaz'], float(options.get('--binning', 1.0)))
+    session.close()
+    print(" ... done (%.2f s)" % (time.time() - start_time))
@@ -108,6 +108,90 @@ def find_star_column(file, column_name, header_start, header_end, DEBUG = True)
                         # print("-------------------------------------------------------------")
                     return column_num
 
+def get_star_columns(file, table_title, DEBUG = False):
+    """ Read the header of a relion .STAR loop table in a single pass and return all of its columns.
+        Reading stops at the first data entry, so this is cheap even for very large files (compare with
+        calling find_star_column once per column, which re-reads the file each time).
+		---------------------------------------------------------------
+		PARAMETERS
+		---------------------------------------------------------------
+			file = str(); name of .STAR file with tables (e.g. "micrographs_ctf.star")
+			table_title = str(); name of the .STAR table we are interested in (e.g. "data_micrographs")
+			DEBUG = bool(); optionally print out steps during run
+		---------------------------------------------------------------
+		RETURNS
+		---------------------------------------------------------------
+			columns = dict(); { '_rlnColumnName' : column_num, ... } (empty if the table is not found)
+			DATA_START = int(); line number for the first data entry after header (-1 if the table has no data)
+    """
+    columns = dict()
+    TABLE_START = -1
+    HEADER_START = -1
+    DATA_START = -1
+
+    with open(file, 'r') as f :
+        line_num = 0
+        for line in f :
+            line_num += 1
+            line_to_list = line.split()
+            ## skip empty lines
+            if len(line_to_list) == 0 :
+                continue
+            ## catch the table title
+            if TABLE_START < 0:
+                if line_to_list[0] == table_title:
+                    TABLE_START = line_num
+                continue
+            ## catch the header start position
+            if HEADER_START < 0:
+                if line_to_list[0] == "loop_":
+                    HEADER_START = line_num + 1
+                continue
+            ## header entries are of the form: _rlnColumnName #3
+            if line_to_list[0][0] == '_':
+                columns[line_to_list[0]] = int(line_to_list[1].replace("#",""))
+                continue
+            ## a new table starting before any data means this table is empty
+            if line_to_list[0][:5] == 'data_':
+                break
+            ## first line after the header that is not a column entry is the start of the data
+            DATA_START = line_num
+            break
+
+    if DEBUG:
+        print(" Columns for table '%s' in %s" % (table_title, file))
+        for column_name in columns:
+            print("   >> %s #%s" % (column_name, columns[column_name]))
+        print("   >> Data starts at line: %s" % DATA_START)
+        print("-------------------------------------------------------------")
+    return columns, DATA_START
+
+def iter_star_rows(file, data_start):
+    """ Stream the data entries of a .STAR loop table one line at a time, without holding the table in memory.
+        Iteration ends at the first empty line, at the start of the next table, or at the end of the file.
+		---------------------------------------------------------------
+		PARAMETERS
+		---------------------------------------------------------------
+			file = str(); name of the star file to parse
+			data_start = int(); line number of the first data entry (e.g. from get_star_columns)
+		---------------------------------------------------------------
+		RETURNS
+		---------------------------------------------------------------
+			generator of list( str(), ... ); the column entries of each data line, index with (column_num - 1)
+    """
+    if data_start < 0:
+        return
+    with open(file, 'r') as f :
+        line_num = 0
+        for line in f :
+            line_num += 1
+            if line_num < data_start:
+                continue
+            line_to_list = line.split()
+            if len(line_to_list) == 0 or line_to_list[0][:5] == 'data_':
+                return
+            yield line_to_list
+
 def get_star_data(line, column, DEBUG = False):
     """ For a given .STAR file line entry, extract the data at the given column index.
         If the column does not exist (e.g. for a header line read in), return 'False'
@@ -132,6 +216,38 @@ def get_star_data(line, column, DEBUG = False):
     except:
         return False
 
+def format_coordinates_star(coordinates):
+    """ Format particle coordinates as the text of a simple coordinates .STAR file (as written by em_dataset_curator.py, i.e. '_CURATED.star')
+	---------------------------------------------------------------
+	PARAMETERS
+	---------------------------------------------------------------
+		coordinates = list( tuple(x, y, selection_type, psi, score), ... ); in .MRC pixels, with selection_type = 2 for manual picks or -999
+	---------------------------------------------------------------
+	RETURNS
+	---------------------------------------------------------------
+		star_text = str(); the full file contents, ready to be written to disk
+    """
+    lines = []
+    ############
+    ## HEADER
+    ############
+    lines.append("\n")
+    lines.append("data_\n")
+    lines.append("\n")
+    lines.append("loop_\n")
+    lines.append("_rlnCoordinateX #1\n")
+    lines.append("_rlnCoordinateY #2\n")
+    lines.append("_rlnParticleSelectionType #3\n")
+    lines.append("_rlnAnglePsi #4\n")
+    lines.append("_rlnAutopickFigureOfMerit #5\n")
+    lines.append("\n")
+    ############
+    ## BODY
+    ############
+    for x, y, selection_type, psi, score in coordinates:
+        lines.append("%.2f    %.2f   \t %s     %.1f    %.2f \n" % (x, y, int(selection_type), psi, score))
+    return "".join(lines)
+
 def remove_path(file_w_path):
     """ Parse an input string containing a path and return the file name without the path. Useful for getting micrograph name from 'rlnMicrographName' column.
 	---------------------------------------------------------------
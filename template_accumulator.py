@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+## 2026-10-19: Wrote module
+
+"""
+    A dataset-level template for em_dataset_curator.py, built up as micrographs are curated.
+    Every pick is boxed out at a fixed box size & pixel size, normalized (zero mean, unit standard deviation) and
+    added into a running sum and sum-of-squares. The boxes accumulated for each micrograph are remembered by their
+    coordinates, so when a micrograph is saved again only the picks that were added or deleted since are boxed out
+    (deleted picks are subtracted from the sums). The state persists in a single .npz file, e.g.:
+        $ template_accumulator.py  .template_accumulator.npz  --o template.png
+    Import this module directly via:
+        from template_accumulator import TemplateAccumulator
+"""
+
+import os
+import sys
+import numpy as np
+
+DEFAULT_ACCUMULATOR_FILE = '.template_accumulator.npz'
+
+class TemplateAccumulator:
+    """
+    Running sum & sum-of-squares of normalized particle boxes at a fixed box size (px) and pixel size (Ang/px).
+    If the accumulator file exists it is loaded, and its box size & pixel size are used instead of the ones given.
+    ### USAGE:
+    ```
+        accumulator = TemplateAccumulator('.template_accumulator.npz', box_size = 64, angpix = 4.0)
+        accumulator.update_micrograph('mic_0001.jpg', im_array, im_angpix, [ (x, y), ... ])
+        accumulator.save()
+        template = accumulator.template(im_angpix) ## 0 - 255, at the pixel size of the image to pick
+    ```
+    """
+    def __init__(self, accumulator_file = DEFAULT_ACCUMULATOR_FILE, box_size = 64, angpix = 1.0, DEBUG = False):
+        self.accumulator_file = accumulator_file
+        self.DEBUG = DEBUG
+        if accumulator_file is not None and os.path.exists(accumulator_file):
+            self.load()
+        else:
+            ## boxes are cut out at an even size (see image_handler.extract_box_stack)
+            self.box_size = 2 * (int(box_size) // 2)
+            self.angpix = float(angpix)
+            self.sum = np.zeros((self.box_size, self.box_size), dtype = np.float64)
+            self.sumsq = np.zeros((self.box_size, self.box_size), dtype = np.float64)
+            self.n = 0
+            ## { micrograph name : np array [ [x1, y1], ... ] } of the picks whose boxes are in the sums
+            self.contributions = dict()
+        return
+
+    def add_boxes(self, boxes, sign = 1):
+        """ Normalize each box of an (n, box_size, box_size) stack and add it to the sums (or subtract it, with sign = -1)
+        """
+        boxes = np.asarray(boxes, dtype = np.float64)
+        if len(boxes) == 0:
+            return
+        boxes = boxes - boxes.mean(axis = (1, 2), keepdims = True)
+        stdev = boxes.std(axis = (1, 2), keepdims = True)
+        boxes /= np.where(stdev > 0, stdev, 1)
+        self.sum += sign * boxes.sum(axis = 0)
+        self.sumsq += sign * np.square(boxes).sum(axis = 0)
+        self.n += sign * len(boxes)
+        return
+
+    def update_micrograph(self, name, im_array, im_angpix, coordinates, coordinate_scale = 1.0):
+        """ Bring the sums up to date with the current picks on a micrograph: boxes of new picks are added and boxes of
+            picks that are no longer present are subtracted. Picks whose box does not fit in the image are not accumulated.
+            PARAMETERS
+                name = str(); micrograph name (e.g. 'mic_0001.jpg')
+                im_array = 2d np array; the image to box out from (deleted picks are boxed out again, so this must be the same
+                           image each time a micrograph is updated, e.g. the image file rather than a processed display image)
+                im_angpix = float(); pixel size of im_array (Ang/px)
+                coordinates = list( tuple(x, y), ... ); all current picks, in units where (x, y) * coordinate_scale is the position on im_array
+            RETURNS
+                n_added, n_removed = int(), int()
+        """
+        import image_handler
+
+        coordinates = np.rint(np.asarray(coordinates, dtype = np.float64).reshape(-1, 2)).astype(np.int64)
+        previous = self.contributions.get(name, np.zeros((0, 2), dtype = np.int64))
+        previous_set = set(map(tuple, previous.tolist()))
+        current_set = set(map(tuple, coordinates.tolist()))
+        removed = np.array(sorted(previous_set - current_set), dtype = np.int64).reshape(-1, 2)
+        added = np.array(sorted(current_set - previous_set), dtype = np.int64).reshape(-1, 2)
+        if len(removed) == 0 and len(added) == 0:
+            return 0, 0
+
+        ## box out on a copy of the image rescaled to the pixel size of the accumulator
+        rescale = im_angpix / self.angpix
+        im = resize_to_angpix(im_array, im_angpix, self.angpix)
+        removed_boxes, removed_in_bounds = image_handler.extract_box_stack(im, self.box_size, removed * coordinate_scale * rescale)
+        added_boxes, added_in_bounds = image_handler.extract_box_stack(im, self.box_size, added * coordinate_scale * rescale)
+        self.add_boxes(removed_boxes, sign = -1)
+        self.add_boxes(added_boxes)
+
+        ## removed picks were in bounds when they were added, so only keep track of the added picks that made it into the sums
+        kept = previous_set - set(map(tuple, removed.tolist()))
+        kept.update(map(tuple, added[added_in_bounds].tolist()))
+        self.contributions[name] = np.array(sorted(kept), dtype = np.int64).reshape(-1, 2)
+        if len(self.contributions[name]) == 0:
+            del self.contributions[name]
+
+        if self.DEBUG:
+            print(" Template accumulator :: %s (+%s, -%s boxes), %s boxes from %s micrographs" % (name, len(added_boxes), len(removed_boxes), self.n, len(self.contributions)))
+        return len(added_boxes), len(removed_boxes)
+
+    def mean(self):
+        """ RETURNS
+                mean = np array (box_size, box_size) of the average normalized box (zeros if empty)
+        """
+        if self.n <= 0:
+            return np.zeros_like(self.sum)
+        return self.sum / self.n
+
+    def std(self):
+        """ RETURNS
+                std = np array (box_size, box_size) of the per-pixel standard deviation of the normalized boxes
+        """
+        if self.n <= 0:
+            return np.zeros_like(self.sum)
+        return np.sqrt(np.maximum(self.sumsq / self.n - np.square(self.mean()), 0))
+
+    def template(self, angpix = None):
+        """ The mean box rescaled into the range 0 - 255, optionally resized to a given pixel size (e.g. of the displayed image)
+            RETURNS
+                template = np array of uint8, or None if no boxes have been accumulated
+        """
+        if self.n <= 0:
+            return None
+        merged = self.mean()
+        if angpix is not None:
+            merged = resize_to_angpix(merged, self.angpix, angpix)
+        if np.ptp(merged) == 0:
+            return np.zeros(merged.shape, dtype = np.uint8)
+        return (255 * (merged - np.min(merged)) / np.ptp(merged)).astype(np.uint8)
+
+    def save(self, accumulator_file = None):
+        """ Write the accumulator to its .npz file (via a temporary file, so an interrupted write keeps the previous state)
+        """
+        if accumulator_file is None:
+            accumulator_file = self.accumulator_file
+        names = sorted(self.contributions)
+        counts = [ len(self.contributions[name]) for name in names ]
+        coordinates = np.concatenate([ self.contributions[name] for name in names ]) if len(names) > 0 else np.zeros((0, 2), dtype = np.int64)
+        tmp_file = accumulator_file + '.tmp.npz'
+        np.savez(tmp_file, box_size = self.box_size, angpix = self.angpix, sum = self.sum, sumsq = self.sumsq, n = self.n,
+                 names = np.array(names, dtype = str), counts = np.array(counts, dtype = np.int64), coordinates = coordinates)
+        os.replace(tmp_file, accumulator_file)
+        if self.DEBUG:
+            print(" Saved template accumulator (%s boxes from %s micrographs): %s" % (self.n, len(names), accumulator_file))
+        return
+
+    def load(self, accumulator_file = None):
+        if accumulator_file is None:
+            accumulator_file = self.accumulator_file
+        with np.load(accumulator_file) as data:
+            self.box_size = int(data['box_size'])
+            self.angpix = float(data['angpix'])
+            self.sum = data['sum']
+            self.sumsq = data['sumsq']
+            self.n = int(data['n'])
+            offsets = np.cumsum(data['counts'])[:-1]
+            self.contributions = dict(zip(data['names'].tolist(), np.split(data['coordinates'], offsets)))
+        if self.DEBUG:
+            print(" Loaded template accumulator (%s px box at %s Ang/px, %s boxes from %s micrographs): %s" % (self.box_size, self.angpix, self.n, len(self.contributions), accumulator_file))
+        return
+
+def resize_to_angpix(im_array, angpix, new_angpix):
+    """ Resize an image from one pixel size to another (returns float32)
+    """
+    import cv2
+    im = np.asarray(im_array, dtype = np.float32)
+    scale = angpix / new_angpix
+    if scale == 1:
+        return im
+    new_dimensions = (max(1, int(round(im.shape[1] * scale))), max(1, int(round(im.shape[0] * scale))))
+    return cv2.resize(im, new_dimensions, interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+
+def check_accumulator(box_sizes = (64, 63), n_edits = 20):
+    """ Check that adding & removing picks over several saves gives the same sums as accumulating the final picks in one go:
+            $ template_accumulator.py --check
+        RETURNS
+            True if the sums match for every box size
+    """
+    rng = np.random.default_rng(0)
+    im_array = rng.normal(0, 1, (1024, 1024)).astype(np.float32)
+    im_angpix = 2.0
+    all_passed = True
+
+    print("======================================================================")
+    print(" template_accumulator :: check_accumulator (%s edits)" % n_edits)
+    print("-------------------------------------------------------")
+    for box_size in box_sizes:
+        accumulator = TemplateAccumulator(None, box_size, angpix = 3.0)
+        picks = set()
+        for i in range(n_edits):
+            ## delete some picks, add some new ones (including some at the edge, which should not be accumulated)
+            picks = set(p for p in picks if rng.random() > 0.3)
+            picks.update(map(tuple, rng.integers(0, im_array.shape[0], (10, 2)).tolist()))
+            accumulator.update_micrograph('mic.jpg', im_array, im_angpix, sorted(picks))
+
+        reference = TemplateAccumulator(None, box_size, angpix = 3.0)
+        reference.update_micrograph('mic.jpg', im_array, im_angpix, sorted(picks))
+        passed = accumulator.n == reference.n and np.allclose(accumulator.sum, reference.sum) and np.allclose(accumulator.sumsq, reference.sumsq)
+        all_passed = all_passed and passed
+        print("    box size %s (%s px) :: %s boxes, %s" % (box_size, accumulator.box_size, accumulator.n, 'OK' if passed else 'FAIL'))
+    print("======================================================================")
+    return all_passed
+
+def usage():
+    print("===================================================================================================")
+    print(" Write out the current dataset template from an em_dataset_curator.py template accumulator:")
+    print("    $ template_accumulator.py  %s  --o template.png" % DEFAULT_ACCUMULATOR_FILE)
+    print(" Options: ")
+    print("          --o  <file> :: output image (default: template.png)")
+    print("     --angpix  <n>    :: resize the template to this pixel size (default: the accumulator pixel size)")
+    print(" Check that adding & removing picks keeps the sums consistent:")
+    print("    $ template_accumulator.py  --check")
+    print("===================================================================================================")
+    sys.exit()
+
+#############################################
+##  RUN BLOCK
+#############################################
+if __name__ == "__main__":
+    import cv2
+
+    ## Get the execution path of this script so we can find local modules
+    sys.path.append(os.path.dirname(os.path.abspath(sys.argv[0])))
+
+    if '--check' in sys.argv:
+        sys.exit(0 if check_accumulator() else 1)
+
+    if len(sys.argv) < 2 or '--help' in sys.argv or '-h' in sys.argv:
+        usage()
+
+    accumulator_file = sys.argv[1]
+    options = {}
+    for i in range(2, len(sys.argv) - 1, 2):
+        options[sys.argv[i]] = sys.argv[i + 1]
+    for option in options:
+        if option not in ['--o', '--angpix']:
+            print(" ERROR :: Unrecognized option: %s" % option)
+            usage()
+    if not os.path.exists(accumulator_file):
+        print(" ERROR :: Could not find accumulator file: %s" % accumulator_file)
+        usage()
+
+    accumulator = TemplateAccumulator(accumulator_file, DEBUG = True)
+    template = accumulator.template(float(options['--angpix']) if '--angpix' in options else None)
+    if template is None:
+        print(" No boxes accumulated yet, nothing to write")
+        sys.exit()
+    output_file = options.get('--o', 'template.png')
+    cv2.imwrite(output_file, template)
+    print(" Written template (%s x %s px): %s" % (template.shape[1], template.shape[0], output_file))